@@ -15,11 +15,20 @@
             --output_dir=<PATH TO THE OUTPUT DIRECTORY>\
             --input_dir=<PATH_TO_THE_DIRECTORY_CONTAINING_TIF_FILES>\
             --label_file=<PATH TO THE LABEL FILE>\
-            --threshold=<Threshold value for inference default is 0.5>
+            --threshold=<Threshold value for inference default is 0.5>\
+            --num_workers=<OPTIONAL NUMBER OF INFERENCE WORKER PROCESSES default is 1>\
+            --tile_shards=<OPTIONAL NUMBER OF TIF SHARDS PER MODEL default is 1>\
+            --intra_op_threads=<OPTIONAL TENSORFLOW INTRA OP THREADS default is 0>\
+            --inter_op_threads=<OPTIONAL TENSORFLOW INTER OP THREADS default is 0>\
+            --outputs=<OPTIONAL COMMA SEPARATED OUTPUTS default is visualizations,shape_files,csv>
     -> Output:
         - Image file having rectangles drawn on it
+        - Shape file per tif
+        - Single GeoPackage layer of all tifs (combined_layer output, opt-in)
+        - annotations.csv
 """
 import math
+import multiprocessing
 import os
 import sys
 
@@ -30,18 +39,158 @@ import fiona
 import rasterio
 
 from PIL import Image, ImageDraw
-from shapely.geometry import Polygon, mapping, box
-from scipy.ndimage.filters import gaussian_filter
+from shapely.geometry import Polygon
 from tqdm import tqdm
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../..") # for sibling import
 from  model_test import *
-from utils.convert_tiff_into_jpeg import convert_to_jpg
+from utils.convert_tiff_into_jpeg import convert_to_jpg, convert_array_to_jpg
+
+# writers of the output pass, see generate_outputs
+OUTPUT_WRITERS = ('visualizations', 'shape_files', 'combined_layer', 'csv')
+DEFAULT_OUTPUTS = ('visualizations', 'shape_files', 'csv')
+
+# combined layer is a GeoPackage with a spatial index, FlatGeobuf would need GDAL >= 3.1
+# while the pinned Fiona wheels bundle GDAL 2.4
+COMBINED_LAYER_DRIVER = 'GPKG'
+COMBINED_LAYER_EXTENSION = '.gpkg'
+COMBINED_LAYER_NAME = 'tree_crowns'
+
+CROWN_SCHEMA = {
+    'geometry': 'Polygon',
+    'properties': {'score': 'float',
+                   'ns_spread' : 'float',
+                   'ew_spread' : 'float',
+                   'volume' : 'float',
+                   'ndvi_avg' : 'float',
+                   'savi_avg' : 'float',
+                   'evi_avg': 'float'},
+    }
+
+def get_session_config(intra_op_threads, inter_op_threads):
+    '''
+        Method to build tensorflow session config with a pinned thread budget
+        params:
+            intra_op_threads : number of threads used inside a single op (0 = tensorflow default)
+            inter_op_threads : number of ops run in parallel (0 = tensorflow default)
+
+        return tf.ConfigProto or None when both values are left to tensorflow
+    '''
+    if not (intra_op_threads or inter_op_threads):
+        return None
+
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
+def get_core_partitions(num_workers):
+    '''
+        Method to split the cpu cores available to this process into
+        non overlapping sets, one set per worker process
+        params:
+            num_workers : number of worker processes
+
+        return list of core sets
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+
+    cores_per_worker = max(1, len(cores) // num_workers)
+
+    return [set(cores[index*cores_per_worker:(index+1)*cores_per_worker])
+            or {cores[index % len(cores)]}
+            for index in range(num_workers)]
+
+def get_tif_detections(detection_graph, model_file_name, tif_file_names, args,
+                       session_config=None):
+    '''
+        Method to run inference of one model over a list of tif files
+        params:
+            detection_graph : loaded frozen graph of the model
+            model_file_name : name of the model file, first three words denote bands
+            tif_file_names : list of tif file names in the input directory
+            args : commandline argument's dictionary
+            session_config : optional tf.ConfigProto used for the inference sessions
+
+        return list of (tif_file_name, [[boundary_box], class, score, model_file_name])
+        in the order of tif_file_names
+    '''
+    band_list = model_file_name.split('_')[:3]
+    tif_detections = []
+
+    for tif_file_name in tif_file_names:
+
+        tif_file_path = os.path.join(args['input_dir'], tif_file_name)
+        img_np = convert_to_jpg(
+                            tif_file_path,
+                            band_list.copy())
+
+        height, width, _ = img_np.shape
+
+        output_dict = run_inference_for_single_image(img_np, detection_graph, session_config)
+
+        for index, detection_score in enumerate(output_dict['detection_scores']):
+            if detection_score >= args['threshold']:
+                ymin, xmin, ymax, xmax = output_dict['detection_boxes'][index]
+
+                tif_detections.append((tif_file_name, [
+                    list(map(int, [xmin*width, ymin*height, xmax*width, ymax*height])),
+                    output_dict['detection_classes'][index],
+                    output_dict['detection_scores'][index],
+                    model_file_name]))
+
+    return tif_detections
+
+# state of an inference worker process, filled by init_inference_worker
+worker_state = {}
+
+def init_inference_worker(core_queue, intra_op_threads, inter_op_threads):
+    '''
+        Initializer of an inference worker process, pins the worker to its own
+        set of cpu cores and sizes the tensorflow thread pools to that set
+        params:
+            core_queue : queue holding one core set per worker
+            intra_op_threads : intra op threads (0 = number of pinned cores)
+            inter_op_threads : inter op threads (0 = 1)
+    '''
+    cores = core_queue.get()
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    worker_state['session_config'] = get_session_config(intra_op_threads or len(cores),
+                                                        inter_op_threads or 1)
+    worker_state['model_file_path'] = None
+    worker_state['detection_graph'] = None
+
+def run_inference_task(task):
+    '''
+        Method executed in a worker process to run one model over one shard of tif files
+        params:
+            task : (model_file_path, tif_file_names, args)
+
+        return list of (tif_file_name, detection) of this shard
+    '''
+    model_file_path, tif_file_names, args = task
+
+    # keep the last model loaded, consecutive shards of a model reuse it
+    if worker_state['model_file_path'] != model_file_path:
+        worker_state['detection_graph'] = get_detection_graph(model_file_path)
+        worker_state['model_file_path'] = model_file_path
+
+    return get_tif_detections(worker_state['detection_graph'],
+                              os.path.basename(model_file_path),
+                              tif_file_names,
+                              args,
+                              worker_state['session_config'])
 
 def get_inference_data(args):
     '''
         Method to run inference for each tif on all model
         and return the compiledinference data
+        when args['num_workers'] > 1 every (model, tif shard) pair runs in its own
+        worker process pinned to a partition of the cpu cores
 
         params:
             args : commandline argument's dictionary
@@ -57,43 +206,63 @@ def get_inference_data(args):
                                                                         use_display_name=True)
     tif_inference_data = defaultdict(list)
 
-    # looping over all model in the directory
-    for model_file_name in tqdm(os.listdir(args['model_dir']), desc='Model_files', file=sys.stdout):
-
-        model_file_path = os.path.join(args['model_dir'], model_file_name)
-        detection_graph = get_detection_graph(model_file_path)
-        band_list = model_file_name.split('_')[:3]
-
-        # Processing tif files
-        for tif_file_name in tqdm(os.listdir(args['input_dir']),
-                                  desc='tif_files',
-                                  leave=False,
-                                  file=sys.stdout):
-
-            if not tif_file_name.endswith(('.tif')):
-                continue
-
-            if not tif_file_name.endswith(('.tif', )):
-                continue
-
-            tif_file_path = os.path.join(args['input_dir'], tif_file_name)
-            img_np = convert_to_jpg(
-                                tif_file_path,
-                                band_list.copy())
-
-            height, width, _ = img_np.shape
-
-            output_dict = run_inference_for_single_image(img_np, detection_graph)
-
-            for index, detection_score in enumerate(output_dict['detection_scores']):
-                if detection_score >= args['threshold']:
-                    ymin, xmin, ymax, xmax = output_dict['detection_boxes'][index]
-
-                    tif_inference_data[tif_file_name].append([
-                        list(map(int, [xmin*width, ymin*height, xmax*width, ymax*height])),
-                        output_dict['detection_classes'][index],
-                        output_dict['detection_scores'][index],
-                        model_file_name])
+    model_file_names = os.listdir(args['model_dir'])
+    tif_file_names = [tif_file_name for tif_file_name in os.listdir(args['input_dir'])
+                      if tif_file_name.endswith(('.tif', ))]
+
+    num_workers = args.get('num_workers', 1)
+
+    if num_workers <= 1:
+        session_config = get_session_config(args.get('intra_op_threads', 0),
+                                            args.get('inter_op_threads', 0))
+
+        # looping over all model in the directory
+        for model_file_name in tqdm(model_file_names, desc='Model_files', file=sys.stdout):
+
+            model_file_path = os.path.join(args['model_dir'], model_file_name)
+            detection_graph = get_detection_graph(model_file_path)
+
+            for tif_file_name, detection in get_tif_detections(detection_graph,
+                                                               model_file_name,
+                                                               tqdm(tif_file_names,
+                                                                    desc='tif_files',
+                                                                    leave=False,
+                                                                    file=sys.stdout),
+                                                               args,
+                                                               session_config):
+                tif_inference_data[tif_file_name].append(detection)
+
+        return tif_inference_data
+
+    # split the tif files of every model into contiguous shards, tasks are ordered
+    # model first so that merged results keep the same order as the sequential run
+    num_shards = max(1, min(args.get('tile_shards', 1), len(tif_file_names)))
+    shard_size = max(1, math.ceil(len(tif_file_names) / num_shards))
+    tasks = [(os.path.join(args['model_dir'], model_file_name),
+              tif_file_names[start:start+shard_size],
+              args)
+             for model_file_name in model_file_names
+             for start in range(0, len(tif_file_names), shard_size)]
+
+    # spawn instead of fork, tensorflow is not fork safe
+    context = multiprocessing.get_context('spawn')
+    core_queue = context.Queue()
+    for cores in get_core_partitions(num_workers):
+        core_queue.put(cores)
+
+    with context.Pool(num_workers,
+                      initializer=init_inference_worker,
+                      initargs=(core_queue,
+                                args.get('intra_op_threads', 0),
+                                args.get('inter_op_threads', 0))) as pool:
+
+        # imap yields in task order, merged data is identical to the sequential run
+        for tif_detections in tqdm(pool.imap(run_inference_task, tasks),
+                                   total=len(tasks),
+                                   desc='Model_shards',
+                                   file=sys.stdout):
+            for tif_file_name, detection in tif_detections:
+                tif_inference_data[tif_file_name].append(detection)
 
     return tif_inference_data
 
@@ -180,201 +349,344 @@ def optimize_bounding_boxes(tif_inference_data):
 
     return optimized_tif_inference_data
 
-def draw_boundary_boxes(optimized_tif_inference_data, args):
+def draw_boundary_boxes(tif_file_name, image_array, tif_data, dst_path):
     '''
-        Method to draw optimized boundary boxes over images and save to output_directory
+        Method to draw optimized boundary boxes over a tif and save it as jpg
         params:
-            optimized_tif_inference_data
-            args : command line arguments dictionary
+            tif_file_name : name of the tif file
+            image_array : tif data of shape (bands, height, width)
+            tif_data : optimized inference data of this tif
+            dst_path : path to the visualizations directory
+    '''
+    if image_array.shape[0] == 8:
+        img_np = convert_array_to_jpg(image_array, [4, 3, 2])
+    elif image_array.shape[0] == 4:
+        img_np = convert_array_to_jpg(image_array, [2, 1, 0])
+    else:
+        raise Exception('Error: Tif file is not of 4 or 8 bands')
+
+    img = Image.fromarray(img_np)
+    draw = ImageDraw.Draw(img)
+
+    for box in tif_data:
+        xmin, ymin, xmax, ymax = box[0]
+        draw.rectangle(((xmin, ymin), (xmax, ymax)), fill=None, width=2, outline=(0, 255, 0))
+
+    img.save(os.path.join(dst_path, tif_file_name.split('.')[0] + '.jpg'))
+
+def get_vegetation_index_rasters(image_array):
+    '''
+        Method to compute ndvi, evi and savi rasters for the whole tif at once
+        params:
+            image_array : tif data of shape (bands, height, width), 4 or 8 bands
+
+        return dictionary {index_name : float32 raster of shape (height, width)}
     '''
+    if image_array.shape[0] == 8:
+        RED = image_array[4, :, :].astype(np.float32)
+        NIR = image_array[7, :, :].astype(np.float32)
 
-    dst_path = os.path.join(args['output_dir'], 'visualizations')
-    if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
+    elif image_array.shape[0] == 4:
+        RED = image_array[0, :, :].astype(np.float32)
+        NIR = image_array[3, :, :].astype(np.float32)
 
-    for tif_file_name in tqdm(optimized_tif_inference_data.keys(),
-                              desc='visualization',
-                              file=sys.stdout):
+    else:
+        raise Exception('Error: Tif file is not of 4 or 8 bands')
 
-        dataset = rasterio.open(os.path.join(args['input_dir'], tif_file_name))
-        img = dataset.read()
+    def safe_divide(numerator, denominator):
+        # 0 where the denominator is 0, same as np.where in the per crown version
+        return np.divide(numerator, denominator,
+                         out=np.zeros_like(numerator),
+                         where=denominator != 0.)
 
-        if img.shape[0] == 8:
-            img_np = convert_to_jpg(
-                os.path.join(args['input_dir'], tif_file_name),
-                [4, 3, 2])
-        elif img.shape[0] == 4:
-            img_np = convert_to_jpg(
-                os.path.join(args['input_dir'], tif_file_name),
-                [2, 1, 0])
-        else:
-            raise Exception('Error: Tif file is not of 4 or 8 bands')
+    # NDVI
+    ndvi = safe_divide(NIR-RED, NIR+RED)
 
-        img = Image.fromarray(img_np)
-        draw = ImageDraw.Draw(img)
+    # EVI
+    G = 2.5; L = 2.4; C = 1
+    evi = G*safe_divide(NIR-RED, L+NIR+C*RED)
 
-        for box in optimized_tif_inference_data[tif_file_name]:
-            xmin, ymin, xmax, ymax = box[0]
-            draw.rectangle(((xmin, ymin), (xmax, ymax)), fill=None, width=2, outline=(0, 255, 0))
+    # SAVI
+    L = 0.5
+    savi = safe_divide(NIR-RED, RED+NIR+L) * (1+L)
 
-        img.save(os.path.join(dst_path, tif_file_name.split('.')[0] + '.jpg'))
+    return {'ndvi': ndvi, 'evi': evi, 'savi': savi}
 
-def generate_shape_files(optimized_tif_inference_data, args):
+def get_integral_image(raster):
     '''
-        Method to create shpfiles and save to output_directory
+        Method to compute the summed area table of a raster
         params:
-            optimized_tif_inference_data
-            args : command line arguments dictionary
+            raster : 2d array of shape (height, width)
+
+        return float64 array of shape (height+1, width+1) where
+        integral[y, x] = raster[:y, :x].sum()
     '''
-    dst_path = os.path.join(args['output_dir'], 'inference_shape_files')
+    integral = np.zeros((raster.shape[0] + 1, raster.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(raster, axis=0, dtype=np.float64), axis=1, out=integral[1:, 1:])
+    return integral
 
-    M2FTCONVERSION = 1
+def get_box_means(integral, boxes):
+    '''
+        Method to compute the mean of a raster inside each box in O(1) per box
+        params:
+            integral : summed area table of the raster (see get_integral_image)
+            boxes : int array of shape (n, 4) of pixel boxes xmin, ymin, xmax, ymax
 
-    if not os.path.exists(dst_path):
-        os.makedirs(dst_path)
+        return float64 array of shape (n,), nan for empty boxes
+    '''
+    height, width = integral.shape[0] - 1, integral.shape[1] - 1
 
-    for tif_file_name in tqdm(optimized_tif_inference_data.keys(), desc='shape_files', file=sys.stdout):
-        tif_file_path = os.path.join(args['input_dir'], tif_file_name)
+    # clip like numpy slicing does
+    xmin = np.clip(boxes[:, 0], 0, width)
+    ymin = np.clip(boxes[:, 1], 0, height)
+    xmax = np.clip(boxes[:, 2], xmin, width)
+    ymax = np.clip(boxes[:, 3], ymin, height)
+
+    sums = (integral[ymax, xmax]
+            - integral[ymin, xmax]
+            - integral[ymax, xmin]
+            + integral[ymin, xmin])
+    pixel_counts = (ymax - ymin) * (xmax - xmin)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(pixel_counts > 0, sums / pixel_counts, np.nan)
+
+def get_crown_index_means(image_array, boxes):
+    '''
+        Method to compute mean vegetation indices of all crowns of a tif at once
+        params:
+            image_array : tif data of shape (bands, height, width)
+            boxes : int array of shape (n, 4) of pixel boxes xmin, ymin, xmax, ymax
+
+        return dictionary {index_name : float64 array of shape (n,)}
+    '''
+    return {index_name: get_box_means(get_integral_image(raster), boxes)
+            for index_name, raster in get_vegetation_index_rasters(image_array).items()}
+
+def get_crown_features(dataset, image_array, tif_data):
+    '''
+        Method to convert the optimized boxes of a tif into map coordinate features,
+        coordinates and attributes are computed for all boxes at once
+        params:
+            dataset : opened rasterio dataset of the tif
+            image_array : tif data of shape (bands, height, width)
+            tif_data : optimized inference data of this tif
 
-        dataset = rasterio.open(tif_file_path)
+        return list of fiona features following CROWN_SCHEMA
+    '''
+    M2FTCONVERSION = 1
 
+    # get raster size in meters
+    raster_size_y = dataset.bounds.top - dataset.bounds.bottom
+
+    # get raster resolution in meters
+    y_res = abs(dataset.read_transform()[1])
+    x_res = abs(dataset.read_transform()[5])
+
+    boxes = np.array([predicted_data[0] for predicted_data in tif_data],
+                     dtype=np.int64).reshape(-1, 4)
+    scores = np.array([predicted_data[2] for predicted_data in tif_data], dtype=np.float64)
+
+    index_means = get_crown_index_means(image_array, boxes)
+
+    # calculate spread of crown
+    north_south_spread = ((boxes[:, 3] - boxes[:, 1]) * y_res) * M2FTCONVERSION
+    east_west_spread = ((boxes[:, 2] - boxes[:, 0]) * x_res) * M2FTCONVERSION
+
+    # calculate volume
+    volume = (4/3
+              * math.pi
+              * north_south_spread
+              * east_west_spread
+              * (((north_south_spread+east_west_spread)/2)/2))
+
+    # recalculate coordinates
+    xmin = (boxes[:, 0] * x_res + (dataset.bounds.left))
+    xmax = (boxes[:, 2] * x_res + (dataset.bounds.left))
+
+    ymax = (raster_size_y - (boxes[:, 3] * y_res)) + dataset.bounds.bottom
+    ymin = (raster_size_y - (boxes[:, 1] * y_res)) + dataset.bounds.bottom
+
+    # same ring as mapping(box(xmin, ymax, xmax, ymin))
+    rings = np.stack([np.stack([xmax, ymax], axis=1),
+                      np.stack([xmax, ymin], axis=1),
+                      np.stack([xmin, ymin], axis=1),
+                      np.stack([xmin, ymax], axis=1),
+                      np.stack([xmax, ymax], axis=1)], axis=1).tolist()
+
+    properties = zip(scores.tolist(),
+                     north_south_spread.astype(np.float64).tolist(),
+                     east_west_spread.astype(np.float64).tolist(),
+                     volume.astype(np.float64).tolist(),
+                     index_means['ndvi'].tolist(),
+                     index_means['savi'].tolist(),
+                     index_means['evi'].tolist())
+
+    return [{'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+             'properties': {'score': score,
+                            'ns_spread': ns_spread,
+                            'ew_spread': ew_spread,
+                            'volume': crown_volume,
+                            'ndvi_avg': ndvi_avg,
+                            'savi_avg': savi_avg,
+                            'evi_avg' : evi_avg}}
+            for ring, (score, ns_spread, ew_spread, crown_volume, ndvi_avg, savi_avg, evi_avg)
+            in zip(rings, properties)]
+
+def generate_shape_file(tif_file_name, dataset, crown_features, dst_path):
+    '''
+        Method to create the shpfile of a tif and save to dst_path
+        params:
+            tif_file_name : name of the tif file
+            dataset : opened rasterio dataset of the tif
+            crown_features : features of the tif (see get_crown_features)
+            dst_path : path to the shape files directory
+    '''
+    # Write a new Shapefile
+    with fiona.open(os.path.join(dst_path, tif_file_name.split('.')[0]), 'w',
+                    crs=dataset.read_crs(),
+                    driver='ESRI Shapefile',
+                    schema=CROWN_SCHEMA) as c:
+        c.writerecords(crown_features)
+
+class CombinedLayerWriter:
+    '''
+        Writer streaming the crowns of all tifs into a single GeoPackage layer,
+        the layer is created on the first write with the crs of that tif
+    '''
+
+    def __init__(self, dst_dir):
+        '''
+            params:
+                dst_dir : path to the directory of the combined layer
+        '''
+        if not os.path.exists(dst_dir):
+            os.makedirs(dst_dir)
+
+        self.dst_dir = dst_dir
+        self.collection = None
+        self.crs = None
+
+    def write(self, tif_file_name, dataset, crown_features):
+        '''
+            Method to append the crowns of a tif to the combined layer
+            params:
+                tif_file_name : name of the tif file
+                dataset : opened rasterio dataset of the tif
+                crown_features : features of the tif (see get_crown_features)
+        '''
         crs = dataset.read_crs()
-        image_array = dataset.read()
-
-        # get raster size in meters
-        raster_size_x = dataset.bounds.right - dataset.bounds.left
-        raster_size_y = dataset.bounds.top - dataset.bounds.bottom
-
-        # get raster resolution in meters
-        y_res = abs(dataset.read_transform()[1])
-        x_res = abs(dataset.read_transform()[5])
-
-        schema = {
-            'geometry': 'Polygon',
-            'properties': {'score': 'float',
-                           'ns_spread' : 'float',
-                           'ew_spread' : 'float',
-                           'volume' : 'float',
-                           'ndvi_avg' : 'float',
-                           'savi_avg' : 'float',
-                           'evi_avg': 'float'},
-            }
-
-        # Write a new Shapefile
-        with fiona.open(os.path.join(dst_path, tif_file_name.split('.')[0]), 'w',
-                        crs=crs,
-                        driver='ESRI Shapefile',
-                        schema=schema) as c:
-
-            for predicted_data in optimized_tif_inference_data[tif_file_name]:
-
-                xmin, ymin, xmax, ymax = predicted_data[0]
-
-                crown_image = image_array[:, ymin:ymax, xmin:xmax]
-
-                if image_array.shape[0] == 8:
-                    RED = crown_image[4, :, :].astype(np.float32)
-                    GREEN = crown_image[2, :, :].astype(np.float32)
-                    BLUE = crown_image[1, :, :].astype(np.float32)
-                    NIR = crown_image[7, :, :].astype(np.float32)
-
-                elif image_array.shape[0] == 4:
-                    RED = crown_image[0, :, :].astype(np.float32)
-                    GREEN = crown_image[1, :, :].astype(np.float32)
-                    BLUE = crown_image[2, :, :].astype(np.float32)
-                    NIR = crown_image[3, :, :].astype(np.float32)
-
-                else:
-                    raise Exception('Error: Tif file is not of 4 or 8 bands')
-
-                ## vegetation indices
-                # NDVI
-                ndvi = np.where(
-                    (NIR+RED) == 0.,
-                    0,
-                    (NIR-RED)/(NIR+RED))
-                ndvi_avg = np.average(ndvi)
-
-                # EVI
-                G = 2.5; L = 2.4; C = 1
-                evi = np.where(
-                    (L+NIR+C*RED) == 0.,
-                    0,
-                    G*((NIR-RED)/(L+NIR+C*RED)))
-                evi_avg = np.average(evi)
-
-                # SAVI
-                L = 0.5
-                savi = np.where(
-                    (RED + NIR + L) == 0.,
-                    0,
-                    ((NIR - RED) / (RED + NIR + L)) * (1+L))
-                savi_avg = np.average(savi)
-
-                # calculate spread of crown
-                north_south_spread = ((ymax - ymin) * y_res) * M2FTCONVERSION
-                east_west_spread = ((xmax - xmin) * x_res) * M2FTCONVERSION
-
-                # calculate area
-                area = north_south_spread * east_west_spread
-
-                # calculate volume
-                volume = (4/3
-                          * math.pi
-                          * north_south_spread
-                          * east_west_spread
-                          * (((north_south_spread+east_west_spread)/2)/2))
-
-                ndvi[0, :] = 0
-                ndvi[-1, :] = 0
-                ndvi[:, 0] = 0
-                ndvi[:, -1] = 0
-
-                ndvi = gaussian_filter(ndvi, sigma=2)
-
-                # recalculate coordinates
-                xmin = (xmin * x_res + (dataset.bounds.left))
-                xmax = (xmax * x_res + (dataset.bounds.left))
-
-                ymax = (raster_size_y - (ymax * y_res)) + dataset.bounds.bottom
-                ymin = (raster_size_y - (ymin * y_res)) + dataset.bounds.bottom
-
-                poly = box(xmin, ymax, xmax, ymin)
-
-                c.write({
-                    'geometry': mapping(poly),
-                    'properties': {'score': float(predicted_data[2]),
-                                   'ns_spread': float(north_south_spread),
-                                   'ew_spread': float(east_west_spread),
-                                   'volume': float(volume),
-                                   'ndvi_avg': float(ndvi_avg),
-                                   'savi_avg': float(savi_avg),
-                                   'evi_avg' : float(evi_avg)}
-                })
-
-def generate_csv(optimized_tif_inference_data, args):
-    '''
-        Method to log bounding box data in a CSV file
+
+        if self.collection is None:
+            # combined file name is the tif name without its chunk number
+            file_name = ('_'.join(tif_file_name.split('.')[0].split('_')[:-1])
+                         or tif_file_name.split('.')[0])
+
+            self.crs = crs
+            self.collection = fiona.open(
+                os.path.join(self.dst_dir,
+                             file_name + COMBINED_LAYER_EXTENSION),
+                'w',
+                crs=crs,
+                driver=COMBINED_LAYER_DRIVER,
+                layer=COMBINED_LAYER_NAME,
+                schema=CROWN_SCHEMA)
+
+        elif crs != self.crs:
+            raise Exception(f'Error: {tif_file_name} crs {crs} differs from combined layer crs {self.crs}')
+
+        self.collection.writerecords(crown_features)
+
+    def close(self):
+        if self.collection is not None:
+            self.collection.close()
+
+def write_csv_rows(writer_obj, tif_file_name, tif_data):
+    '''
+        Method to log bounding box data of a tif in the CSV file
+        params:
+            writer_obj : csv writer of annotations.csv
+            tif_file_name : name of the tif file
+            tif_data : optimized inference data of this tif
+    '''
+    for data in tif_data:
+        writer_obj.writerow([
+            tif_file_name,
+            data[0][0],
+            data[0][1],
+            data[0][2],
+            data[0][3],
+            data[1],
+            round(data[2], 2)])
+
+def generate_outputs(optimized_tif_inference_data, args):
+    '''
+        Method to generate all enabled outputs in a single pass over the tifs,
+        each tif is opened and read once and shared by the writers
         params:
             optimized_tif_inference_data
-            args : command line arguments dictionary
+            args : command line arguments dictionary, args['outputs'] lists
+                   the enabled writers out of OUTPUT_WRITERS
     '''
-    csv_file_path = os.path.join(args['output_dir'], 'annotations.csv')
+    outputs = args.get('outputs', DEFAULT_OUTPUTS)
+
+    unknown_outputs = set(outputs) - set(OUTPUT_WRITERS)
+    if unknown_outputs:
+        raise ValueError(f'Unknown outputs : {", ".join(sorted(unknown_outputs))}')
+
+    visualization_dir = os.path.join(args['output_dir'], 'visualizations')
+    shape_file_dir = os.path.join(args['output_dir'], 'inference_shape_files')
+    combined_layer_dir = os.path.join(args['output_dir'], 'combined_box_shape_file')
+
+    for output, dst_path in [('visualizations', visualization_dir),
+                             ('shape_files', shape_file_dir)]:
+        if output in outputs and not os.path.exists(dst_path):
+            os.makedirs(dst_path)
 
-    with open(csv_file_path, 'w') as csv_file:
+    csv_file = None
+    if 'csv' in outputs:
+        csv_file = open(os.path.join(args['output_dir'], 'annotations.csv'), 'w')
         writer_obj = csv.writer(csv_file)
         writer_obj.writerow(['filename', 'xmin', 'ymin', 'xmax', 'ymax', 'label', 'score'])
 
-        for tif_file_name in tqdm(optimized_tif_inference_data.keys(), desc='csv_file', file=sys.stdout):
-            for data in optimized_tif_inference_data[tif_file_name]:
-                writer_obj.writerow([
-                    tif_file_name,
-                    data[0][0],
-                    data[0][1],
-                    data[0][2],
-                    data[0][3],
-                    data[1],
-                    round(data[2], 2)])
+    combined_layer_writer = None
+    if 'combined_layer' in outputs:
+        combined_layer_writer = CombinedLayerWriter(combined_layer_dir)
+
+    try:
+        for tif_file_name in tqdm(optimized_tif_inference_data.keys(),
+                                  desc='outputs',
+                                  file=sys.stdout):
+
+            tif_data = optimized_tif_inference_data[tif_file_name]
+
+            if set(outputs) & {'visualizations', 'shape_files', 'combined_layer'}:
+                with rasterio.open(os.path.join(args['input_dir'], tif_file_name)) as dataset:
+                    image_array = dataset.read()
+
+                    if 'visualizations' in outputs:
+                        draw_boundary_boxes(tif_file_name, image_array, tif_data,
+                                            visualization_dir)
+
+                    if 'shape_files' in outputs or 'combined_layer' in outputs:
+                        crown_features = get_crown_features(dataset, image_array, tif_data)
+
+                    if 'shape_files' in outputs:
+                        generate_shape_file(tif_file_name, dataset, crown_features,
+                                            shape_file_dir)
+
+                    if combined_layer_writer:
+                        combined_layer_writer.write(tif_file_name, dataset, crown_features)
+
+            if csv_file:
+                write_csv_rows(writer_obj, tif_file_name, tif_data)
+
+    finally:
+        if csv_file:
+            csv_file.close()
+
+        if combined_layer_writer:
+            combined_layer_writer.close()
 
 
 if __name__ == "__main__":
@@ -390,19 +702,29 @@ if __name__ == "__main__":
                         type=str)
     parser.add_argument("--threshold", help="Threshold value for inference",
                         type=float, default=0.5)
+    parser.add_argument("--num_workers",
+                        help="Number of inference worker processes, each pinned to its own cpu cores",
+                        type=int, default=1)
+    parser.add_argument("--tile_shards",
+                        help="Number of shards the tif files of each model are split into",
+                        type=int, default=1)
+    parser.add_argument("--intra_op_threads",
+                        help="Tensorflow intra op threads per session, 0 derives it from the cores",
+                        type=int, default=0)
+    parser.add_argument("--inter_op_threads",
+                        help="Tensorflow inter op threads per session, 0 derives it from the cores",
+                        type=int, default=0)
+    parser.add_argument("--outputs",
+                        help=f"Comma separated outputs to generate out of {', '.join(OUTPUT_WRITERS)}",
+                        type=str, default=','.join(DEFAULT_OUTPUTS))
 
     args = vars(parser.parse_args())
+    args['outputs'] = args['outputs'].split(',')
 
     tif_inference_data = get_inference_data(args)
 
     print('optimizing inference results...')
     optimized_tif_inference_data = optimize_bounding_boxes(tif_inference_data)
 
-    print('generating visualizations...')
-    draw_boundary_boxes(optimized_tif_inference_data, args)
-
-    print('generating shape files...')
-    generate_shape_files(optimized_tif_inference_data, args)
-
-    print('generating csv file...')
-    generate_csv(optimized_tif_inference_data, args)
+    print('generating outputs...')
+    generate_outputs(optimized_tif_inference_data, args)
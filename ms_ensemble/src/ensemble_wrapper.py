@@ -180,13 +180,22 @@ if __name__ == "__main__":
 
         print('running ensembling process...')
         logging.info('staring ensembling process')
+
+        # per tif shape files by default, adding "combined_layer" to the outputs in the config
+        # streams the crowns into one GeoPackage in combined_box_shape_file instead of
+        # combining the per tif shape files afterwards
+        ensemble_outputs = meta_data_json.get('outputs', ['visualizations', 'shape_files', 'csv'])
+
         run_subprocess(['python',
                         ENSEMBLE_SCRIPT_PATH,
                         f'--model_dir={MODEL_DIR_PATH}',
                         f'--input_dir={TIF_DIR_PATH}',
                         f'--output_dir={ENSEMBLE_OUTPUT_DIR_PATH}',
                         f'--label_file={LABEL_FILE_PATH}',
-                        f'--threshold={meta_data_json["threshold"]}'])
+                        f'--threshold={meta_data_json["threshold"]}',
+                        f'--num_workers={meta_data_json.get("num_workers", 1)}',
+                        f'--tile_shards={meta_data_json.get("tile_shards", 1)}',
+                        f'--outputs={",".join(ensemble_outputs)}'])
 
         # --------------------------- generating point data ........................................
 
@@ -202,10 +211,12 @@ if __name__ == "__main__":
 
         print('combining shape files...')
         logging.info('combining shape files')
-        run_subprocess(['python',
-                        COMBINE_SHAPE_FILE_SCRIPT_PATH,
-                        f'--input_dir={os.path.join(ENSEMBLE_OUTPUT_DIR_PATH, "inference_shape_files")}',
-                        f'--output_dir={COMBINED_BOX_SHAPE_FILE_DIR}'])
+
+        if 'shape_files' in ensemble_outputs and 'combined_layer' not in ensemble_outputs:
+            run_subprocess(['python',
+                            COMBINE_SHAPE_FILE_SCRIPT_PATH,
+                            f'--input_dir={os.path.join(ENSEMBLE_OUTPUT_DIR_PATH, "inference_shape_files")}',
+                            f'--output_dir={COMBINED_BOX_SHAPE_FILE_DIR}'])
 
         run_subprocess(['python',
                         COMBINE_SHAPE_FILE_SCRIPT_PATH,
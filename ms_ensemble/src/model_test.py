@@ -38,9 +38,9 @@ def load_image_into_numpy_array(image):
     return np.array(image.getdata()).reshape(
         (im_height, im_width, 3)).astype(np.uint8)
 
-def run_inference_for_single_image(image, graph):
+def run_inference_for_single_image(image, graph, session_config=None):
     with graph.as_default():
-        with tf.Session() as sess:
+        with tf.Session(config=session_config) as sess:
             # Get handles to input and output tensors
             ops = tf.get_default_graph().get_operations()
             all_tensor_names = {output.name for op in ops for output in op.outputs}
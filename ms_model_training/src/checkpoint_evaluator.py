@@ -0,0 +1,251 @@
+'''
+    script to evaluate the checkpoints of a running training in a separate low priority process
+    -> the training directory is watched for new checkpoints, the newest one is hard linked
+       into a directory of its own (the trainer may delete it meanwhile) and evaluated once
+    -> the metrics of every evaluated checkpoint are appended to a json lines metrics curve
+    -> the best checkpoints by a metric are kept as hard links in the best checkpoint directory
+    -> the script stops once the stop file exists and the last checkpoint has been evaluated
+    -> command to run:
+        python checkpoint_evaluator.py\
+            --training_dir=<PATH TO THE TRAINING DIRECTORY>\
+            --pipeline_config_path=<PATH TO THE PIPELINE CONFIG>\
+            --output_dir=<PATH TO THE DIRECTORY OF THE EVAL OUTPUTS>\
+            --stop_file=<PATH TO THE FILE SIGNALLING THE END OF TRAINING>\
+            --iteration_no=<OPTIONAL DATASET ITERATION THE CHECKPOINTS BELONG TO>\
+            --metric=<OPTIONAL METRIC TO RANK THE CHECKPOINTS BY>\
+            --keep_best=<OPTIONAL NUMBER OF BEST CHECKPOINTS KEPT>\
+            --niceness=<OPTIONAL NICENESS INCREMENT OF THE PROCESS>\
+            --profile_path=<OPTIONAL JSON LINES FILE OF THE LATENCY PER IMAGE, NOT PROFILED IF EMPTY>
+    -> Output (in output_dir):
+        - metrics_curve.jsonl, best_checkpoints/ and eval/ summaries
+'''
+
+import os
+import glob
+import json
+import shutil
+import time
+
+import argparse
+import tensorflow as tf
+
+import modified_eval
+
+# constants
+METRICS_CURVE_FILE_NAME = 'metrics_curve.jsonl'
+BEST_CHECKPOINT_DIR_NAME = 'best_checkpoints'
+EVAL_CHECKPOINT_DIR_NAME = 'eval_checkpoint'
+EVAL_DIR_NAME = 'eval'
+DEFAULT_METRIC = 'PascalBoxes_Precision/mAP@0.5IOU'
+POLL_INTERVAL_SEC = 30
+
+def arguments():
+    '''
+        command line arguments
+        retun command line argument dictionary
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--training_dir", help="Path to the training directory", type=str)
+    parser.add_argument("--pipeline_config_path", help="Path to the pipeline config", type=str)
+    parser.add_argument("--output_dir", help="Path to the directory of the eval outputs",
+                        type=str)
+    parser.add_argument("--stop_file", help="Path to the file signalling the end of training",
+                        type=str)
+    parser.add_argument("--iteration_no", help="Dataset iteration the checkpoints belong to",
+                        type=int, default=0)
+    parser.add_argument("--metric", help="Metric to rank the checkpoints by, higher is better",
+                        type=str, default=DEFAULT_METRIC)
+    parser.add_argument("--keep_best", help="Number of best checkpoints kept",
+                        type=int, default=3)
+    parser.add_argument("--niceness", help="Niceness increment of the process",
+                        type=int, default=19)
+    parser.add_argument("--profile_path", help="Json lines file of the latency per image, "
+                                               "not profiled if empty",
+                        type=str, default='')
+
+    return vars(parser.parse_args())
+
+def get_checkpoint_step(checkpoint_prefix):
+    '''
+        return global step of a checkpoint prefix like .../model.ckpt-1234
+    '''
+    return int(checkpoint_prefix.split('-')[-1])
+
+def link_checkpoint(checkpoint_prefix, dst_dir):
+    '''
+        Method to hard link the files of a checkpoint into a directory, they are
+        copied if the directory is on another file system
+        params:
+            checkpoint_prefix : checkpoint prefix like .../model.ckpt-1234
+            dst_dir : destination directory
+        return checkpoint prefix in dst_dir
+    '''
+    for file_path in glob.glob(checkpoint_prefix + '.*'):
+        dst_path = os.path.join(dst_dir, os.path.basename(file_path))
+
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+
+        try:
+            os.link(file_path, dst_path)
+        except OSError:
+            shutil.copy(file_path, dst_path)
+
+    return os.path.join(dst_dir, os.path.basename(checkpoint_prefix))
+
+def read_metrics_curve(metrics_curve_path):
+    '''
+        return list of the records of the metrics curve, empty if it does not exist
+    '''
+    if not os.path.exists(metrics_curve_path):
+        return []
+
+    with open(metrics_curve_path) as metrics_curve_file:
+        return [json.loads(line) for line in metrics_curve_file if line.strip()]
+
+def get_iteration_records(metrics_curve, iteration_no):
+    '''
+        return records of the metrics curve of one dataset iteration, every iteration
+        is evaluated on its own test set so only these are comparable
+    '''
+    return [record for record in metrics_curve if record['iteration_no'] == iteration_no]
+
+def get_best_records(metrics_curve, metric, keep_best):
+    '''
+        Method to rank the evaluated checkpoints, newer checkpoints win ties
+        params:
+            metrics_curve : records of the metrics curve
+            metric : metric to rank by, higher is better
+            keep_best : number of records kept
+        return list of the best records, best first
+    '''
+    ranked_records = [record for record in metrics_curve if record['metrics'].get(metric) is not None]
+    ranked_records.sort(key=lambda record: (record['metrics'][metric], record['step']), reverse=True)
+
+    return ranked_records[:keep_best]
+
+def update_best_checkpoints(best_checkpoint_dir, checkpoint_prefix, metrics_curve, metric, keep_best):
+    '''
+        Method to keep hard links of only the best checkpoints in best_checkpoint_dir
+        params:
+            best_checkpoint_dir : directory of the best checkpoints
+            checkpoint_prefix : prefix of the checkpoint evaluated last
+            metrics_curve : records of the iteration including the last checkpoint
+            metric : metric to rank by, higher is better
+            keep_best : number of checkpoints kept
+    '''
+    best_checkpoint_names = [os.path.basename(record['checkpoint'])
+                             for record in get_best_records(metrics_curve, metric, keep_best)]
+
+    if os.path.basename(checkpoint_prefix) in best_checkpoint_names:
+        link_checkpoint(checkpoint_prefix, best_checkpoint_dir)
+
+    for file_name in os.listdir(best_checkpoint_dir):
+        if os.path.splitext(file_name)[0] not in best_checkpoint_names:
+            os.remove(os.path.join(best_checkpoint_dir, file_name))
+
+    # the checkpoint state points at the best checkpoint
+    if best_checkpoint_names:
+        tf.train.update_checkpoint_state(
+            best_checkpoint_dir,
+            os.path.join(best_checkpoint_dir, best_checkpoint_names[0]),
+            all_model_checkpoint_paths=[os.path.join(best_checkpoint_dir, checkpoint_name)
+                                        for checkpoint_name in best_checkpoint_names])
+
+def evaluate_checkpoint(checkpoint_prefix, args):
+    '''
+        Method to evaluate one checkpoint and record its metrics
+        params:
+            checkpoint_prefix : checkpoint prefix in the training directory
+            args : command line arguments
+        return metrics curve record of the checkpoint
+    '''
+    eval_checkpoint_dir = os.path.join(args['output_dir'], EVAL_CHECKPOINT_DIR_NAME)
+
+    if os.path.exists(eval_checkpoint_dir):
+        shutil.rmtree(eval_checkpoint_dir)
+    os.makedirs(eval_checkpoint_dir)
+
+    # the linked files stay readable even if the trainer removes the checkpoint
+    eval_checkpoint_prefix = link_checkpoint(checkpoint_prefix, eval_checkpoint_dir)
+    if not os.path.exists(eval_checkpoint_prefix + '.index'):
+        raise FileNotFoundError(f'{checkpoint_prefix} was removed before it was linked')
+
+    tf.train.update_checkpoint_state(eval_checkpoint_dir, eval_checkpoint_prefix)
+
+    start_time = time.time()
+
+    with tf.Graph().as_default():
+        metrics_dict = modified_eval.evaluate(
+            eval_checkpoint_dir,
+            os.path.join(args['output_dir'], EVAL_DIR_NAME),
+            os.path.join(eval_checkpoint_dir, 'evaluation_results.json'),
+            pipeline_config_path=args['pipeline_config_path'],
+            run_once=True,
+            profile_path=args['profile_path'])
+
+    record = {'iteration_no': args['iteration_no'],
+              'step': get_checkpoint_step(checkpoint_prefix),
+              'checkpoint': os.path.basename(checkpoint_prefix),
+              'eval_time_sec': time.time() - start_time,
+              'metrics': {key: float(value) for key, value in metrics_dict.items()}}
+
+    metrics_curve_path = os.path.join(args['output_dir'], METRICS_CURVE_FILE_NAME)
+    with open(metrics_curve_path, 'a') as metrics_curve_file:
+        metrics_curve_file.write(json.dumps(record) + '\n')
+
+    update_best_checkpoints(os.path.join(args['output_dir'], BEST_CHECKPOINT_DIR_NAME),
+                            eval_checkpoint_prefix,
+                            get_iteration_records(read_metrics_curve(metrics_curve_path),
+                                                  args['iteration_no']),
+                            args['metric'],
+                            args['keep_best'])
+
+    shutil.rmtree(eval_checkpoint_dir)
+
+    return record
+
+def watch(args):
+    '''
+        Method to evaluate the newest checkpoint of the training directory whenever
+        a new one is written, until the stop file exists
+        params:
+            args : command line arguments
+    '''
+    os.makedirs(os.path.join(args['output_dir'], BEST_CHECKPOINT_DIR_NAME), exist_ok=True)
+
+    metrics_curve = read_metrics_curve(os.path.join(args['output_dir'], METRICS_CURVE_FILE_NAME))
+    evaluated_steps = {record['step']
+                       for record in get_iteration_records(metrics_curve, args['iteration_no'])}
+
+    while True:
+        # read before looking for checkpoints so the last checkpoint is not missed
+        is_training_done = os.path.exists(args['stop_file'])
+
+        checkpoint_prefix = tf.train.latest_checkpoint(args['training_dir'])
+
+        if checkpoint_prefix and get_checkpoint_step(checkpoint_prefix) not in evaluated_steps:
+            evaluated_steps.add(get_checkpoint_step(checkpoint_prefix))
+
+            try:
+                record = evaluate_checkpoint(checkpoint_prefix, args)
+            except FileNotFoundError:
+                # removed by the trainer before it was linked, a newer one exists
+                continue
+
+            print(f"evaluated {record['checkpoint']}: {args['metric']}="
+                  f"{record['metrics'].get(args['metric'])}")
+            continue
+
+        if is_training_done:
+            break
+
+        time.sleep(POLL_INTERVAL_SEC)
+
+if __name__ == "__main__":
+    args = arguments()
+
+    # evaluation yields to the training process
+    os.nice(args['niceness'])
+
+    watch(args)
@@ -97,54 +97,84 @@ from object_detection import exporter
 from object_detection.protos import pipeline_pb2
 
 slim = tf.contrib.slim
-flags = tf.app.flags
-
-flags.DEFINE_string('input_type', 'image_tensor', 'Type of input node. Can be '
-                    'one of [`image_tensor`, `encoded_image_string_tensor`, '
-                    '`tf_example`]')
-flags.DEFINE_string('input_shape', None,
-                    'If input_type is `image_tensor`, this can explicitly set '
-                    'the shape of this input tensor to a fixed size. The '
-                    'dimensions are to be provided as a comma-separated list '
-                    'of integers. A value of -1 can be used for unknown '
-                    'dimensions. If not specified, for an `image_tensor, the '
-                    'default shape will be partially specified as '
-                    '`[None, None, None, 3]`.')
-flags.DEFINE_string('pipeline_config_path', None,
-                    'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
-                    'file.')
-flags.DEFINE_string('trained_checkpoint_prefix', None,
-                    'Path to trained checkpoint, typically of the form '
-                    'path/to/model.ckpt')
-flags.DEFINE_string('output_directory', None, 'Path to write outputs.')
-flags.DEFINE_string('config_override', '',
-                    'pipeline_pb2.TrainEvalPipelineConfig '
-                    'text proto to override pipeline_config_path.')
-flags.DEFINE_boolean('write_inference_graph', False,
-                     'If true, writes inference graph to disk.')
-tf.app.flags.mark_flag_as_required('pipeline_config_path')
-tf.app.flags.mark_flag_as_required('trained_checkpoint_prefix')
-tf.app.flags.mark_flag_as_required('output_directory')
-FLAGS = flags.FLAGS
-
-
-def main(_):
+FLAGS = tf.app.flags.FLAGS
+
+
+def define_flags():
+  """Defines the command line flags, only when run as a script so that the
+  module can be imported next to the other stages without duplicate flags."""
+  flags = tf.app.flags
+
+  flags.DEFINE_string('input_type', 'image_tensor', 'Type of input node. Can be '
+                      'one of [`image_tensor`, `encoded_image_string_tensor`, '
+                      '`tf_example`]')
+  flags.DEFINE_string('input_shape', None,
+                      'If input_type is `image_tensor`, this can explicitly set '
+                      'the shape of this input tensor to a fixed size. The '
+                      'dimensions are to be provided as a comma-separated list '
+                      'of integers. A value of -1 can be used for unknown '
+                      'dimensions. If not specified, for an `image_tensor, the '
+                      'default shape will be partially specified as '
+                      '`[None, None, None, 3]`.')
+  flags.DEFINE_string('pipeline_config_path', None,
+                      'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
+                      'file.')
+  flags.DEFINE_string('trained_checkpoint_prefix', None,
+                      'Path to trained checkpoint, typically of the form '
+                      'path/to/model.ckpt')
+  flags.DEFINE_string('output_directory', None, 'Path to write outputs.')
+  flags.DEFINE_string('config_override', '',
+                      'pipeline_pb2.TrainEvalPipelineConfig '
+                      'text proto to override pipeline_config_path.')
+  flags.DEFINE_boolean('write_inference_graph', False,
+                       'If true, writes inference graph to disk.')
+  tf.app.flags.mark_flag_as_required('pipeline_config_path')
+  tf.app.flags.mark_flag_as_required('trained_checkpoint_prefix')
+  tf.app.flags.mark_flag_as_required('output_directory')
+
+
+def export(pipeline_config_path, trained_checkpoint_prefix, output_directory,
+           input_type='image_tensor', input_shape=None, config_override='',
+           write_inference_graph=False):
+  """Exports an inference graph, importable version of main.
+
+  Args:
+    pipeline_config_path: path to a pipeline_pb2.TrainEvalPipelineConfig file.
+    trained_checkpoint_prefix: path to trained checkpoint.
+    output_directory: path to write outputs.
+    input_type: type of input node.
+    input_shape: comma-separated input shape, see the `input_shape` flag.
+    config_override: pipeline_pb2.TrainEvalPipelineConfig text proto to override
+      pipeline_config_path.
+    write_inference_graph: if true, writes inference graph to disk.
+  """
   pipeline_config = pipeline_pb2.TrainEvalPipelineConfig()
-  with tf.gfile.GFile(FLAGS.pipeline_config_path, 'r') as f:
+  with tf.gfile.GFile(pipeline_config_path, 'r') as f:
     text_format.Merge(f.read(), pipeline_config)
-  text_format.Merge(FLAGS.config_override, pipeline_config)
-  if FLAGS.input_shape:
+  text_format.Merge(config_override, pipeline_config)
+  if input_shape:
     input_shape = [
         int(dim) if dim != '-1' else None
-        for dim in FLAGS.input_shape.split(',')
+        for dim in input_shape.split(',')
     ]
   else:
     input_shape = None
   exporter.export_inference_graph(
-      FLAGS.input_type, pipeline_config, FLAGS.trained_checkpoint_prefix,
-      FLAGS.output_directory, input_shape=input_shape,
-      write_inference_graph=FLAGS.write_inference_graph)
+      input_type, pipeline_config, trained_checkpoint_prefix,
+      output_directory, input_shape=input_shape,
+      write_inference_graph=write_inference_graph)
+
+
+def main(_):
+  export(FLAGS.pipeline_config_path,
+         FLAGS.trained_checkpoint_prefix,
+         FLAGS.output_directory,
+         input_type=FLAGS.input_type,
+         input_shape=FLAGS.input_shape,
+         config_override=FLAGS.config_override,
+         write_inference_graph=FLAGS.write_inference_graph)
 
 
 if __name__ == '__main__':
+  define_flags()
   tf.app.run()
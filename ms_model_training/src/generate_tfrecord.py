@@ -2,9 +2,16 @@
     script to generate tfrecord from image and annotations data
     -> command to run:
         python generate_tfrecord.py\
-             --csv_file=<PATH TO THE CSV FILE FOR WHICH TFRECORD NEEDS TO BE GENERATED>\
+             --csv_file=<PATH TO THE CSV OR PARQUET FILE FOR WHICH TFRECORD NEEDS TO BE GENERATED>\
              --image_dir=<PATH TO THE IMAGE DIRECTORY>
              --output_path=<PATH TO THE OUTPUT TFRECORD FILE>
+             --num_shards=<OPTIONAL NUMBER OF OUTPUT SHARDS default is 1>
+             --num_workers=<OPTIONAL NUMBER OF PROCESSES WRITING SHARDS default is cpu count>
+             --tif_dir=<OPTIONAL PATH TO THE TIF DIRECTORY, IMAGES ARE ENCODED FROM THE TIFS>
+             --band=<BANDS OF THE TIFS e.g. 1,2,ndvi, NEEDED WITH tif_dir>
+    with more than one shard the records go to <output_path>-00000-of-000NN, ...
+    with tif_dir the jpg files are not needed, every tif is converted like
+    convert_tiff_into_jpeg.py does and encoded in memory
 '''
 
 from __future__ import division
@@ -13,6 +20,8 @@ from __future__ import absolute_import
 
 import os
 import io
+import multiprocessing
+import sys
 import pandas as pd
 import tensorflow as tf
 
@@ -20,12 +29,26 @@ from PIL import Image
 from object_detection.utils import dataset_util
 from collections import namedtuple
 
-flags = tf.app.flags
-flags.DEFINE_string('csv_file', '', 'Path to the CSV input')
-flags.DEFINE_string('image_dir', '', 'Path to the image directory')
-flags.DEFINE_string('output_path', '', 'Path to output TFRecord')
-FLAGS = flags.FLAGS
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../..") # for sibling import
 
+from utils.convert_tiff_into_jpeg import convert_to_jpg
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def define_flags():
+    # only defined when run as a script, the module is also imported by training_wrapper.py
+    flags = tf.app.flags
+    flags.DEFINE_string('csv_file', '', 'Path to the CSV (or .parquet) input')
+    flags.DEFINE_string('image_dir', '', 'Path to the image directory')
+    flags.DEFINE_string('output_path', '', 'Path to output TFRecord')
+    flags.DEFINE_integer('num_shards', 1, 'Number of output TFRecord shards')
+    flags.DEFINE_integer('num_workers', os.cpu_count(), 'Number of processes writing shards')
+    flags.DEFINE_string('tif_dir', '', 'Path to the tif directory, encode images from the tifs')
+    flags.DEFINE_string('band', '', 'Comma separated bands of the tifs e.g. 1,2,ndvi')
+
+# module level so that groups can be pickled to the shard writers
+data = namedtuple('data', ['filename', 'object'])
 
 # TO-DO replace this with label map
 def class_text_to_int(row_label):
@@ -35,34 +58,39 @@ def class_text_to_int(row_label):
         return None
 
 def split(df, group):
-    data = namedtuple('data', ['filename', 'object'])
     gb = df.groupby(group)
     return [data(filename, gb.get_group(x)) for filename, x in zip(gb.groups.keys(), gb.groups)]
 
-def create_tf_example(group, path):
+def encode_tif(tif_file_path, band_list):
+    img = convert_to_jpg(tif_file_path, list(band_list))
+    height, width = img.shape[:2]
+
+    encoded_jpg_io = io.BytesIO()
+    Image.fromarray(img).save(encoded_jpg_io, format='JPEG')
+    return encoded_jpg_io.getvalue(), b'jpg', width, height
+
+def create_tf_example(group, path, tif_dir='', band_list=None):
     print(group.filename)
-    with tf.gfile.GFile(os.path.join(path, '{}'.format(group.filename)), 'rb') as fid:
-        encoded_jpg = fid.read()
-    encoded_jpg_io = io.BytesIO(encoded_jpg)
-    image = Image.open(encoded_jpg_io)
-    width, height = image.size
+    if tif_dir:
+        encoded_jpg, image_format, width, height = encode_tif(
+            os.path.join(tif_dir, group.filename.split('.')[0] + '.tif'),
+            band_list)
+    else:
+        with tf.gfile.GFile(os.path.join(path, '{}'.format(group.filename)), 'rb') as fid:
+            encoded_jpg = fid.read()
+        image_format = b'jpg'
+        # Image.open only parses the header, the jpg is not decoded
+        width, height = Image.open(io.BytesIO(encoded_jpg)).size
 
     filename = group.filename.encode('utf8')
-    image_format = b'jpg'
-    xmins = []
-    xmaxs = []
-    ymins = []
-    ymaxs = []
-    classes_text = []
-    classes = []
-
-    for index, row in group.object.iterrows():
-        xmins.append(row['xmin'] / width)
-        xmaxs.append(row['xmax'] / width)
-        ymins.append(row['ymin'] / height)
-        ymaxs.append(row['ymax'] / height)
-        classes_text.append(row['class'].encode('utf8'))
-        classes.append(class_text_to_int(row['class']))
+
+    # normalized boxes of the whole group at once
+    xmins = (group.object['xmin'].values / width).tolist()
+    xmaxs = (group.object['xmax'].values / width).tolist()
+    ymins = (group.object['ymin'].values / height).tolist()
+    ymaxs = (group.object['ymax'].values / height).tolist()
+    classes_text = [row_label.encode('utf8') for row_label in group.object['class']]
+    classes = [class_text_to_int(row_label) for row_label in group.object['class']]
 
     tf_example = tf.train.Example(features=tf.train.Features(feature={
         'image/height': dataset_util.int64_feature(height),
@@ -81,19 +109,62 @@ def create_tf_example(group, path):
     return tf_example
 
 
-def main(_):
-    writer = tf.python_io.TFRecordWriter(FLAGS.output_path)
-    path = os.path.join(os.getcwd(), FLAGS.image_dir)
-    examples = pd.read_csv(FLAGS.csv_file)
-    grouped = split(examples, 'filename')
-    for group in grouped:
-        tf_example = create_tf_example(group, path)
-        writer.write(tf_example.SerializeToString())
+def get_shard_path(output_path, shard_no, num_shards):
+    if num_shards == 1:
+        return output_path
+    return '{}-{:05d}-of-{:05d}'.format(output_path, shard_no, num_shards)
+
 
+def write_shard(task):
+    shard_path, groups, path, tif_dir, band_list = task
+    writer = tf.python_io.TFRecordWriter(shard_path)
+    for group in groups:
+        tf_example = create_tf_example(group, path, tif_dir, band_list)
+        writer.write(tf_example.SerializeToString())
     writer.close()
-    output_path = os.path.join(os.getcwd(), FLAGS.output_path)
-    print('Successfully created the TFRecords: {}'.format(output_path))
+    return shard_path
+
+
+def generate_tfrecord(csv_file, output_path, image_dir='', num_shards=1,
+                      num_workers=os.cpu_count(), tif_dir='', band_list=None):
+    path = os.path.join(os.getcwd(), image_dir)
+    if csv_file.endswith('.parquet'):
+        examples = pd.read_parquet(csv_file)
+    else:
+        examples = pd.read_csv(csv_file)
+    grouped = split(examples, 'filename')
+
+    # images are dealt round robin so that shards get the same number of images
+    tasks = [(get_shard_path(output_path, shard_no, num_shards),
+              grouped[shard_no::num_shards],
+              path,
+              tif_dir,
+              band_list)
+             for shard_no in range(num_shards)]
+
+    if num_shards > 1 and num_workers > 1:
+        # spawn, tensorflow is not fork safe
+        with multiprocessing.get_context('spawn').Pool(min(num_workers, num_shards)) as pool:
+            shard_paths = pool.map(write_shard, tasks)
+    else:
+        shard_paths = [write_shard(task) for task in tasks]
+
+    for shard_path in shard_paths:
+        print('Successfully created the TFRecords: {}'.format(os.path.join(os.getcwd(), shard_path)))
+
+    return shard_paths
+
+
+def main(_):
+    generate_tfrecord(FLAGS.csv_file,
+                      FLAGS.output_path,
+                      image_dir=FLAGS.image_dir,
+                      num_shards=FLAGS.num_shards,
+                      num_workers=FLAGS.num_workers,
+                      tif_dir=FLAGS.tif_dir,
+                      band_list=FLAGS.band.split(','))
 
 
 if __name__ == '__main__':
+    define_flags()
     tf.app.run()
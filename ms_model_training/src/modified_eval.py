@@ -54,60 +54,93 @@ from object_detection.legacy import evaluator
 from object_detection.utils import config_util
 from object_detection.utils import label_map_util
 
-tf.logging.set_verbosity(tf.logging.INFO)
-
-flags = tf.app.flags
-flags.DEFINE_boolean('eval_training_data', False,
-                     'If training data should be evaluated for this job.')
-flags.DEFINE_string(
-    'checkpoint_dir', '',
-    'Directory containing checkpoints to evaluate, typically '
-    'set to `train_dir` used in the training job.')
-flags.DEFINE_string('eval_dir', '', 'Directory to write eval summaries to.')
-flags.DEFINE_string(
-    'pipeline_config_path', '',
-    'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
-    'file. If provided, other configs are ignored')
-flags.DEFINE_string('eval_config_path', '',
-                    'Path to an eval_pb2.EvalConfig config file.')
-flags.DEFINE_string('input_config_path', '',
-                    'Path to an input_reader_pb2.InputReader config file.')
-flags.DEFINE_string('model_config_path', '',
-                    'Path to a model_pb2.DetectionModel config file.')
-flags.DEFINE_boolean(
-    'run_once', False, 'Option to only run a single pass of '
-    'evaluation. Overrides the `max_evals` parameter in the '
-    'provided config.')
-flags.DEFINE_string('output_json_path', '', 'Path to output json file')
-FLAGS = flags.FLAGS
+import training_profiler
 
+tf.logging.set_verbosity(tf.logging.INFO)
 
-@tf.contrib.framework.deprecated(None, 'Use object_detection/model_main.py.')
-def main(unused_argv):
-  assert FLAGS.checkpoint_dir, '`checkpoint_dir` is missing.'
-  assert FLAGS.eval_dir, '`eval_dir` is missing.'
-  tf.gfile.MakeDirs(FLAGS.eval_dir)
-  if FLAGS.pipeline_config_path:
-    configs = config_util.get_configs_from_pipeline_file(
-        FLAGS.pipeline_config_path)
+FLAGS = tf.app.flags.FLAGS
+
+
+def define_flags():
+  """Defines the command line flags, only when run as a script so that the
+  module can be imported next to the other stages without duplicate flags."""
+  flags = tf.app.flags
+  flags.DEFINE_boolean('eval_training_data', False,
+                       'If training data should be evaluated for this job.')
+  flags.DEFINE_string(
+      'checkpoint_dir', '',
+      'Directory containing checkpoints to evaluate, typically '
+      'set to `train_dir` used in the training job.')
+  flags.DEFINE_string('eval_dir', '', 'Directory to write eval summaries to.')
+  flags.DEFINE_string(
+      'pipeline_config_path', '',
+      'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
+      'file. If provided, other configs are ignored')
+  flags.DEFINE_string('eval_config_path', '',
+                      'Path to an eval_pb2.EvalConfig config file.')
+  flags.DEFINE_string('input_config_path', '',
+                      'Path to an input_reader_pb2.InputReader config file.')
+  flags.DEFINE_string('model_config_path', '',
+                      'Path to a model_pb2.DetectionModel config file.')
+  flags.DEFINE_boolean(
+      'run_once', False, 'Option to only run a single pass of '
+      'evaluation. Overrides the `max_evals` parameter in the '
+      'provided config.')
+  flags.DEFINE_string('output_json_path', '', 'Path to output json file')
+  flags.DEFINE_string('profile_path', '',
+                      'Path to a json lines file the latency per image is '
+                      'appended to. Not profiled if empty.')
+
+
+def evaluate(checkpoint_dir, eval_dir, output_json_path, pipeline_config_path='',
+             eval_config_path='', input_config_path='', model_config_path='',
+             eval_training_data=False, run_once=False, configs=None,
+             profile_path=''):
+  """Evaluates a detection model, importable version of main.
+
+  Args:
+    checkpoint_dir: directory containing checkpoints to evaluate.
+    eval_dir: directory to write eval summaries to.
+    output_json_path: path of the json file the metrics are written to.
+    pipeline_config_path: path to a pipeline_pb2.TrainEvalPipelineConfig file.
+    eval_config_path: path to an eval_pb2.EvalConfig file.
+    input_config_path: path to an input_reader_pb2.InputReader file.
+    model_config_path: path to a model_pb2.DetectionModel file.
+    eval_training_data: evaluate the training data instead.
+    run_once: only run a single pass of evaluation.
+    configs: already parsed configs of pipeline_config_path, parsed from the file
+      if None.
+    profile_path: path to a json lines file the latency per image is appended
+      to, see training_profiler. Not profiled if empty.
+
+  Returns:
+    dictionary of the metrics.
+  """
+  assert checkpoint_dir, '`checkpoint_dir` is missing.'
+  assert eval_dir, '`eval_dir` is missing.'
+  tf.gfile.MakeDirs(eval_dir)
+  if pipeline_config_path:
+    if configs is None:
+      configs = config_util.get_configs_from_pipeline_file(
+          pipeline_config_path)
     tf.gfile.Copy(
-        FLAGS.pipeline_config_path,
-        os.path.join(FLAGS.eval_dir, 'pipeline.config'),
+        pipeline_config_path,
+        os.path.join(eval_dir, 'pipeline.config'),
         overwrite=True)
   else:
     configs = config_util.get_configs_from_multiple_files(
-        model_config_path=FLAGS.model_config_path,
-        eval_config_path=FLAGS.eval_config_path,
-        eval_input_config_path=FLAGS.input_config_path)
-    for name, config in [('model.config', FLAGS.model_config_path),
-                         ('eval.config', FLAGS.eval_config_path),
-                         ('input.config', FLAGS.input_config_path)]:
-      tf.gfile.Copy(config, os.path.join(FLAGS.eval_dir, name), overwrite=True)
+        model_config_path=model_config_path,
+        eval_config_path=eval_config_path,
+        eval_input_config_path=input_config_path)
+    for name, config in [('model.config', model_config_path),
+                         ('eval.config', eval_config_path),
+                         ('input.config', input_config_path)]:
+      tf.gfile.Copy(config, os.path.join(eval_dir, name), overwrite=True)
 
   model_config = configs['model']
   eval_config = configs['eval_config']
   input_config = configs['eval_input_config']
-  if FLAGS.eval_training_data:
+  if eval_training_data:
     input_config = configs['train_input_config']
 
   model_fn = functools.partial(
@@ -122,7 +155,7 @@ def main(unused_argv):
   categories = label_map_util.create_categories_from_labelmap(
       input_config.label_map_path)
 
-  if FLAGS.run_once:
+  if run_once:
     eval_config.max_evals = 1
 
   graph_rewriter_fn = None
@@ -130,21 +163,46 @@ def main(unused_argv):
     graph_rewriter_fn = graph_rewriter_builder.build(
         configs['graph_rewriter_config'], is_training=False)
 
-  metrics_dict = evaluator.evaluate(
+  evaluate_fn = functools.partial(
+                  evaluator.evaluate,
                   create_input_dict_fn,
                   model_fn,
                   eval_config,
                   categories,
-                  FLAGS.checkpoint_dir,
-                  FLAGS.eval_dir,
+                  checkpoint_dir,
+                  eval_dir,
                   graph_hook_fn=graph_rewriter_fn)
 
-  with open(FLAGS.output_json_path, 'w') as op_json_file:
+  if profile_path:
+    with training_profiler.profile_evaluation(profile_path):
+      metrics_dict = evaluate_fn()
+  else:
+    metrics_dict = evaluate_fn()
+
+  with open(output_json_path, 'w') as op_json_file:
     temp_dict = {}
     for key, value in metrics_dict.items():
         temp_dict[key] = str(value)
-        
+
     json.dump(temp_dict, op_json_file)
-  
+
+  return metrics_dict
+
+
+@tf.contrib.framework.deprecated(None, 'Use object_detection/model_main.py.')
+def main(unused_argv):
+  evaluate(FLAGS.checkpoint_dir,
+           FLAGS.eval_dir,
+           FLAGS.output_json_path,
+           pipeline_config_path=FLAGS.pipeline_config_path,
+           eval_config_path=FLAGS.eval_config_path,
+           input_config_path=FLAGS.input_config_path,
+           model_config_path=FLAGS.model_config_path,
+           eval_training_data=FLAGS.eval_training_data,
+           run_once=FLAGS.run_once,
+           profile_path=FLAGS.profile_path)
+
+
 if __name__ == '__main__':
+  define_flags()
   tf.app.run()
@@ -52,59 +52,93 @@ from object_detection.builders import model_builder
 from object_detection.legacy import trainer
 from object_detection.utils import config_util
 
-tf.logging.set_verbosity(tf.logging.INFO)
-
-flags = tf.app.flags
-flags.DEFINE_string('master', '', 'Name of the TensorFlow master to use.')
-flags.DEFINE_integer('task', 0, 'task id')
-flags.DEFINE_integer('num_clones', 1, 'Number of clones to deploy per worker.')
-flags.DEFINE_boolean('clone_on_cpu', False,
-                     'Force clones to be deployed on CPU.  Note that even if '
-                     'set to False (allowing ops to run on gpu), some ops may '
-                     'still be run on the CPU if they have no GPU kernel.')
-flags.DEFINE_integer('worker_replicas', 1, 'Number of worker+trainer '
-                     'replicas.')
-flags.DEFINE_integer('ps_tasks', 0,
-                     'Number of parameter server tasks. If None, does not use '
-                     'a parameter server.')
-flags.DEFINE_string('train_dir', '',
-                    'Directory to save the checkpoints and training summaries.')
-
-flags.DEFINE_string('pipeline_config_path', '',
-                    'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
-                    'file. If provided, other configs are ignored')
-
-flags.DEFINE_string('train_config_path', '',
-                    'Path to a train_pb2.TrainConfig config file.')
-flags.DEFINE_string('input_config_path', '',
-                    'Path to an input_reader_pb2.InputReader config file.')
-flags.DEFINE_string('model_config_path', '',
-                    'Path to a model_pb2.DetectionModel config file.')
-
-FLAGS = flags.FLAGS
+import training_profiler
 
+tf.logging.set_verbosity(tf.logging.INFO)
 
-@tf.contrib.framework.deprecated(None, 'Use object_detection/model_main.py.')
-def main(_):
-  assert FLAGS.train_dir, '`train_dir` is missing.'
-  if FLAGS.task == 0: tf.gfile.MakeDirs(FLAGS.train_dir)
-  if FLAGS.pipeline_config_path:
-    configs = config_util.get_configs_from_pipeline_file(
-        FLAGS.pipeline_config_path)
-    if FLAGS.task == 0:
-      tf.gfile.Copy(FLAGS.pipeline_config_path,
-                    os.path.join(FLAGS.train_dir, 'pipeline.config'),
+FLAGS = tf.app.flags.FLAGS
+
+
+def define_flags():
+  """Defines the command line flags, only when run as a script so that the
+  module can be imported next to the other stages without duplicate flags."""
+  flags = tf.app.flags
+  flags.DEFINE_string('master', '', 'Name of the TensorFlow master to use.')
+  flags.DEFINE_integer('task', 0, 'task id')
+  flags.DEFINE_integer('num_clones', 1, 'Number of clones to deploy per worker.')
+  flags.DEFINE_boolean('clone_on_cpu', False,
+                       'Force clones to be deployed on CPU.  Note that even if '
+                       'set to False (allowing ops to run on gpu), some ops may '
+                       'still be run on the CPU if they have no GPU kernel.')
+  flags.DEFINE_integer('worker_replicas', 1, 'Number of worker+trainer '
+                       'replicas.')
+  flags.DEFINE_integer('ps_tasks', 0,
+                       'Number of parameter server tasks. If None, does not use '
+                       'a parameter server.')
+  flags.DEFINE_string('train_dir', '',
+                      'Directory to save the checkpoints and training summaries.')
+
+  flags.DEFINE_string('pipeline_config_path', '',
+                      'Path to a pipeline_pb2.TrainEvalPipelineConfig config '
+                      'file. If provided, other configs are ignored')
+
+  flags.DEFINE_string('train_config_path', '',
+                      'Path to a train_pb2.TrainConfig config file.')
+  flags.DEFINE_string('input_config_path', '',
+                      'Path to an input_reader_pb2.InputReader config file.')
+  flags.DEFINE_string('model_config_path', '',
+                      'Path to a model_pb2.DetectionModel config file.')
+  flags.DEFINE_string('profile_path', '',
+                      'Path to a json lines file the per step profile is '
+                      'appended to. Not profiled if empty.')
+  flags.DEFINE_integer('trace_every_n_steps',
+                       training_profiler.TRACE_EVERY_N_STEPS,
+                       'Steps between the traced steps of the profile, 0 '
+                       'never traces.')
+
+
+def train(train_dir, pipeline_config_path='', train_config_path='',
+          input_config_path='', model_config_path='', task=0, num_clones=1,
+          clone_on_cpu=False, configs=None, profile_path='',
+          trace_every_n_steps=training_profiler.TRACE_EVERY_N_STEPS):
+  """Trains a detection model, importable version of main.
+
+  Args:
+    train_dir: directory to save the checkpoints and training summaries.
+    pipeline_config_path: path to a pipeline_pb2.TrainEvalPipelineConfig file.
+    train_config_path: path to a train_pb2.TrainConfig file.
+    input_config_path: path to an input_reader_pb2.InputReader file.
+    model_config_path: path to a model_pb2.DetectionModel file.
+    task: task id.
+    num_clones: number of clones to deploy per worker.
+    clone_on_cpu: force clones to be deployed on CPU.
+    configs: already parsed configs of pipeline_config_path, parsed from the file
+      if None.
+    profile_path: path to a json lines file the per step profile is appended
+      to, see training_profiler. Not profiled if empty.
+    trace_every_n_steps: steps between the traced steps of the profile, 0
+      never traces.
+  """
+  assert train_dir, '`train_dir` is missing.'
+  if task == 0: tf.gfile.MakeDirs(train_dir)
+  if pipeline_config_path:
+    if configs is None:
+      configs = config_util.get_configs_from_pipeline_file(
+          pipeline_config_path)
+    if task == 0:
+      tf.gfile.Copy(pipeline_config_path,
+                    os.path.join(train_dir, 'pipeline.config'),
                     overwrite=True)
   else:
     configs = config_util.get_configs_from_multiple_files(
-        model_config_path=FLAGS.model_config_path,
-        train_config_path=FLAGS.train_config_path,
-        train_input_config_path=FLAGS.input_config_path)
-    if FLAGS.task == 0:
-      for name, config in [('model.config', FLAGS.model_config_path),
-                           ('train.config', FLAGS.train_config_path),
-                           ('input.config', FLAGS.input_config_path)]:
-        tf.gfile.Copy(config, os.path.join(FLAGS.train_dir, name),
+        model_config_path=model_config_path,
+        train_config_path=train_config_path,
+        train_input_config_path=input_config_path)
+    if task == 0:
+      for name, config in [('model.config', model_config_path),
+                           ('train.config', train_config_path),
+                           ('input.config', input_config_path)]:
+        tf.gfile.Copy(config, os.path.join(train_dir, name),
                       overwrite=True)
 
   model_config = configs['model']
@@ -164,21 +198,45 @@ def main(_):
     graph_rewriter_fn = graph_rewriter_builder.build(
         configs['graph_rewriter_config'], is_training=True)
 
-  trainer.train(
+  train_fn = functools.partial(
+      trainer.train,
       create_input_dict_fn,
       model_fn,
       train_config,
       master,
       task,
-      FLAGS.num_clones,
+      num_clones,
       worker_replicas,
-      FLAGS.clone_on_cpu,
+      clone_on_cpu,
       ps_tasks,
       worker_job_name,
       is_chief,
-      FLAGS.train_dir,
+      train_dir,
       graph_hook_fn=graph_rewriter_fn)
 
+  if profile_path:
+    with training_profiler.profile_training(
+        profile_path, train_config.batch_size * num_clones,
+        trace_every_n_steps):
+      train_fn()
+  else:
+    train_fn()
+
+
+@tf.contrib.framework.deprecated(None, 'Use object_detection/model_main.py.')
+def main(_):
+  train(FLAGS.train_dir,
+        pipeline_config_path=FLAGS.pipeline_config_path,
+        train_config_path=FLAGS.train_config_path,
+        input_config_path=FLAGS.input_config_path,
+        model_config_path=FLAGS.model_config_path,
+        task=FLAGS.task,
+        num_clones=FLAGS.num_clones,
+        clone_on_cpu=FLAGS.clone_on_cpu,
+        profile_path=FLAGS.profile_path,
+        trace_every_n_steps=FLAGS.trace_every_n_steps)
+
 
 if __name__ == '__main__':
+  define_flags()
   tf.app.run()
@@ -0,0 +1,226 @@
+'''
+    Profiling of the training and evaluation stages, metrics of every step are written
+    as json lines next to the checkpoints
+    -> training : wall time, images/sec and peak memory per step, every TRACE_EVERY_N_STEPS
+                  steps a traced step splits the step time into input wait (dequeue ops)
+                  and compute and samples the fill of the input queues
+    -> evaluation : latency per image
+'''
+
+import contextlib
+import json
+import resource
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from object_detection.legacy import evaluator
+from object_detection.legacy import trainer
+
+# constants
+TRAIN_PROFILE_FILE_NAME = 'train_profile.jsonl'
+EVAL_PROFILE_FILE_NAME = 'eval_profile.jsonl'
+TRACE_EVERY_N_STEPS = 100
+INPUT_OP_TYPES = ('QueueDequeueV2', 'QueueDequeueManyV2', 'QueueDequeueUpToV2', 'IteratorGetNext')
+
+def get_peak_memory_mb():
+    '''
+        return peak resident memory of this process in MB
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def get_input_wait_sec(graph, run_metadata):
+    '''
+        Method to sum the time spent in input dequeue ops of a traced step
+        params:
+            graph : graph of the session
+            run_metadata : tf.RunMetadata of a FULL_TRACE run
+        return seconds
+    '''
+    input_wait_micros = 0
+
+    for device_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in device_stats.node_stats:
+            try:
+                op_type = graph.get_operation_by_name(node_stats.node_name.split(':')[0]).type
+            except KeyError:
+                continue
+
+            if op_type in INPUT_OP_TYPES:
+                input_wait_micros += node_stats.all_end_rel_micros
+
+    return input_wait_micros / 1e6
+
+def get_queue_fill_tensors():
+    '''
+        Method to build the size tensors of the input queues of the default graph,
+        it has to be called before the graph is finalized
+        return list of (queue name, size tensor, capacity)
+    '''
+    queue_fill_tensors = []
+
+    for queue_runner in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS):
+        queue = queue_runner.queue
+        try:
+            capacity = queue.queue_ref.op.get_attr('capacity')
+        except ValueError:
+            capacity = -1
+        queue_fill_tensors.append((queue.name, queue.size(), capacity))
+
+    return queue_fill_tensors
+
+@contextlib.contextmanager
+def profile_training(profile_path, images_per_step, trace_every_n_steps=TRACE_EVERY_N_STEPS):
+    '''
+        Context manager making slim.learning.train, as called by the legacy trainer,
+        record every training step into profile_path
+        params:
+            profile_path : path of the json lines file
+            images_per_step : batch size times number of clones
+            trace_every_n_steps : steps between traced steps, 0 never traces
+    '''
+    original_train = trainer.slim.learning.train
+
+    def profiled_train(train_op, logdir, *args, **kwargs):
+        queue_fill_tensors = get_queue_fill_tensors()
+
+        with open(profile_path, 'a') as profile_file:
+
+            def train_step_fn(sess, train_op, global_step, train_step_kwargs):
+                step_start_time = time.time()
+                input_wait_sec = None
+                queue_fill = None
+
+                if trace_every_n_steps and train_step_fn.step_no % trace_every_n_steps == 0:
+                    # the queue sizes are fetched in the same run, other steps run untouched
+                    run_metadata = tf.RunMetadata()
+                    total_loss, _, queue_sizes = sess.run(
+                        [train_op, global_step, [size for _, size, _ in queue_fill_tensors]],
+                        options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                        run_metadata=run_metadata)
+                    queue_fill = {name: float(size) / capacity if capacity > 0 else float(size)
+                                  for (name, _, capacity), size in zip(queue_fill_tensors,
+                                                                       queue_sizes)}
+                    should_stop = bool(sess.run(train_step_kwargs['should_stop'])) \
+                        if 'should_stop' in train_step_kwargs else False
+                    input_wait_sec = get_input_wait_sec(sess.graph, run_metadata)
+                else:
+                    total_loss, should_stop = trainer.slim.learning.train_step(
+                        sess, train_op, global_step, train_step_kwargs)
+
+                step_time = time.time() - step_start_time
+
+                profile_file.write(json.dumps({
+                    'step': train_step_fn.step_no,
+                    'step_time_sec': step_time,
+                    'images_per_sec': images_per_step / step_time,
+                    'input_wait_sec': input_wait_sec,
+                    'compute_sec': step_time - input_wait_sec if input_wait_sec is not None else None,
+                    'queue_fill': queue_fill,
+                    'peak_memory_mb': get_peak_memory_mb(),
+                    'loss': float(total_loss)}) + '\n')
+
+                train_step_fn.step_no += 1
+                return total_loss, should_stop
+
+            train_step_fn.step_no = 0
+            kwargs['train_step_fn'] = train_step_fn
+
+            return original_train(train_op, logdir, *args, **kwargs)
+
+    trainer.slim.learning.train = profiled_train
+    try:
+        yield
+    finally:
+        trainer.slim.learning.train = original_train
+
+@contextlib.contextmanager
+def profile_evaluation(profile_path):
+    '''
+        Context manager making the legacy evaluator record the latency of every
+        evaluated image into profile_path
+        params:
+            profile_path : path of the json lines file
+    '''
+    original_repeated_checkpoint_run = evaluator.eval_util.repeated_checkpoint_run
+
+    def profiled_repeated_checkpoint_run(*args, **kwargs):
+        batch_processor = kwargs['batch_processor']
+
+        with open(profile_path, 'a') as profile_file:
+
+            def timed_batch_processor(*batch_args, **batch_kwargs):
+                batch_start_time = time.time()
+                result = batch_processor(*batch_args, **batch_kwargs)
+
+                # the legacy evaluator runs one image per batch
+                profile_file.write(json.dumps({
+                    'image_latency_sec': time.time() - batch_start_time,
+                    'peak_memory_mb': get_peak_memory_mb()}) + '\n')
+
+                return result
+
+            kwargs['batch_processor'] = timed_batch_processor
+            return original_repeated_checkpoint_run(*args, **kwargs)
+
+    evaluator.eval_util.repeated_checkpoint_run = profiled_repeated_checkpoint_run
+    try:
+        yield
+    finally:
+        evaluator.eval_util.repeated_checkpoint_run = original_repeated_checkpoint_run
+
+def read_profile(profile_path):
+    '''
+        return list of the records of a json lines profile
+    '''
+    with open(profile_path) as profile_file:
+        return [json.loads(line) for line in profile_file if line.strip()]
+
+def summarize_train_profile(profile_path):
+    '''
+        Method to summarize a training profile, the first step is left out of the
+        timings as it includes the graph warm up
+        params:
+            profile_path : path of the json lines file
+        return dictionary of summary values
+    '''
+    records = read_profile(profile_path)
+    timed_records = records[1:] or records
+
+    if not timed_records:
+        return {'steps': 0}
+
+    step_times = np.array([record['step_time_sec'] for record in timed_records])
+    traced_records = [record for record in timed_records if record['input_wait_sec'] is not None]
+
+    return {
+        'steps': len(records),
+        'median_step_time_sec': float(np.median(step_times)),
+        'p95_step_time_sec': float(np.percentile(step_times, 95)),
+        'mean_images_per_sec': float(np.mean([record['images_per_sec']
+                                              for record in timed_records])),
+        'input_wait_fraction': float(np.mean([record['input_wait_sec'] / record['step_time_sec']
+                                              for record in traced_records]))
+                               if traced_records else None,
+        'peak_memory_mb': max(record['peak_memory_mb'] for record in records)}
+
+def summarize_eval_profile(profile_path):
+    '''
+        Method to summarize an evaluation profile
+        params:
+            profile_path : path of the json lines file
+        return dictionary of summary values
+    '''
+    records = read_profile(profile_path)
+
+    if not records:
+        return {'images': 0}
+
+    latencies = np.array([record['image_latency_sec'] for record in records])
+
+    return {
+        'images': len(records),
+        'median_image_latency_sec': float(np.median(latencies)),
+        'p95_image_latency_sec': float(np.percentile(latencies, 95)),
+        'peak_memory_mb': max(record['peak_memory_mb'] for record in records)}
@@ -4,11 +4,13 @@
 
 # importing
 import glob
+import hashlib
 import json
 import logging
 import os
 import subprocess
 import sys
+import time
 
 import pandas as pd
 import shortuuid
@@ -17,6 +19,19 @@ import tensorflow as tf
 
 from google.protobuf import text_format
 from object_detection.protos import pipeline_pb2
+from object_detection.utils import config_util
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../..") # for sibling import
+
+# training stages, run in this process unless run_in_subprocess is set in the config
+import checkpoint_evaluator
+import export_inference_graph
+import generate_tfrecord
+import modified_eval
+import train
+import training_profiler
+
+from utils.convert_tiff_into_jpeg import convert_tif_dir
 
 #CONSTANTS
 CURRENT_PATH = os.getcwd()
@@ -37,21 +52,37 @@ CONVERT_TIF_INTO_JPG_CONVERSION_SCRIPT_PATH = '../../utils/convert_tiff_into_jpe
 
 TRAINING_CONFIG_JSON_PATH = os.path.join('..', 'training_config.json')
 LOG_FILE_PATH = os.path.join('..', 'training.log')
+# with shards the records are train.record-00000-of-000NN, ... the input readers glob them
 TRAIN_TFRECORD_PATH = os.path.join(DATASET_DIR_PATH, 'train.record')
 TEST_TFRECORD_PATH = os.path.join(DATASET_DIR_PATH, 'test.record')
 LABEL_MAP_PATH = os.path.join(DATASET_DIR_PATH, 'label_map.pbtxt')
 TRAIN_CSV_PATH = os.path.join(TIF_DIR_PATH, 'train_labels.csv')
 TEST_CSV_PATH = os.path.join(TIF_DIR_PATH, 'test_labels.csv')
+# written next to the csvs by the split script with --parquet, read instead when present
+TRAIN_PARQUET_PATH = os.path.join(TIF_DIR_PATH, 'train_labels.parquet')
+TEST_PARQUET_PATH = os.path.join(TIF_DIR_PATH, 'test_labels.parquet')
+
+# prepared tf records are cached by a hash of everything they are made from
+DATASET_CACHE_DIR_PATH = os.path.join(CURRENT_PATH, '..', 'dataset_cache')
+DATASET_CACHE_VERSION = 1
+DATASET_CACHE_SUCCESS_FILE_NAME = '_SUCCESS'
+DATA_PREPARATION_SCRIPT_PATHS = [CONVERT_TIF_INTO_JPG_CONVERSION_SCRIPT_PATH, 'generate_tfrecord.py']
+
+# stages are run as python3 subprocesses when True (set from the config)
+RUN_IN_SUBPROCESS = False
+
+# train records are copied to this tmpfs with input_reader cache_in_memory
+IN_MEMORY_DATASET_DIR_PATH = '/dev/shm/treetect_dataset'
 
-#logger
-if os.path.exists(LOG_FILE_PATH):
-    os.remove(LOG_FILE_PATH)
+# checkpoints are evaluated by this script next to the training with concurrent_evaluation
+CHECKPOINT_EVALUATOR_SCRIPT_PATH = 'checkpoint_evaluator.py'
+TRAINING_DONE_FILE_NAME = 'training_done'
 
-logging.basicConfig(filename=LOG_FILE_PATH,
-                    filemode='a',
-                    format='%(asctime)s - %(message)s',
-                    level=logging.INFO,
-                    datefmt='%d-%b-%y %H:%M:%S')
+# iteration snapshots link the newest checkpoint and reference the other training files
+SNAPSHOT_MANIFEST_FILE_NAME = 'snapshot_manifest.json'
+# files with the same content are uploaded once and listed here
+DEDUPLICATION_MANIFEST_FILE_NAME = 'deduplicated_files.json'
+HASH_CHUNK_SIZE = 1 << 20
 
 def run_subprocess(command_list, input=None):
     '''
@@ -76,6 +107,28 @@ def run_subprocess(command_list, input=None):
             stderr=sys.stdout,
             check=True)
 
+def run_stage(command_list, stage_function, stage_kwargs, input=None):
+    '''
+        Method to run a training stage in this process, sharing the loaded modules,
+        or as a subprocess if RUN_IN_SUBPROCESS is set
+        params:
+            command_list: list of subprocesses command of the stage
+            stage_function: function running the stage in process
+            stage_kwargs: keyword arguments of stage_function
+            input: command line input of the subprocess
+        return value of stage_function, None in a subprocess
+    '''
+    if RUN_IN_SUBPROCESS:
+        run_subprocess(command_list, input)
+        return None
+
+    logging.info(f"\n\n{'*'*100}\n\nRunning stage :{stage_function.__module__}."
+                 f"{stage_function.__name__}({stage_kwargs})\n\n{'*'*100}\n\n")
+
+    # every stage builds its graph from scratch
+    with tf.Graph().as_default():
+        return stage_function(**stage_kwargs)
+
 def s3_data_transfer(src, dest, is_dir):
     '''
         Method to download data from s3
@@ -91,21 +144,375 @@ def s3_data_transfer(src, dest, is_dir):
     else:
         run_subprocess(['aws', 's3', 'cp', src, dest])
 
-def generate_training_data(s3_dataset_path, band):
+def get_file_hash(file_path):
     '''
-        method to generate training_data for a specific dataset
-        it download tif files dir from s3 and then convert tif into jpg for defined version
-        and then save the train.record and test.record in the dataset folder
+        return sha256 hex digest of the content of a file, read in chunks
+    '''
+    file_hash = hashlib.sha256()
+
+    with open(file_path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(HASH_CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+def get_duplicate_files(dir_path):
+    '''
+        Method to find the files of a directory with the same content, only files of
+        the same size are hashed and hard links of a file are hashed once
         params:
-            dataset_path : path of the dataset
+            dir_path : path of the directory
+        return dictionary of the relative path of every duplicate to the relative path
+        of the kept file with its content, files in the training directory are kept first
+    '''
+    file_paths_by_size = {}
+    for root, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            file_paths_by_size.setdefault(os.path.getsize(file_path), []).append(
+                os.path.relpath(file_path, dir_path))
+
+    duplicate_files = {}
+    file_hashes_by_inode = {}
+
+    for file_size, file_paths in file_paths_by_size.items():
+        if file_size == 0 or len(file_paths) < 2:
+            continue
+
+        kept_file_paths = {}
+        for file_path in sorted(file_paths,
+                                key=lambda path: (not path.startswith('training' + os.sep), path)):
+            file_stat = os.stat(os.path.join(dir_path, file_path))
+            inode = (file_stat.st_dev, file_stat.st_ino)
+
+            if inode not in file_hashes_by_inode:
+                file_hashes_by_inode[inode] = get_file_hash(os.path.join(dir_path, file_path))
+
+            kept_file_path = kept_file_paths.setdefault(file_hashes_by_inode[inode], file_path)
+            if kept_file_path != file_path:
+                duplicate_files[file_path] = kept_file_path
+
+    return duplicate_files
+
+def upload_deduplicated_dir(src, dest):
+    '''
+        Method to upload a directory to s3 with every content only once, the skipped
+        duplicates are listed in DEDUPLICATION_MANIFEST_FILE_NAME next to the files
+        params:
+            src : local directory
+            dest : s3 destination path
+    '''
+    duplicate_files = get_duplicate_files(src)
+
+    with open(os.path.join(src, DEDUPLICATION_MANIFEST_FILE_NAME), 'w') as manifest_file:
+        json.dump(duplicate_files, manifest_file, indent=4, sort_keys=True)
+
+    logging.info(f'Skipping {len(duplicate_files)} duplicate files in the upload, saving '
+                 f'{sum(os.path.getsize(os.path.join(src, path)) for path in duplicate_files)} bytes')
+
+    exclude_args = []
+    for file_path in sorted(duplicate_files):
+        exclude_args += ['--exclude', file_path]
+
+    run_subprocess(['aws', 's3', 'cp', src, dest, '--recursive'] + exclude_args)
+
+def restore_deduplicated_files(dir_path):
+    '''
+        Method to recreate the duplicates skipped by upload_deduplicated_dir as hard links
+        of the kept files, for a downloaded model directory
+        params:
+            dir_path : downloaded directory
+    '''
+    manifest_path = os.path.join(dir_path, DEDUPLICATION_MANIFEST_FILE_NAME)
+
+    if not os.path.exists(manifest_path):
+        return
+
+    with open(manifest_path) as manifest_file:
+        duplicate_files = json.load(manifest_file)
+
+    for file_path, kept_file_path in duplicate_files.items():
+        dst_path = os.path.join(dir_path, file_path)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+
+        if not os.path.exists(dst_path):
+            os.link(os.path.join(dir_path, kept_file_path), dst_path)
+
+def snapshot_training_dir(training_dir, snapshot_dir):
+    '''
+        Method to snapshot the training directory after an iteration: the files of the
+        newest checkpoint are hard linked, the other files (event files, graph, config)
+        keep growing in the training directory and are only referenced in a manifest
+        params:
+            training_dir : path of the training directory
+            snapshot_dir : path of the snapshot directory, replaced if it exists
+    '''
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.makedirs(snapshot_dir)
+
+    checkpoint_prefix = tf.train.latest_checkpoint(training_dir)
+    snapshot_checkpoint_prefix = checkpoint_evaluator.link_checkpoint(checkpoint_prefix, snapshot_dir)
+    tf.train.update_checkpoint_state(snapshot_dir, snapshot_checkpoint_prefix)
+
+    checkpoint_file_names = set(os.listdir(snapshot_dir))
+
+    referenced_files = []
+    for root, _, file_names in os.walk(training_dir):
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            if root == training_dir and file_name in checkpoint_file_names:
+                continue
+            referenced_files.append({'path': os.path.relpath(file_path, training_dir),
+                                     'size': os.path.getsize(file_path)})
+
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST_FILE_NAME), 'w') as manifest_file:
+        json.dump({'checkpoint': os.path.basename(checkpoint_prefix),
+                   'training_dir': os.path.basename(training_dir),
+                   'referenced_files': referenced_files},
+                  manifest_file, indent=4)
+
+def get_s3_manifest(s3_path):
+    '''
+        Method to list key and etag of all objects under a s3 path
+        params:
+            s3_path : s3 path without s3://
+        return list of [key, etag] sorted by key
+    '''
+    bucket, _, prefix = s3_path.strip('/').partition('/')
+
+    process_output = subprocess.run(
+        ['aws', 's3api', 'list-objects-v2',
+         '--bucket', bucket,
+         '--prefix', prefix,
+         '--query', 'Contents[].[Key, ETag]',
+         '--output', 'json'],
+        stdout=subprocess.PIPE,
+        check=True)
+
+    return sorted(json.loads(process_output.stdout.decode() or 'null') or [])
+
+def get_dataset_cache_key(s3_dataset_path, band, preparation_options):
+    '''
+        Method to hash everything the tf records of a dataset are made from: the dataset
+        files (by etag), the bands, the conversion/encoding scripts (so that a change of
+        the enhancement parameters is a new key) and the preparation options
+        params:
+            s3_dataset_path : path of the dataset
             band : band list in which the tif will get converted
+            preparation_options : dictionary of the options of generate_tfrecord.py
+        return hex digest
     '''
-    if os.path.exists(DATASET_DIR_PATH):
-        shutil.rmtree(DATASET_DIR_PATH)
+    script_hashes = []
+    for script_path in DATA_PREPARATION_SCRIPT_PATHS:
+        with open(script_path, 'rb') as script_file:
+            script_hashes.append(hashlib.sha256(script_file.read()).hexdigest())
 
-    os.makedirs(TIF_DIR_PATH)
-    os.makedirs(IMAGE_DIR_PATH)
+    cache_key_data = {'version': DATASET_CACHE_VERSION,
+                      'dataset_path': s3_dataset_path.strip('/'),
+                      'manifest': get_s3_manifest(s3_dataset_path),
+                      'band': list(band),
+                      'scripts': script_hashes,
+                      'options': preparation_options}
+
+    return hashlib.sha256(json.dumps(cache_key_data, sort_keys=True).encode()).hexdigest()
+
+def get_label_path(csv_path, parquet_path):
+    '''
+        return path of the labels given to generate_tfrecord.py, the parquet labels
+        when the dataset has them else the csv
+    '''
+    return parquet_path if os.path.exists(parquet_path) else csv_path
+
+def get_dataset_files():
+    '''
+        return paths of the prepared files of a dataset that are cached
+    '''
+    return (glob.glob(TRAIN_TFRECORD_PATH + '*')
+            + glob.glob(TEST_TFRECORD_PATH + '*')
+            + [TEST_CSV_PATH])
+
+def restore_dataset_from_cache(cache_key, s3_cache_path=None):
+    '''
+        Method to copy prepared files from the local cache, filling it from the s3 cache
+        first if needed
+        params:
+            cache_key : key of the dataset (see get_dataset_cache_key)
+            s3_cache_path : optional s3 path of the shared cache
+        return True on a cache hit
+    '''
+    cache_dir = os.path.join(DATASET_CACHE_DIR_PATH, cache_key)
+
+    if not os.path.exists(os.path.join(cache_dir, DATASET_CACHE_SUCCESS_FILE_NAME)) and s3_cache_path:
+        s3_cache_dir = 's3://' + s3_cache_path.strip('/') + '/' + cache_key
+
+        is_cached = subprocess.run(['aws', 's3', 'ls',
+                                    s3_cache_dir + '/' + DATASET_CACHE_SUCCESS_FILE_NAME],
+                                   stdout=subprocess.PIPE).returncode == 0
+        if is_cached:
+            if os.path.exists(cache_dir):
+                shutil.rmtree(cache_dir)
+
+            # the local marker is written once every file is downloaded
+            run_subprocess(['aws', 's3', 'cp', s3_cache_dir, cache_dir, '--recursive',
+                            '--exclude', DATASET_CACHE_SUCCESS_FILE_NAME])
+            open(os.path.join(cache_dir, DATASET_CACHE_SUCCESS_FILE_NAME), 'w').close()
+
+    if not os.path.exists(os.path.join(cache_dir, DATASET_CACHE_SUCCESS_FILE_NAME)):
+        return False
+
+    for file_name in os.listdir(cache_dir):
+        if file_name == DATASET_CACHE_SUCCESS_FILE_NAME:
+            continue
+
+        dst_dir_path = TIF_DIR_PATH if file_name == os.path.basename(TEST_CSV_PATH) \
+                       else DATASET_DIR_PATH
+        shutil.copy(os.path.join(cache_dir, file_name), dst_dir_path)
+
+    return True
+
+def store_dataset_in_cache(cache_key, s3_cache_path=None):
+    '''
+        Method to copy the prepared files into the local cache and the s3 cache
+        params:
+            cache_key : key of the dataset (see get_dataset_cache_key)
+            s3_cache_path : optional s3 path of the shared cache
+    '''
+    cache_dir = os.path.join(DATASET_CACHE_DIR_PATH, cache_key)
 
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.makedirs(cache_dir)
+
+    for file_path in get_dataset_files():
+        shutil.copy(file_path, cache_dir)
+
+    # written last, a cache entry without it is incomplete
+    open(os.path.join(cache_dir, DATASET_CACHE_SUCCESS_FILE_NAME), 'w').close()
+
+    if s3_cache_path:
+        s3_cache_dir = 's3://' + s3_cache_path.strip('/') + '/' + cache_key
+
+        # aws s3 cp uploads files concurrently, the marker is uploaded once all others are
+        run_subprocess(['aws', 's3', 'cp', cache_dir, s3_cache_dir, '--recursive',
+                        '--exclude', DATASET_CACHE_SUCCESS_FILE_NAME])
+        s3_data_transfer(os.path.join(cache_dir, DATASET_CACHE_SUCCESS_FILE_NAME),
+                         s3_cache_dir + '/' + DATASET_CACHE_SUCCESS_FILE_NAME, False)
+
+def apply_input_reader_config(input_reader, input_reader_config):
+    '''
+        Method to copy the input reader settings of the config json into the pipeline
+        e.g. num_readers, num_parallel_batches, num_prefetch_batches, shuffle_buffer_size,
+        num_parallel_map_calls
+        params:
+            input_reader : input_reader_pb2.InputReader of the pipeline
+            input_reader_config : dictionary of input reader fields
+    '''
+    for field_name, value in input_reader_config.items():
+        if field_name == 'cache_in_memory':
+            continue
+
+        if field_name not in input_reader.DESCRIPTOR.fields_by_name:
+            raise Exception(f'Error: input_reader has no field {field_name}')
+
+        setattr(input_reader, field_name, value)
+        logging.info(f'input_reader.{field_name} = {value}')
+
+def stage_records_in_memory(record_pattern):
+    '''
+        Method to copy tf records into tmpfs so that training reads them from memory,
+        falls back to the records on disk if they do not fit
+        params:
+            record_pattern : glob pattern of the tf records
+        return glob pattern of the records to read
+    '''
+    record_paths = glob.glob(record_pattern)
+    records_size = sum(os.path.getsize(record_path) for record_path in record_paths)
+
+    if os.path.exists(IN_MEMORY_DATASET_DIR_PATH):
+        shutil.rmtree(IN_MEMORY_DATASET_DIR_PATH)
+
+    if not os.path.exists(os.path.dirname(IN_MEMORY_DATASET_DIR_PATH)) \
+            or shutil.disk_usage(os.path.dirname(IN_MEMORY_DATASET_DIR_PATH)).free < records_size:
+        logging.warning(f'{records_size} bytes of records do not fit in memory, reading from disk')
+        return record_pattern
+
+    os.makedirs(IN_MEMORY_DATASET_DIR_PATH)
+    for record_path in record_paths:
+        shutil.copy(record_path, IN_MEMORY_DATASET_DIR_PATH)
+
+    logging.info(f'Staged {records_size} bytes of records in {IN_MEMORY_DATASET_DIR_PATH}')
+    return os.path.join(IN_MEMORY_DATASET_DIR_PATH, os.path.basename(record_pattern))
+
+def start_checkpoint_evaluator(model_files_dir, model_config_path, iteration_no,
+                               evaluation_config, profile_path=''):
+    '''
+        Method to start the low priority process evaluating the checkpoints of the
+        training directory while training runs
+        params:
+            model_files_dir : model directory containing the training directory
+            model_config_path : path to the pipeline config of the iteration
+            iteration_no : dataset iteration
+            evaluation_config : concurrent_evaluation block of the config
+            profile_path : json lines file of the latency per image, not profiled if empty
+        return subprocess.Popen of the evaluator
+    '''
+    stop_file_path = os.path.join(model_files_dir, TRAINING_DONE_FILE_NAME)
+    if os.path.exists(stop_file_path):
+        os.remove(stop_file_path)
+
+    # keep the gpu memory for the training by default
+    env = dict(os.environ)
+    if evaluation_config.get('on_cpu', True):
+        env['CUDA_VISIBLE_DEVICES'] = ''
+
+    command_list = ['python3',
+                    CHECKPOINT_EVALUATOR_SCRIPT_PATH,
+                    f'--training_dir={os.path.join(model_files_dir, "training")}',
+                    f'--pipeline_config_path={model_config_path}',
+                    f'--output_dir={model_files_dir}',
+                    f'--stop_file={stop_file_path}',
+                    f'--iteration_no={iteration_no}',
+                    f'--metric={evaluation_config.get("metric", checkpoint_evaluator.DEFAULT_METRIC)}',
+                    f'--keep_best={evaluation_config.get("keep_best", 3)}',
+                    f'--profile_path={profile_path}']
+
+    logging.info(f"\n\n{'*'*100}\n\nStarting process :{' '.join(command_list)}\n\n{'*'*100}\n\n")
+
+    return subprocess.Popen(command_list, stdout=sys.stdout, stderr=sys.stdout, env=env)
+
+def stop_checkpoint_evaluator(evaluator_process, model_files_dir):
+    '''
+        Method to signal the end of training to the checkpoint evaluator and wait
+        until it has evaluated the last checkpoint
+        params:
+            evaluator_process : subprocess.Popen of the evaluator
+            model_files_dir : model directory containing the training directory
+    '''
+    stop_file_path = os.path.join(model_files_dir, TRAINING_DONE_FILE_NAME)
+    open(stop_file_path, 'w').close()
+
+    return_code = evaluator_process.wait()
+    os.remove(stop_file_path)
+
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, evaluator_process.args)
+
+def terminate_checkpoint_evaluator(evaluator_process):
+    '''
+        Method to end the checkpoint evaluator without waiting for its evaluation,
+        used when the training failed, its exit code is ignored
+        params:
+            evaluator_process : subprocess.Popen of the evaluator
+    '''
+    evaluator_process.terminate()
+    evaluator_process.wait()
+
+def prepare_dataset(s3_dataset_path, band, num_shards, direct_tfrecord):
+    '''
+        method to download the tif files of a dataset and write its train/test tf records
+        params: see generate_training_data
+    '''
     #------------------------------Download tif files-----------------------------------------------
 
     print('-- Downloading tif data from', s3_dataset_path)
@@ -120,32 +527,100 @@ def generate_training_data(s3_dataset_path, band):
 
     # --------------------Convert tif file into jpg for band given in config and save into dir------
 
-    print(f"-- Converting tif info jpg using band, {band}")
-    logging.info(f"Converting tif info jpg using band, {band}")
-    run_subprocess([
-                'python3',
-                CONVERT_TIF_INTO_JPG_CONVERSION_SCRIPT_PATH,
-                f'--input_dir={TIF_DIR_PATH}',
-                f'--output_dir={IMAGE_DIR_PATH}'],
-                   input=(', '.join(band) + '\nz\n').encode())
+    if direct_tfrecord:
+        image_source_args = [f'--tif_dir={TIF_DIR_PATH}',
+                             f'--band={",".join(band)}']
+        image_source_kwargs = {'tif_dir': TIF_DIR_PATH,
+                               'band_list': list(band)}
+    else:
+        print(f"-- Converting tif info jpg using band, {band}")
+        logging.info(f"Converting tif info jpg using band, {band}")
+
+        image_dir_path = os.path.join(IMAGE_DIR_PATH, "_".join(band))
+        os.makedirs(image_dir_path, exist_ok=True)
+
+        run_stage([
+                    'python3',
+                    CONVERT_TIF_INTO_JPG_CONVERSION_SCRIPT_PATH,
+                    f'--input_dir={TIF_DIR_PATH}',
+                    f'--output_dir={IMAGE_DIR_PATH}'],
+                  convert_tif_dir,
+                  {'input_dir': TIF_DIR_PATH,
+                   'output_dir_path': image_dir_path,
+                   'band_list': list(band)},
+                  input=(', '.join(band) + '\ny\nz\n').encode())
+
+        image_source_args = [f'--image_dir={image_dir_path}']
+        image_source_kwargs = {'image_dir': image_dir_path}
 
     # ---------------------Generating tf record-----------------------------------------------------
 
+    train_label_path = get_label_path(TRAIN_CSV_PATH, TRAIN_PARQUET_PATH)
+
     logging.info('Generating train tf records')
-    print('-- Generating train tf records...')
-    run_subprocess(['python3',
-                    'generate_tfrecord.py',
-                    f'--csv_file={TRAIN_CSV_PATH}',
-                    f'--image_dir={os.path.join(IMAGE_DIR_PATH, "_".join(band))}',
-                    f'--output_path={TRAIN_TFRECORD_PATH}'])
+    print('-- Generating train tf records from', train_label_path)
+    run_stage(['python3',
+               'generate_tfrecord.py',
+               f'--csv_file={train_label_path}',
+               f'--output_path={TRAIN_TFRECORD_PATH}',
+               f'--num_shards={num_shards}']
+              + image_source_args,
+              generate_tfrecord.generate_tfrecord,
+              dict({'csv_file': train_label_path,
+                    'output_path': TRAIN_TFRECORD_PATH,
+                    'num_shards': num_shards},
+                   **image_source_kwargs))
+
+    test_label_path = get_label_path(TEST_CSV_PATH, TEST_PARQUET_PATH)
 
     logging.info('Generating test tf records')
-    print('-- Generating test tf records...')
-    run_subprocess(['python3',
-                    'generate_tfrecord.py',
-                    f'--csv_file={TEST_CSV_PATH}',
-                    f'--image_dir={os.path.join(IMAGE_DIR_PATH, "_".join(band))}',
-                    f'--output_path={TEST_TFRECORD_PATH}'])
+    print('-- Generating test tf records from', test_label_path)
+    run_stage(['python3',
+               'generate_tfrecord.py',
+               f'--csv_file={test_label_path}',
+               f'--output_path={TEST_TFRECORD_PATH}',
+               f'--num_shards={num_shards}']
+              + image_source_args,
+              generate_tfrecord.generate_tfrecord,
+              dict({'csv_file': test_label_path,
+                    'output_path': TEST_TFRECORD_PATH,
+                    'num_shards': num_shards},
+                   **image_source_kwargs))
+
+def generate_training_data(s3_dataset_path, band, num_shards=1, direct_tfrecord=False,
+                           s3_cache_path=None):
+    '''
+        method to generate training_data for a specific dataset
+        it download tif files dir from s3 and then convert tif into jpg for defined version
+        and then save the train.record and test.record in the dataset folder
+        params:
+            dataset_path : path of the dataset
+            band : band list in which the tif will get converted
+            num_shards : number of shards of each tf record
+            direct_tfrecord : encode the tifs straight into the tf records without jpg files
+            s3_cache_path : optional s3 path of a dataset cache shared between jobs
+    '''
+    if os.path.exists(DATASET_DIR_PATH):
+        shutil.rmtree(DATASET_DIR_PATH)
+
+    os.makedirs(TIF_DIR_PATH)
+    os.makedirs(IMAGE_DIR_PATH)
+
+    #------------------------------Look up prepared dataset in cache---------------------------------
+
+    cache_key = get_dataset_cache_key(s3_dataset_path,
+                                      band,
+                                      {'num_shards': num_shards,
+                                       'direct_tfrecord': direct_tfrecord})
+
+    if restore_dataset_from_cache(cache_key, s3_cache_path):
+        print('-- Dataset cache hit', cache_key)
+        logging.info(f'Dataset cache hit : {cache_key}')
+    else:
+        print('-- Dataset cache miss', cache_key)
+        logging.info(f'Dataset cache miss : {cache_key}')
+        prepare_dataset(s3_dataset_path, band, num_shards, direct_tfrecord)
+        store_dataset_in_cache(cache_key, s3_cache_path)
 
     # -----------------------downloading label_map.pbtxt file --------------------------------------
 
@@ -155,6 +630,16 @@ def generate_training_data(s3_dataset_path, band):
 
 if __name__ == "__main__":
 
+    #logger
+    if os.path.exists(LOG_FILE_PATH):
+        os.remove(LOG_FILE_PATH)
+
+    logging.basicConfig(filename=LOG_FILE_PATH,
+                        filemode='a',
+                        format='%(asctime)s - %(message)s',
+                        level=logging.INFO,
+                        datefmt='%d-%b-%y %H:%M:%S')
+
     try:
         status = 'failure'
         # ----------------------------download training_config.json file from s3------------------
@@ -174,6 +659,9 @@ if __name__ == "__main__":
             LABLE_FILE_S3_PATH = meta_data_json['LABLE_FILE_S3_PATH']
             S3_LOG_FILE_UPLOAD_PATH = meta_data_json['S3_LOG_FILE_UPLOAD_PATH']
             S3_MODEL_UPLOAD_PATH = meta_data_json['S3_MODEL_UPLOAD_PATH']
+            RUN_IN_SUBPROCESS = meta_data_json.get('run_in_subprocess', False)
+            concurrent_evaluation_config = meta_data_json.get('concurrent_evaluation', {})
+            profiling_config = meta_data_json.get('profiling', {})
 
         # ----------------------download base model path and rename according to version------------
 
@@ -192,6 +680,9 @@ if __name__ == "__main__":
                 model_files_dir,
                 True)
 
+            # duplicates were skipped when the model was uploaded
+            restore_deduplicated_files(model_files_dir)
+
             checkpoint_txt_log_path = os.path.join(model_files_dir, 'training', 'checkpoint')
 
             res = ''
@@ -214,11 +705,35 @@ if __name__ == "__main__":
                 model_files_dir,
                 True)
 
+        # evaluation outputs of a transfer learned model belong to that model
+        eval_profile_path = os.path.join(model_files_dir, training_profiler.EVAL_PROFILE_FILE_NAME)
+        metrics_curve_path = os.path.join(model_files_dir, checkpoint_evaluator.METRICS_CURVE_FILE_NAME)
+        best_checkpoint_dir = os.path.join(model_files_dir, checkpoint_evaluator.BEST_CHECKPOINT_DIR_NAME)
+
+        for file_path in [eval_profile_path, metrics_curve_path]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        # profiles cost a json write per step and traced steps, they are opt-in
+        is_profiled = profiling_config.get('enabled', False)
+        trace_every_n_steps = profiling_config.get('trace_every_n_steps',
+                                                   training_profiler.TRACE_EVERY_N_STEPS)
+        if not is_profiled:
+            eval_profile_path = ''
+
+        if os.path.exists(best_checkpoint_dir):
+            shutil.rmtree(best_checkpoint_dir)
+
         # --------------------------- iteration over dataset and start training --------------------
         for iteration_no, dataset_info in enumerate(meta_data_json['dataset']):
 
             logging.info(f'Generate training data for {iteration_no}th iteration ')
-            generate_training_data(dataset_info['dataset_path'], meta_data_json['band'])
+            # fixed default shard count, it is part of the dataset cache key
+            generate_training_data(dataset_info['dataset_path'],
+                                   meta_data_json['band'],
+                                   meta_data_json.get('tfrecord_num_shards', 1),
+                                   meta_data_json.get('direct_tfrecord', False),
+                                   meta_data_json.get('dataset_cache_s3_path'))
 
             # ----------------------------------update config---------------------------------------
 
@@ -246,7 +761,16 @@ if __name__ == "__main__":
             pipeline.train_config.batch_size = meta_data_json['batch_size']
 
             pipeline.train_input_reader.label_map_path = LABEL_MAP_PATH
-            pipeline.train_input_reader.tf_record_input_reader.input_path[:] = [TRAIN_TFRECORD_PATH]
+
+            # input pipeline tuning from the config
+            input_reader_config = meta_data_json.get('input_reader', {})
+            apply_input_reader_config(pipeline.train_input_reader, input_reader_config)
+
+            train_record_pattern = TRAIN_TFRECORD_PATH + '*'
+            if input_reader_config.get('cache_in_memory'):
+                train_record_pattern = stage_records_in_memory(train_record_pattern)
+
+            pipeline.train_input_reader.tf_record_input_reader.input_path[:] = [train_record_pattern]
 
             df = pd.read_csv(TEST_CSV_PATH)
             unique_file_count = df['filename'].unique().size
@@ -261,7 +785,7 @@ if __name__ == "__main__":
             pipeline.eval_config.visualization_export_dir = vis_dir
 
             pipeline.eval_input_reader[0].label_map_path = LABEL_MAP_PATH
-            pipeline.eval_input_reader[0].tf_record_input_reader.input_path[:] = [TEST_TFRECORD_PATH]
+            pipeline.eval_input_reader[0].tf_record_input_reader.input_path[:] = [TEST_TFRECORD_PATH + '*']
 
             config_text = text_format.MessageToString(pipeline)
             with tf.gfile.Open(model_config_path, "wb") as f:
@@ -272,41 +796,127 @@ if __name__ == "__main__":
             print(f'iteration: {iteration_no}  :Start training..')
             logging.info(f'iteration: {iteration_no}  :Start training')
 
-            run_subprocess([
-                'python3',
-                'train.py',
-                '--logtostderr',
-                f'--train_dir={os.path.join(model_files_dir, "training")}',
-                f'--pipeline_config_path={model_config_path}'])
-
-            # ------------------------------------copying training checkpoints----------------------
-
-            print(f'iteration: {iteration_no}  :Copying checkpoint data...')
-            logging.info(f'iteration: {iteration_no}  :Copying checkpoint data')
+            training_start_time = time.time()
+
+            # per step profile next to the checkpoints, one file per iteration
+            train_profile_path = os.path.join(model_files_dir,
+                                              f'{iteration_no}_{training_profiler.TRAIN_PROFILE_FILE_NAME}')
+            if os.path.exists(train_profile_path):
+                os.remove(train_profile_path)
+            if not is_profiled:
+                train_profile_path = ''
+
+            evaluator_process = None
+            if concurrent_evaluation_config.get('enabled'):
+                evaluator_process = start_checkpoint_evaluator(model_files_dir,
+                                                               model_config_path,
+                                                               iteration_no,
+                                                               concurrent_evaluation_config,
+                                                               eval_profile_path)
+
+            try:
+                run_stage([
+                    'python3',
+                    'train.py',
+                    '--logtostderr',
+                    f'--train_dir={os.path.join(model_files_dir, "training")}',
+                    f'--pipeline_config_path={model_config_path}',
+                    f'--profile_path={train_profile_path}',
+                    f'--trace_every_n_steps={trace_every_n_steps}'],
+                          train.train,
+                          {'train_dir': os.path.join(model_files_dir, "training"),
+                           'pipeline_config_path': model_config_path,
+                           'configs': config_util.create_configs_from_pipeline_proto(pipeline),
+                           'profile_path': train_profile_path,
+                           'trace_every_n_steps': trace_every_n_steps})
+            except BaseException:
+                # the training error is raised, not masked by the evaluator
+                if evaluator_process is not None:
+                    terminate_checkpoint_evaluator(evaluator_process)
+                raise
+
+            # the test records of this iteration are replaced by the next one
+            if evaluator_process is not None:
+                stop_checkpoint_evaluator(evaluator_process, model_files_dir)
+
+            # stage level throughput, includes graph building and checkpoint restore
+            training_time = time.time() - training_start_time
+            images_per_sec = dataset_info['training_steps'] * meta_data_json['batch_size'] / training_time
+            print(f'iteration: {iteration_no}  :Training throughput {images_per_sec:.2f} images/sec')
+            logging.info(f'iteration: {iteration_no}  :Training throughput {images_per_sec:.2f} images/sec '
+                         f"({dataset_info['training_steps']} steps of batch size "
+                         f"{meta_data_json['batch_size']} in {training_time:.1f} s)")
+            if train_profile_path:
+                logging.info(f'iteration: {iteration_no}  :Training profile '
+                             f'{json.dumps(training_profiler.summarize_train_profile(train_profile_path))}')
+
+            if os.path.exists(IN_MEMORY_DATASET_DIR_PATH):
+                shutil.rmtree(IN_MEMORY_DATASET_DIR_PATH)
+
+            # -----------------------------------snapshot training checkpoint----------------------
+
+            print(f'iteration: {iteration_no}  :Snapshotting checkpoint data...')
+            logging.info(f'iteration: {iteration_no}  :Snapshotting checkpoint data')
 
             chk_dir_path = os.path.join(model_files_dir,
                                          f"{iteration_no}_checkpoint_{meta_data_json['model_architecture']}")
 
-            if os.path.exists(chk_dir_path):
-                shutil.rmtree(chk_dir_path)
-
-            shutil.copytree(os.path.join(model_files_dir, 'training'), chk_dir_path)
+            snapshot_training_dir(os.path.join(model_files_dir, 'training'), chk_dir_path)
 
 
         shutil.rmtree(chk_dir_path) #delete latest checkpoint as it is same as in training dir
 
-        # --------------------------------running evaluation for latest checkpoints-----------------
+        # ------------------running evaluation for latest checkpoint if not evaluated yet-----------
+
+        # only checkpoints of the last iteration, earlier ones were scored on other test sets
+        best_records = checkpoint_evaluator.get_best_records(
+            checkpoint_evaluator.get_iteration_records(
+                checkpoint_evaluator.read_metrics_curve(metrics_curve_path), iteration_no),
+            concurrent_evaluation_config.get('metric', checkpoint_evaluator.DEFAULT_METRIC),
+            1)
+
+        if best_records:
+            # already evaluated while training, the best checkpoint is exported
+            print(f"Best checkpoint {best_records[0]['checkpoint']} of iteration "
+                  f"{best_records[0]['iteration_no']}")
+            logging.info(f"Best checkpoint {json.dumps(best_records[0])}")
 
-        print('Running evaluation...')
-        logging.info('Running evaluation')
-        run_subprocess([
-            'python3',
-            'modified_eval.py',
-            '--logtostderr',
-            f'--pipeline_config_path={model_config_path}',
-            f'--checkpoint_dir={os.path.join(model_files_dir, "training")}',
-            f'--eval_dir={os.path.join(model_files_dir, "eval")}',
-            f'--output_json_path={os.path.join(model_files_dir, "evaluation_results.json")}'])
+            with open(os.path.join(model_files_dir, "evaluation_results.json"), 'w') as op_json_file:
+                json.dump({key: str(value) for key, value in best_records[0]['metrics'].items()},
+                          op_json_file)
+
+            trained_checkpoint_prefix = os.path.join(best_checkpoint_dir,
+                                                     best_records[0]['checkpoint'])
+
+        else:
+            print('Running evaluation...')
+            logging.info('Running evaluation')
+
+            run_stage([
+                'python3',
+                'modified_eval.py',
+                '--logtostderr',
+                f'--pipeline_config_path={model_config_path}',
+                f'--checkpoint_dir={os.path.join(model_files_dir, "training")}',
+                f'--eval_dir={os.path.join(model_files_dir, "eval")}',
+                f'--output_json_path={os.path.join(model_files_dir, "evaluation_results.json")}',
+                f'--profile_path={eval_profile_path}'],
+                      modified_eval.evaluate,
+                      {'checkpoint_dir': os.path.join(model_files_dir, "training"),
+                       'eval_dir': os.path.join(model_files_dir, "eval"),
+                       'output_json_path': os.path.join(model_files_dir, "evaluation_results.json"),
+                       'pipeline_config_path': model_config_path,
+                       'configs': config_util.create_configs_from_pipeline_proto(pipeline),
+                       'profile_path': eval_profile_path})
+
+            max_checkpoint_number = max([int(file_name.split('.')[1].split('-')[-1])
+                                         for file_name in os.listdir(os.path.join(model_files_dir,
+                                                                                  'training'))
+                                         if file_name.endswith(('.index'))])
+
+            trained_checkpoint_prefix = os.path.join(model_files_dir,
+                                                     'training',
+                                                     f"model.ckpt-{max_checkpoint_number}")
 
         # ----------------------------------freeze model-------------------------------------------
 
@@ -314,21 +924,17 @@ if __name__ == "__main__":
         logging.info('Freezing model graph')
         pipeline_config_path = os.path.join(model_files_dir, 'training', 'pipeline.config')
 
-        max_checkpoint_number = max([int(file_name.split('.')[1].split('-')[-1])
-                                     for file_name in os.listdir(os.path.join(model_files_dir,
-                                                                              'training'))
-                                     if file_name.endswith(('.index'))])
-
-        trained_checkpoint_prefix = os.path.join(model_files_dir,
-                                                 'training',
-                                                 f"model.ckpt-{max_checkpoint_number}")
-
-        run_subprocess(['python3',
-                        'export_inference_graph.py',
-                        '--input_type=image_tensor',
-                        f'--pipeline_config_path={pipeline_config_path}',
-                        f'--trained_checkpoint_prefix={trained_checkpoint_prefix}',
-                        f'--output_directory={os.path.join(model_files_dir, "output_inference_graph")}'])
+        run_stage(['python3',
+                   'export_inference_graph.py',
+                   '--input_type=image_tensor',
+                   f'--pipeline_config_path={pipeline_config_path}',
+                   f'--trained_checkpoint_prefix={trained_checkpoint_prefix}',
+                   f'--output_directory={os.path.join(model_files_dir, "output_inference_graph")}'],
+                  export_inference_graph.export,
+                  {'pipeline_config_path': pipeline_config_path,
+                   'trained_checkpoint_prefix': trained_checkpoint_prefix,
+                   'output_directory': os.path.join(model_files_dir, "output_inference_graph"),
+                   'input_type': 'image_tensor'})
 
         # ---------------------------------creating meta file---------------------------------------
 
@@ -345,6 +951,16 @@ if __name__ == "__main__":
                 meta_txt_file.write(f'dataset_path_{index}:{dataset_info["dataset_path"]}\n')
                 meta_txt_file.write(f'training_steps_{index}:{dataset_info["training_steps"]}\n')
 
+                train_profile_path = os.path.join(model_files_dir,
+                                                  f'{index}_{training_profiler.TRAIN_PROFILE_FILE_NAME}')
+                if os.path.exists(train_profile_path):
+                    meta_txt_file.write(f'training_profile_{index}:'
+                                        f'{json.dumps(training_profiler.summarize_train_profile(train_profile_path))}\n')
+
+            if eval_profile_path and os.path.exists(eval_profile_path):
+                meta_txt_file.write(f'evaluation_profile:'
+                                    f'{json.dumps(training_profiler.summarize_eval_profile(eval_profile_path))}\n')
+
         # --------------------------------remove unnecessary files ---------------------------------
 
         print('Removing base folder...')
@@ -362,9 +978,8 @@ if __name__ == "__main__":
 
         print('Uploading training files to s3...')
         logging.info('Uploading training files to s3')
-        s3_data_transfer(model_files_dir,
-                         's3://'+ S3_MODEL_UPLOAD_PATH + '/' + model_files_dir.split('/')[-1],
-                         True)
+        upload_deduplicated_dir(model_files_dir,
+                                's3://'+ S3_MODEL_UPLOAD_PATH + '/' + model_files_dir.split('/')[-1])
 
         status = 'success'
 
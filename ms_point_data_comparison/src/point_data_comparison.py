@@ -8,15 +8,23 @@
             --actual_shp_file=<PATH_TO_THE_ACTUAL_SHAPE_FILE>\
             --predicted_shp_file=<PATH TO THE PREDICTED SHAPE FILE>\
             --threshold=<RADIUS_OF_AREA_IN WHICH_TREES_WILL_BE_SEARCHED>\
-            --output_dir=<PATH TO THE OUTPUT DIRECTORY>
+            --output_dir=<PATH TO THE OUTPUT DIRECTORY>\
+            --matching=<OPTIONAL greedy OR optimal default is greedy>\
+            --tile_size=<OPTIONAL SIDE OF THE SEARCH TILES default is 0 (no tiling)>\
+            --num_workers=<OPTIONAL NUMBER OF TILE WORKERS default is cpu count>\
+            --radius_sweep=<OPTIONAL COMMA SEPARATED RADII e.g. 1,2,3,4,5>
     -> Output:
         - Line shape files from actual to predicted point for the nearest tree
+        - radius_sweep.json and radius_sweep.csv with the metrics of every radius of the sweep
 """
 
+import csv
+import itertools
+import json
 import math
+import multiprocessing
 import os
 import sys
-import shutil
 
 import argparse
 import fiona
@@ -24,16 +32,22 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 
-from scipy.spatial.distance import cdist
-from shapely.geometry import LineString, box, mapping
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import bmat, coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components, reverse_cuthill_mckee
+from scipy.spatial import cKDTree
 from tqdm import tqdm
 
 # constants
 CRS = 'EPSG:32631'
-TEMP_DIR_PATH = '../temp'
-ACTUAL_SHAPE_FILE_LOCAL_PATH = os.path.join(TEMP_DIR_PATH, 'actual.shp')
-PREDICTED_SHAPE_FILE_LOCAL_PATH = os.path.join(TEMP_DIR_PATH, 'predicted.shp')
+COMMON_AREA_MARGIN = 3
 GRAPH_RESCALE_FACTOR = 1000
+HEXBIN_GRID_SIZE = 100
+# largest number of actual points solved in one dense assignment
+MAX_ASSIGNMENT_SIZE = 1000
+WINDOW_PASSES = 2
+# features reprojected at once when a layer is streamed with --tile_size
+READ_CHUNK_SIZE = 100000
 
 
 def arguments():
@@ -54,125 +68,723 @@ def arguments():
     parser.add_argument("--output_dir",
                         help="Path to the output_dir",
                         type=str)
+    parser.add_argument("--matching",
+                        help="greedy: nearest match in order of actual points, "
+                             "optimal: globally optimal one-to-one matching",
+                        type=str, default='greedy', choices=['greedy', 'optimal'])
+    parser.add_argument("--tile_size",
+                        help="Side of the tiles candidate pairs are searched in, the layers "
+                             "are streamed and only their coordinates kept, "
+                             "0 loads both layers completely",
+                        type=float, default=0)
+    parser.add_argument("--num_workers",
+                        help="Number of processes searching tiles, default is cpu count",
+                        type=int, default=None)
+    parser.add_argument("--radius_sweep",
+                        help="Comma separated radii to report precision/recall/F1 for, "
+                             "the line shape file is still generated for --threshold only",
+                        type=lambda value: [float(radius) for radius in value.split(',') if radius],
+                        default=[])
 
     return vars(parser.parse_args())
 
-if __name__ == "__main__":
-    args = arguments()
+def get_common_bounds(actual_bounds, predicted_bounds):
+    '''
+        Method to find the intersection of two extents
+        params:
+            actual_bounds : (minx, miny, maxx, maxy) of the actual points
+            predicted_bounds : (minx, miny, maxx, maxy) of the predicted points
+        return (minx, miny, maxx, maxy) of the common area
+    '''
+    minx = max(actual_bounds[0], predicted_bounds[0])
+    miny = max(actual_bounds[1], predicted_bounds[1])
+    maxx = min(actual_bounds[2], predicted_bounds[2])
+    maxy = min(actual_bounds[3], predicted_bounds[3])
 
-    if os.path.exists(TEMP_DIR_PATH):
-        shutil.rmtree(TEMP_DIR_PATH)
+    if minx > maxx or miny > maxy:
+        raise Exception('Error: actual and predicted shape files do not overlap')
 
-    os.makedirs(TEMP_DIR_PATH)
+    return minx, miny, maxx, maxy
 
-    if not os.path.exists(args['output_dir']):
-        os.makedirs(args['output_dir'])
+def crop_to_bounds(gdf, bounds, margin=0):
+    '''
+        Method to keep the features whose bounding box intersects bounds,
+        same selection as gpd.read_file(bbox=...) but in memory and vectorized
+        params:
+            gdf : GeoDataFrame to crop
+            bounds : (minx, miny, maxx, maxy) to crop to
+            margin : distance the bounds are extended by on every side
+        return cropped GeoDataFrame
+    '''
+    minx, miny, maxx, maxy = bounds
+    feature_bounds = gdf.geometry.bounds
+
+    is_inside = ((feature_bounds['minx'].values <= maxx + margin)
+                 & (feature_bounds['maxx'].values >= minx - margin)
+                 & (feature_bounds['miny'].values <= maxy + margin)
+                 & (feature_bounds['maxy'].values >= miny - margin))
+
+    return gdf[is_inside]
+
+def get_candidate_pairs(actual_xy, predicted_xy, radius):
+    '''
+        Method to find all (actual, predicted) point pairs within radius using a kd-tree
+        params:
+            actual_xy : array of shape (n, 2) of actual points
+            predicted_xy : array of shape (m, 2) of predicted points
+            radius : search radius
+        return (actual_index, predicted_index, distance) arrays sorted by actual index,
+        then distance, then predicted index
+    '''
+    if len(actual_xy) == 0 or len(predicted_xy) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    # query a hair wider, the exact cut is done below on distances computed like cdist does
+    neighbor_lists = cKDTree(predicted_xy).query_ball_point(actual_xy,
+                                                            radius * (1 + 1e-9) + 1e-12)
+
+    neighbor_counts = np.fromiter(map(len, neighbor_lists), dtype=np.int64,
+                                  count=len(neighbor_lists))
+    actual_index = np.repeat(np.arange(len(actual_xy)), neighbor_counts)
+    predicted_index = np.fromiter(itertools.chain.from_iterable(neighbor_lists),
+                                  dtype=np.int64,
+                                  count=neighbor_counts.sum())
+
+    distance = np.sqrt(((actual_xy[actual_index] - predicted_xy[predicted_index]) ** 2).sum(axis=1))
+
+    within_radius = distance <= radius
+    actual_index = actual_index[within_radius]
+    predicted_index = predicted_index[within_radius]
+    distance = distance[within_radius]
+
+    order = np.lexsort((predicted_index, distance, actual_index))
+    return actual_index[order], predicted_index[order], distance[order]
+
+def match_greedy(actual_index, predicted_index, distance, total_predicted_points):
+    '''
+        Method to match every actual point, in order, to its nearest still unmatched
+        predicted point, ties go to the lowest predicted index
+        params:
+            actual_index, predicted_index, distance : sorted candidate pairs
+                                                      (see get_candidate_pairs)
+            total_predicted_points : number of predicted points
+        return (actual_index, predicted_index, distance) arrays of the matches
+    '''
+    match_list = get_greedy_match_list(actual_index, predicted_index, total_predicted_points)
+    return actual_index[match_list], predicted_index[match_list], distance[match_list]
+
+def get_greedy_match_list(actual_index, predicted_index, total_predicted_points):
+    '''
+        return positions of the greedy matches in the sorted candidate pairs (see match_greedy)
+    '''
+    is_matched = np.zeros(total_predicted_points, dtype=bool)
+    match_list = []
+
+    # candidates of an actual point are contiguous and sorted by distance
+    group_starts = np.flatnonzero(np.r_[True, actual_index[1:] != actual_index[:-1]]) \
+        if len(actual_index) else np.empty(0, dtype=np.int64)
+    group_ends = np.r_[group_starts[1:], len(actual_index)]
+
+    predicted_index_list = predicted_index.tolist()
+
+    for group_start, group_end in zip(group_starts.tolist(), group_ends.tolist()):
+        for pair_no in range(group_start, group_end):
+            if not is_matched[predicted_index_list[pair_no]]:
+                is_matched[predicted_index_list[pair_no]] = True
+                match_list.append(pair_no)
+                break
+
+    return np.array(match_list, dtype=np.int64)
+
+def assign_pairs(pairs, actual_index, predicted_index, distance):
+    '''
+        Method to solve the min-cost assignment of a set of candidate pairs densely
+        params:
+            pairs : indexes of the candidate pairs
+            actual_index, predicted_index, distance : candidate pairs (see get_candidate_pairs)
+        return indexes of the assigned pairs
+    '''
+    if len(pairs) == 1:
+        return pairs
+
+    rows, row_no = np.unique(actual_index[pairs], return_inverse=True)
+    columns, column_no = np.unique(predicted_index[pairs], return_inverse=True)
+
+    # every pair earns a bonus larger than any total distance of the pairs
+    # so that the number of matches is maximized before the distance is minimized
+    bonus = distance[pairs].sum() + 1.
+    cost = np.zeros((len(rows), len(columns)))
+    cost[row_no, column_no] = distance[pairs] - bonus
+    pair_lookup = np.full((len(rows), len(columns)), -1, dtype=np.int64)
+    pair_lookup[row_no, column_no] = pairs
+
+    assigned_rows, assigned_columns = linear_sum_assignment(cost)
+    assigned_pairs = pair_lookup[assigned_rows, assigned_columns]
+
+    # assignments outside of the candidate graph are no matches
+    return assigned_pairs[assigned_pairs >= 0]
+
+def match_large_component(pairs, actual_index, predicted_index, distance, window_size):
+    '''
+        Method to match a connected component too large for one dense assignment.
+        Starting from the greedy matching, windows of window_size actual points, ordered
+        by reverse Cuthill-McKee so that a window holds neighbouring points, are
+        re-assigned one after the other with their own and the free predicted points.
+        A window never loses matches and never increases the distance at the same
+        number of matches, the result is near the optimum but not guaranteed to reach it
+        params:
+            pairs : indexes of the candidate pairs of the component, in candidate pair order
+            actual_index, predicted_index, distance : candidate pairs (see get_candidate_pairs)
+            window_size : maximum number of actual points of an assignment
+        return indexes of the matched pairs
+    '''
+    rows, row_no = np.unique(actual_index[pairs], return_inverse=True)
+    columns, column_no = np.unique(predicted_index[pairs], return_inverse=True)
+
+    # greedy matching to start from, the pairs keep the candidate pair order
+    greedy_pairs = get_greedy_match_list(row_no, column_no, len(columns))
+
+    row_pair = np.full(len(rows), -1, dtype=np.int64)
+    row_pair[row_no[greedy_pairs]] = pairs[greedy_pairs]
+
+    column_owner = np.full(len(columns), -1, dtype=np.int64)
+    column_owner[column_no[greedy_pairs]] = row_no[greedy_pairs]
+
+    candidate_graph = csr_matrix((np.ones(len(pairs)), (row_no, column_no)),
+                                 shape=(len(rows), len(columns)))
+
+    undirected_graph = bmat([[None, candidate_graph], [candidate_graph.T, None]], format='csr')
+    node_order = reverse_cuthill_mckee(undirected_graph, symmetric_mode=True)
+    row_order = node_order[node_order < len(rows)]
+
+    row_rank = np.empty(len(rows), dtype=np.int64)
+    row_rank[row_order] = np.arange(len(rows))
+
+    # pairs sorted by the rank of their row, a window is a slice of them
+    rank_order = np.argsort(row_rank[row_no], kind='stable')
+    pair_ranks = row_rank[row_no][rank_order]
+
+    # windows overlap by half so that points at a window border are re-assigned again
+    window_step = max(window_size // 2, 1)
+
+    for _ in range(WINDOW_PASSES):
+        for window_start in range(0, max(len(rows) - window_size, 0) + window_step, window_step):
+            window_end = window_start + window_size
+            window_pairs = rank_order[np.searchsorted(pair_ranks, window_start):
+                                      np.searchsorted(pair_ranks, window_end)]
+
+            # pairs to predicted points that are free or owned by a window row
+            pair_owner = column_owner[column_no[window_pairs]]
+            owner_rank = row_rank[np.maximum(pair_owner, 0)]
+            window_pairs = window_pairs[(pair_owner < 0)
+                                        | ((owner_rank >= window_start) & (owner_rank < window_end))]
+
+            assigned_pairs = assign_pairs(pairs[window_pairs], actual_index, predicted_index,
+                                          distance)
+            assigned_positions = window_pairs[np.isin(pairs[window_pairs], assigned_pairs)]
+
+            column_owner[column_no[window_pairs]] = -1
+            row_pair[row_no[window_pairs]] = -1
+            column_owner[column_no[assigned_positions]] = row_no[assigned_positions]
+            row_pair[row_no[assigned_positions]] = pairs[assigned_positions]
+
+    return row_pair[row_pair >= 0]
+
+def match_optimal(actual_index, predicted_index, distance,
+                  total_actual_points, total_predicted_points):
+    '''
+        Method to find the one-to-one matching with the most matches and, among those,
+        the smallest total distance, it does not depend on the order of the points.
+        The candidate pairs form a sparse bipartite graph, every connected component
+        of it is solved on its own with a min-cost assignment. Components of more than
+        MAX_ASSIGNMENT_SIZE actual points (dense canopy with a threshold close to the
+        tree spacing) are matched near optimally in bounded windows, see
+        match_large_component
+        params:
+            actual_index, predicted_index, distance : candidate pairs (see get_candidate_pairs)
+            total_actual_points : number of actual points
+            total_predicted_points : number of predicted points
+        return (actual_index, predicted_index, distance) arrays of the matches
+        sorted by actual index
+    '''
+    if not len(actual_index):
+        return actual_index, predicted_index, distance
+
+    # graph nodes are the actual points followed by the predicted points
+    total_nodes = total_actual_points + total_predicted_points
+    candidate_graph = coo_matrix((np.ones(len(actual_index)),
+                                  (actual_index, total_actual_points + predicted_index)),
+                                 shape=(total_nodes, total_nodes))
+    _, component_labels = connected_components(candidate_graph, directed=False)
+
+    pair_order = np.argsort(component_labels[actual_index], kind='stable')
+    pair_components = component_labels[actual_index][pair_order]
+    component_starts = np.flatnonzero(np.r_[True, pair_components[1:] != pair_components[:-1]])
+    component_ends = np.r_[component_starts[1:], len(pair_order)]
+
+    match_list = []
+
+    for component_start, component_end in zip(component_starts, component_ends):
+        component_pairs = pair_order[component_start:component_end]
+
+        if len(np.unique(actual_index[component_pairs])) <= MAX_ASSIGNMENT_SIZE:
+            match_list.append(assign_pairs(component_pairs, actual_index, predicted_index,
+                                           distance))
+            continue
+
+        print(f'Warning: {len(np.unique(actual_index[component_pairs]))} actual points are '
+              f'linked by the threshold, matching them in windows of {MAX_ASSIGNMENT_SIZE} '
+              f'(near optimal)')
+
+        match_list.append(match_large_component(component_pairs, actual_index, predicted_index,
+                                                distance, MAX_ASSIGNMENT_SIZE))
+
+    match_list = np.concatenate(match_list)
+    match_list = match_list[np.argsort(actual_index[match_list], kind='stable')]
+    return actual_index[match_list], predicted_index[match_list], distance[match_list]
+
+def match_candidate_pairs(candidate_pairs, radius, matching,
+                          total_actual_points, total_predicted_points):
+    '''
+        Method to match the candidate pairs within radius, the pairs can come from
+        a larger radius so that one kd-tree query serves several radii
+        params:
+            candidate_pairs : sorted candidate pairs (see get_candidate_pairs)
+            radius : search radius
+            matching : 'greedy' or 'optimal'
+            total_actual_points : number of actual points
+            total_predicted_points : number of predicted points
+        return (actual_index, predicted_index, distance) arrays of the matches
+    '''
+    actual_index, predicted_index, distance = candidate_pairs
+
+    # filtering keeps the sort order of the pairs
+    within_radius = distance <= radius
+    candidate_pairs = (actual_index[within_radius],
+                       predicted_index[within_radius],
+                       distance[within_radius])
+
+    if matching == 'optimal':
+        return match_optimal(*candidate_pairs, total_actual_points, total_predicted_points)
+
+    return match_greedy(*candidate_pairs, total_predicted_points)
+
+def match_points(actual_xy, predicted_xy, radius, matching):
+    '''
+        Method to match actual to predicted points within radius
+        params:
+            actual_xy : array of shape (n, 2) of actual points
+            predicted_xy : array of shape (m, 2) of predicted points
+            radius : search radius
+            matching : 'greedy' or 'optimal'
+        return (actual_index, predicted_index, distance) arrays of the matches
+    '''
+    return match_candidate_pairs(get_candidate_pairs(actual_xy, predicted_xy, radius),
+                                 radius, matching, len(actual_xy), len(predicted_xy))
 
+def get_sweep_metrics(actual_xy, predicted_xy, candidate_pairs, radius_list, matching):
+    '''
+        Method to compute the evaluation metrics for several radii out of one set of
+        candidate pairs
+        params:
+            actual_xy : array of shape (n, 2) of actual points
+            predicted_xy : array of shape (m, 2) of predicted points
+            candidate_pairs : sorted candidate pairs within the largest radius
+            radius_list : list of radii
+            matching : 'greedy' or 'optimal'
+        return list of metric dictionaries, one per radius in increasing order
+    '''
+    sweep_metrics = []
+
+    for radius in tqdm(sorted(radius_list), desc='Radius sweep', file=sys.stdout):
+        actual_index, predicted_index, distance = match_candidate_pairs(
+            candidate_pairs, radius, matching, len(actual_xy), len(predicted_xy))
+
+        matched_points = len(distance)
+        precision = matched_points / len(predicted_xy) if len(predicted_xy) else 0.
+        recall = matched_points / len(actual_xy) if len(actual_xy) else 0.
+        offset = predicted_xy[predicted_index] - actual_xy[actual_index]
+
+        sweep_metrics.append({
+            'radius': radius,
+            'matched_points': matched_points,
+            'precision': precision,
+            'recall': recall,
+            'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.,
+            'mean_offset': float(distance.mean()) if matched_points else None,
+            'bias_x': float(offset[:, 0].mean()) if matched_points else None,
+            'bias_y': float(offset[:, 1].mean()) if matched_points else None})
+
+    return sweep_metrics
+
+def write_sweep_report(sweep_metrics, output_dir):
+    '''
+        Method to write the radius sweep metrics as json and csv
+        params:
+            sweep_metrics : list of metric dictionaries (see get_sweep_metrics)
+            output_dir : path to the output directory
+    '''
+    with open(os.path.join(output_dir, 'radius_sweep.json'), 'w') as json_file_obj:
+        json.dump(sweep_metrics, json_file_obj, indent=4)
+
+    with open(os.path.join(output_dir, 'radius_sweep.csv'), 'w', newline='') as csv_file_obj:
+        writer = csv.DictWriter(csv_file_obj, fieldnames=list(sweep_metrics[0]))
+        writer.writeheader()
+        writer.writerows(sweep_metrics)
+
+def get_unique_points(point_xy):
+    '''
+        Method to remove duplicate points
+        params:
+            point_xy : array of shape (n, 2)
+        return array of shape (m, 2) in the order of the first occurrences
+    '''
+    _, first_index = np.unique(point_xy, axis=0, return_index=True)
+    first_index.sort()
+
+    return point_xy[first_index]
+
+def get_point_coordinates(gdf):
+    '''
+        Method to remove duplicate points and return their coordinates
+        params:
+            gdf : GeoDataFrame of points
+        return array of shape (n, 2) in the order of the first occurrences
+    '''
+    return get_unique_points(np.column_stack([gdf.geometry.x.to_numpy(),
+                                              gdf.geometry.y.to_numpy()]))
+
+def compare_points(actual_xy, predicted_xy, candidate_pairs, args):
+    '''
+        Method to write the radius sweep report and match the points within the threshold
+        params:
+            actual_xy : array of shape (n, 2) of unique actual points
+            predicted_xy : array of shape (m, 2) of unique predicted points
+            candidate_pairs : sorted candidate pairs within the largest radius
+            args : command line argument dictionary
+        return (total_actual_points, total_predicted_points,
+                matched_actual_xy, matched_predicted_xy, match_distance)
+    '''
+    if args['radius_sweep']:
+        print('Generating radius sweep report...')
+        write_sweep_report(get_sweep_metrics(actual_xy,
+                                             predicted_xy,
+                                             candidate_pairs,
+                                             args['radius_sweep'],
+                                             args['matching']),
+                           args['output_dir'])
+
+    # match points
+    print('Matching points...')
+    actual_match_index, predicted_match_index, match_distance = match_candidate_pairs(
+        candidate_pairs, args['threshold'], args['matching'], len(actual_xy), len(predicted_xy))
+
+    return (len(actual_xy),
+            len(predicted_xy),
+            actual_xy[actual_match_index],
+            predicted_xy[predicted_match_index],
+            match_distance)
+
+def compare_in_memory(args):
+    '''
+        Method to load both point sets completely and match them
+        params:
+            args : command line argument dictionary
+        return (total_actual_points, total_predicted_points,
+                matched_actual_xy, matched_predicted_xy, match_distance)
+    '''
     # load data
     print('Loading df...')
     actual_df = gpd.read_file(args['actual_shp_file']).to_crs(CRS)
     predicted_df = gpd.read_file(args['predicted_shp_file']).to_crs(CRS)
 
-    # save the df and reopen with fiona to find the extent
-    actual_df.to_file(ACTUAL_SHAPE_FILE_LOCAL_PATH, driver='ESRI Shapefile')
-    predicted_df.to_file(PREDICTED_SHAPE_FILE_LOCAL_PATH, driver='ESRI Shapefile')
-
+    # find the intersection area of two shape files
     print('Extracting extent information...')
-    with fiona.open(ACTUAL_SHAPE_FILE_LOCAL_PATH, 'r') as shp_file:
-        actual_extent = shp_file.bounds
-    with fiona.open(PREDICTED_SHAPE_FILE_LOCAL_PATH, 'r') as shp_file:
-        pedicted_extent = shp_file.bounds
+    common_area = get_common_bounds(actual_df.total_bounds, predicted_df.total_bounds)
 
-    # find the intersection area of two shape files
-    actual_polygon_obj = box(actual_extent[0],
-                             actual_extent[1],
-                             actual_extent[2],
-                             actual_extent[3])
+    # keep only the common area, predicted points with a margin of 3 meters
+    print('Extracting common area data...')
+    actual_df = crop_to_bounds(actual_df, common_area)
+    predicted_df = crop_to_bounds(predicted_df, common_area, COMMON_AREA_MARGIN)
 
-    predicted_polygon_obj = box(pedicted_extent[0],
-                                pedicted_extent[1],
-                                pedicted_extent[2],
-                                pedicted_extent[3])
+    # remove duplicates and load points data in a list
+    print('Removing duplicates...')
+    actual_data_np_array = get_point_coordinates(actual_df)
+    predicted_data_np_array = get_point_coordinates(predicted_df)
 
-    common_area = actual_polygon_obj.intersection(predicted_polygon_obj)
-    x_coor, y_coor = common_area.exterior.coords.xy
+    # one kd-tree query serves the threshold and every radius of the sweep
+    print('Finding candidate pairs...')
+    candidate_pairs = get_candidate_pairs(actual_data_np_array,
+                                          predicted_data_np_array,
+                                          max(args['radius_sweep'] + [args['threshold']]))
 
-    # load geopandas df again only for common area
-    #  adding margin of 3 meters
-    print('Extracting common area data...')
-    actual_df = gpd.read_file(ACTUAL_SHAPE_FILE_LOCAL_PATH,
-                              bbox=(min(x_coor), min(y_coor), max(x_coor), max(y_coor)))
+    return compare_points(actual_data_np_array, predicted_data_np_array, candidate_pairs, args)
 
-    predicted_df = gpd.read_file(PREDICTED_SHAPE_FILE_LOCAL_PATH,
-                                 bbox=(min(x_coor) - 3, min(y_coor) - 3, max(x_coor) + 3, max(y_coor) + 3))
+def read_point_coordinates(shp_file_path):
+    '''
+        Method to stream the points of a layer once, READ_CHUNK_SIZE features at a time
+        are reprojected to CRS, only the coordinates are kept
+        params:
+            shp_file_path : path to the shape file
+        return array of shape (n, 2) in CRS in the order of the features
+    '''
+    chunk_list = []
 
-    # remove duplicates and load points data in a list
+    with fiona.open(shp_file_path) as shp_file:
+        layer_crs = shp_file.crs
+        features = iter(shp_file)
+
+        while True:
+            feature_list = list(itertools.islice(features, READ_CHUNK_SIZE))
+            if not feature_list:
+                break
+
+            layer_xy = np.array([feature['geometry']['coordinates'][:2]
+                                 for feature in feature_list], dtype=np.float64)
+            points = gpd.GeoSeries(gpd.points_from_xy(layer_xy[:, 0], layer_xy[:, 1]),
+                                   crs=layer_crs).to_crs(CRS)
+            chunk_list.append(np.column_stack([points.x.to_numpy(), points.y.to_numpy()]))
+
+    return np.concatenate(chunk_list + [np.empty((0, 2))])
+
+def get_point_bounds(point_xy):
+    '''
+        return (minx, miny, maxx, maxy) of points, nan if there are none like total_bounds
+    '''
+    if not len(point_xy):
+        return (np.nan,) * 4
+
+    return (*point_xy.min(axis=0), *point_xy.max(axis=0))
+
+def crop_points(point_xy, bounds, margin=0):
+    '''
+        Method to keep the points inside bounds, same selection as crop_to_bounds
+        params:
+            point_xy : array of shape (n, 2)
+            bounds : (minx, miny, maxx, maxy) to crop to
+            margin : distance the bounds are extended by on every side
+        return cropped array
+    '''
+    minx, miny, maxx, maxy = bounds
+
+    is_inside = ((point_xy[:, 0] <= maxx + margin)
+                 & (point_xy[:, 0] >= minx - margin)
+                 & (point_xy[:, 1] <= maxy + margin)
+                 & (point_xy[:, 1] >= miny - margin))
+
+    return point_xy[is_inside]
+
+class TileGrid():
+    '''
+        Actual and predicted points bucketed by square tiles of the actual extent,
+        points of a tile are a slice of the points sorted by tile number
+    '''
+    def __init__(self, actual_xy, predicted_xy, tile_size, radius):
+        self.actual_xy = actual_xy
+        self.predicted_xy = predicted_xy
+        self.tile_size = tile_size
+        self.radius = radius
+
+        self.extent = get_point_bounds(actual_xy)
+        self.total_columns = max(int(math.ceil((self.extent[2] - self.extent[0]) / tile_size)), 1)
+        self.total_rows = max(int(math.ceil((self.extent[3] - self.extent[1]) / tile_size)), 1)
+
+        # one tile more than the radius spans, covers rounding at the tile edges
+        self.reach = int(radius // tile_size) + 1
+
+        actual_tile = self.get_tile_numbers(actual_xy)
+        self.actual_order = np.argsort(actual_tile, kind='stable')
+        self.actual_tile = actual_tile[self.actual_order]
+
+        predicted_tile = self.get_tile_numbers(predicted_xy)
+        self.predicted_order = np.argsort(predicted_tile, kind='stable')
+        self.predicted_tile = predicted_tile[self.predicted_order]
+
+    def get_tile_numbers(self, point_xy):
+        '''
+            return row major tile numbers of points, points outside the extent go to
+            the tiles at its edge
+        '''
+        columns = np.clip((point_xy[:, 0] - self.extent[0]) // self.tile_size,
+                          0, self.total_columns - 1).astype(np.int64)
+        rows = np.clip((point_xy[:, 1] - self.extent[1]) // self.tile_size,
+                       0, self.total_rows - 1).astype(np.int64)
+
+        return rows * self.total_columns + columns
+
+    def get_tile_list(self):
+        '''
+            return numbers of the tiles with actual points
+        '''
+        return np.unique(self.actual_tile).tolist()
+
+    def get_candidate_pairs(self, tile_no):
+        '''
+            Method to find the candidate pairs of the actual points of a tile against
+            the predicted points of the tiles within reach
+            params:
+                tile_no : number of the tile
+            return (actual_index, predicted_index, distance) arrays with indexes of all points
+        '''
+        actual_index = self.actual_order[np.searchsorted(self.actual_tile, tile_no):
+                                         np.searchsorted(self.actual_tile, tile_no, side='right')]
+
+        row, column = divmod(tile_no, self.total_columns)
+        first_column = max(column - self.reach, 0)
+        last_column = min(column + self.reach, self.total_columns - 1)
+
+        # every row of neighbour tiles is a slice of the predicted points
+        predicted_index = np.concatenate(
+            [self.predicted_order[
+                np.searchsorted(self.predicted_tile, neighbour_row * self.total_columns + first_column):
+                np.searchsorted(self.predicted_tile, neighbour_row * self.total_columns + last_column,
+                                side='right')]
+             for neighbour_row in range(max(row - self.reach, 0),
+                                        min(row + self.reach, self.total_rows - 1) + 1)])
+
+        tile_actual_index, tile_predicted_index, distance = get_candidate_pairs(
+            self.actual_xy[actual_index], self.predicted_xy[predicted_index], self.radius)
+
+        return actual_index[tile_actual_index], predicted_index[tile_predicted_index], distance
+
+# tile grid of a worker process, set by set_tile_grid
+worker_tile_grid = None
+
+def set_tile_grid(tile_grid):
+    '''
+        initializer of the worker processes
+    '''
+    global worker_tile_grid
+    worker_tile_grid = tile_grid
+
+def get_tile_candidate_pairs(tile_no):
+    '''
+        Method executed by a worker to find the candidate pairs of one tile
+    '''
+    return worker_tile_grid.get_candidate_pairs(tile_no)
+
+def get_tiled_candidate_pairs(actual_xy, predicted_xy, radius, tile_size, num_workers=None):
+    '''
+        Method to find the same candidate pairs as get_candidate_pairs tile by tile,
+        a kd-tree holds the predicted points of a few tiles only and tiles are searched
+        in parallel
+        params:
+            actual_xy : array of shape (n, 2) of actual points
+            predicted_xy : array of shape (m, 2) of predicted points
+            radius : search radius
+            tile_size : side of a tile
+            num_workers : number of processes, default is cpu count
+        return (actual_index, predicted_index, distance) arrays sorted like get_candidate_pairs
+    '''
+    if len(actual_xy) == 0 or len(predicted_xy) == 0:
+        return get_candidate_pairs(actual_xy, predicted_xy, radius)
+
+    tile_grid = TileGrid(actual_xy, predicted_xy, tile_size, radius)
+    tile_list = tile_grid.get_tile_list()
+
+    num_workers = num_workers or os.cpu_count()
+
+    if num_workers > 1 and len(tile_list) > 1:
+        with multiprocessing.Pool(num_workers, initializer=set_tile_grid,
+                                  initargs=(tile_grid,)) as pool:
+            tile_pairs = list(tqdm(pool.imap(get_tile_candidate_pairs, tile_list,
+                                             chunksize=max(len(tile_list) // (num_workers * 4), 1)),
+                                   total=len(tile_list),
+                                   desc='Searching tiles',
+                                   file=sys.stdout))
+    else:
+        tile_pairs = [tile_grid.get_candidate_pairs(tile_no)
+                      for tile_no in tqdm(tile_list, desc='Searching tiles', file=sys.stdout)]
+
+    # every actual point is in one tile, the pairs of all tiles are the pairs of all points
+    actual_index = np.concatenate([pairs[0] for pairs in tile_pairs])
+    predicted_index = np.concatenate([pairs[1] for pairs in tile_pairs])
+    distance = np.concatenate([pairs[2] for pairs in tile_pairs])
+
+    order = np.lexsort((predicted_index, distance, actual_index))
+    return actual_index[order], predicted_index[order], distance[order]
+
+def compare_tiled(args):
+    '''
+        Method to compare the points of layers too large to load as GeoDataFrames. Each
+        layer is streamed once and only its coordinates are kept, candidate pairs are
+        searched tile by tile in workers. The points are matched on the pairs of all
+        tiles, so components of candidate pairs crossing tile borders are matched whole
+        and the result is the same as compare_in_memory for any tile size
+        params:
+            args : command line argument dictionary
+        return (total_actual_points, total_predicted_points,
+                matched_actual_xy, matched_predicted_xy, match_distance)
+    '''
+    print('Reading points...')
+    actual_xy = read_point_coordinates(args['actual_shp_file'])
+    predicted_xy = read_point_coordinates(args['predicted_shp_file'])
+
+    print('Extracting extent information...')
+    common_area = get_common_bounds(get_point_bounds(actual_xy), get_point_bounds(predicted_xy))
+
+    # keep only the common area, predicted points with a margin of 3 meters
+    print('Extracting common area data...')
+    actual_xy = crop_points(actual_xy, common_area)
+    predicted_xy = crop_points(predicted_xy, common_area, COMMON_AREA_MARGIN)
+
+    # duplicates over the whole layers, like compare_in_memory
     print('Removing duplicates...')
-    actual_data_list = actual_df.drop_duplicates('geometry')['geometry'].to_list()
-    predicted_data_list = predicted_df.drop_duplicates('geometry')['geometry'].to_list()
-
-    actual_data_np_array = np.array(list(map(lambda point: (point.x, point.y), actual_data_list)))
-    predicted_data_np_array = np.array(list(map(lambda point: (point.x, point.y),
-                                                predicted_data_list)))
-
-    # decalre variables
-    total_dis_bw_two_pts = 0.0
-    result_line_obj_list = []
-    total_predicted_points = len(predicted_data_np_array)
-    x_coor_list = []
-    y_coor_list = []
-    quad_1 = 0
-    quad_2 = 0
-    quad_3 = 0
-    quad_4 = 0
-
-    for actual_point in tqdm(actual_data_np_array, desc='Processing', file=sys.stdout):
-
-        # calculate distance from actual point to all predicted points
-        dis_array = cdist([actual_point], predicted_data_np_array)[0]
-
-        min_dis = min(dis_array)
-
-        if min_dis <= args['threshold']:
-            total_dis_bw_two_pts += min_dis
-            min_dis_index = np.where(dis_array == min_dis)[0][0]
-            predicted_point = tuple(predicted_data_np_array[min_dis_index])
-
-            result_line_obj_list.append(LineString([actual_point,
-                                                    predicted_point]))
-            # storing x, y points in a list to draw graphs
-            x = (predicted_point[0] - actual_point[0]) * GRAPH_RESCALE_FACTOR
-            y = (predicted_point[1] - actual_point[1]) * GRAPH_RESCALE_FACTOR
-            x_coor_list.append(x)
-            y_coor_list.append(y)
-
-            if x > 0  and y > 0:
-                quad_1 += 1
-            elif x < 0 and y > 0:
-                quad_2 += 1
-            elif x < 0 and y < 0:
-                quad_3 += 1
-            elif x > 0 and y < 0:
-                quad_4 += 1
-
-            predicted_data_np_array = np.delete(predicted_data_np_array, min_dis_index, axis=0)
+    actual_xy = get_unique_points(actual_xy)
+    predicted_xy = get_unique_points(predicted_xy)
+
+    print('Finding candidate pairs...')
+    candidate_pairs = get_tiled_candidate_pairs(actual_xy,
+                                                predicted_xy,
+                                                max(args['radius_sweep'] + [args['threshold']]),
+                                                args['tile_size'],
+                                                args['num_workers'])
+
+    return compare_points(actual_xy, predicted_xy, candidate_pairs, args)
+
+if __name__ == "__main__":
+    args = arguments()
+
+    if not os.path.exists(args['output_dir']):
+        os.makedirs(args['output_dir'])
+
+    if args['tile_size']:
+        (total_actual_points, total_predicted_points,
+         matched_actual_xy, matched_predicted_xy, match_distance) = compare_tiled(args)
+    else:
+        (total_actual_points, total_predicted_points,
+         matched_actual_xy, matched_predicted_xy, match_distance) = compare_in_memory(args)
+
+    # offsets of all matches at once, rescaled for the graph
+    total_dis_bw_two_pts = match_distance.sum()
+    offset_xy = (matched_predicted_xy - matched_actual_xy) * GRAPH_RESCALE_FACTOR
+    x_coor_array = offset_xy[:, 0]
+    y_coor_array = offset_xy[:, 1]
+
+    quad_1 = int(((x_coor_array > 0) & (y_coor_array > 0)).sum())
+    quad_2 = int(((x_coor_array < 0) & (y_coor_array > 0)).sum())
+    quad_3 = int(((x_coor_array < 0) & (y_coor_array < 0)).sum())
+    quad_4 = int(((x_coor_array > 0) & (y_coor_array < 0)).sum())
+
+    x_coor_sum = float(x_coor_array.sum())
+    y_coor_sum = float(y_coor_array.sum())
 
     print('Generating result.txt...')
     result_file_path = os.path.join(args['output_dir'], 'result.txt')
 
     with open(result_file_path, 'w') as res_file_obj:
-        res_file_obj.write(f'Total actual points : {len(actual_data_np_array)}\n')
+        res_file_obj.write(f'Total actual points : {total_actual_points}\n')
         res_file_obj.write(f'Total predicted points : {total_predicted_points}\n')
-        res_file_obj.write(f'Total predicted points that are not near to any actual point : {len(predicted_data_np_array)}\n')
-        res_file_obj.write(f'Total actual points : {len(result_line_obj_list)}\n')
-        res_file_obj.write(f'Average distance : {total_dis_bw_two_pts/len(result_line_obj_list)}\n')
-        res_file_obj.write(f'Accuracy : {(len(result_line_obj_list)/ float(len(actual_data_np_array)))*100}\n')
+        res_file_obj.write(f'Total predicted points that are not near to any actual point : {total_predicted_points - len(match_distance)}\n')
+        res_file_obj.write(f'Total actual points : {len(match_distance)}\n')
+        res_file_obj.write(f'Average distance : {total_dis_bw_two_pts/len(match_distance)}\n')
+        res_file_obj.write(f'Accuracy : {(len(match_distance)/ float(total_actual_points))*100}\n')
         res_file_obj.write(f'Total points in quadrant 1 : {quad_1}\n')
         res_file_obj.write(f'Total points in quadrant 2 : {quad_2}\n')
         res_file_obj.write(f'Total points in quadrant 3 : {quad_3}\n')
         res_file_obj.write(f'Total points in quadrant 4 : {quad_4}\n')
-        res_file_obj.write(f'Resultant angle : {math.degrees(math.atan(sum(x_coor_list)/sum(y_coor_list)))}\n')
-        res_file_obj.write(f'Resultant magnitude : {math.sqrt(sum(x_coor_list)**2 + sum(y_coor_list)**2)/GRAPH_RESCALE_FACTOR}')
+        res_file_obj.write(f'Resultant angle : {math.degrees(math.atan(x_coor_sum/y_coor_sum))}\n')
+        res_file_obj.write(f'Resultant magnitude : {math.sqrt(x_coor_sum**2 + y_coor_sum**2)/GRAPH_RESCALE_FACTOR}')
 
     print('Creating shape file...')
     schema = {
@@ -185,15 +797,25 @@ if __name__ == "__main__":
                     crs=CRS,
                     driver='ESRI Shapefile',
                     schema=schema) as c:
-        for line_obj in result_line_obj_list:
-            c.write({
-                'geometry': mapping(line_obj),
-                'properties': {}})
-
+        c.writerecords([{
+            'geometry': {'type': 'LineString',
+                         'coordinates': [tuple(actual_point), tuple(predicted_point)]},
+            'properties': {}}
+                        for actual_point, predicted_point in zip(matched_actual_xy.tolist(),
+                                                                 matched_predicted_xy.tolist())])
+
+    # a density of the offsets instead of one line per match
     print('Generation plot image...')
     plt.figure(figsize=(20, 20))
-    plt.plot([[0]*len(x_coor_list), x_coor_list],
-             [[0]*len(y_coor_list), y_coor_list])
+    if len(match_distance):
+        plt.hexbin(x_coor_array, y_coor_array, gridsize=HEXBIN_GRID_SIZE, mincnt=1)
+        plt.colorbar(label='matches')
+    plt.axhline(0, color='grey', linewidth=1)
+    plt.axvline(0, color='grey', linewidth=1)
+    plt.plot([0, x_coor_sum / max(len(match_distance), 1)],
+             [0, y_coor_sum / max(len(match_distance), 1)],
+             color='red', label='mean offset')
+    plt.legend()
+    plt.xlabel('x offset')
+    plt.ylabel('y offset')
     plt.savefig(os.path.join(args['output_dir'], 'res.png'))
-
-    shutil.rmtree(TEMP_DIR_PATH)
@@ -137,7 +137,11 @@ if __name__ == "__main__":
             f'--actual_shp_file={actual_shp_file_path}',
             f'--predicted_shp_file={predicted_shp_file_path}',
             f'--threshold={config["threshold"]}',
-            f'--output_dir={OUTPUT_DIR}'])
+            f'--output_dir={OUTPUT_DIR}',
+            f'--matching={config.get("matching", "greedy")}',
+            f'--tile_size={config.get("tile_size", 0)}',
+            f'--num_workers={config.get("num_workers", os.cpu_count())}',
+            f'--radius_sweep={",".join(map(str, config.get("radius_sweep", [])))}'])
 
         # -----------------upload files to s3-------------------------------------------
         logging.info('Uploading results to s3')
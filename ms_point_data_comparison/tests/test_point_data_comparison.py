@@ -0,0 +1,157 @@
+'''
+    tests of the point matching of point_data_comparison.py
+    -> command to run (from ms_point_data_comparison):
+        python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import point_data_comparison as pdc
+
+GRID_SIZE = 40
+TREE_SPACING = 4.
+# a threshold above the tree spacing links the whole grid into one component
+THRESHOLD = 1.5 * TREE_SPACING
+
+def get_dense_canopy(seed=0):
+    '''
+        return (actual_xy, predicted_xy) of a dense grid of trees with jittered
+        predictions and a few missed and extra trees
+    '''
+    random_state = np.random.RandomState(seed)
+
+    grid = np.arange(GRID_SIZE) * TREE_SPACING
+    actual_xy = np.array(np.meshgrid(grid, grid)).reshape(2, -1).T
+    predicted_xy = actual_xy + random_state.uniform(-1.5, 1.5, actual_xy.shape)
+
+    predicted_xy = predicted_xy[random_state.rand(len(predicted_xy)) > 0.05]
+    extra_xy = random_state.uniform(0, GRID_SIZE * TREE_SPACING, (50, 2))
+
+    return actual_xy, np.concatenate([predicted_xy, extra_xy])
+
+def get_component_count(candidate_pairs, total_actual_points, total_predicted_points):
+    '''
+        return number of connected components of the candidate graph with pairs
+    '''
+    actual_index, predicted_index, _ = candidate_pairs
+    total_nodes = total_actual_points + total_predicted_points
+    candidate_graph = coo_matrix((np.ones(len(actual_index)),
+                                  (actual_index, total_actual_points + predicted_index)),
+                                 shape=(total_nodes, total_nodes))
+    _, component_labels = connected_components(candidate_graph, directed=False)
+
+    return len(np.unique(component_labels[actual_index]))
+
+def assert_valid_matching(matches, actual_xy, predicted_xy):
+    '''
+        assert the matches are one-to-one and within the threshold
+    '''
+    actual_index, predicted_index, distance = matches
+
+    assert len(np.unique(actual_index)) == len(actual_index)
+    assert len(np.unique(predicted_index)) == len(predicted_index)
+    assert np.all(distance <= THRESHOLD)
+    assert np.allclose(distance, np.sqrt(((actual_xy[actual_index]
+                                           - predicted_xy[predicted_index]) ** 2).sum(axis=1)))
+
+def test_large_single_component_is_matched_in_windows(monkeypatch):
+    actual_xy, predicted_xy = get_dense_canopy()
+    candidate_pairs = pdc.get_candidate_pairs(actual_xy, predicted_xy, THRESHOLD)
+
+    assert get_component_count(candidate_pairs, len(actual_xy), len(predicted_xy)) == 1
+
+    # reference is the exact dense solution of the whole component
+    monkeypatch.setattr(pdc, 'MAX_ASSIGNMENT_SIZE', len(actual_xy))
+    exact_matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'optimal')
+
+    monkeypatch.setattr(pdc, 'MAX_ASSIGNMENT_SIZE', 200)
+    window_matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'optimal')
+    greedy_matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'greedy')
+
+    assert_valid_matching(window_matches, actual_xy, predicted_xy)
+
+    # near the exact solution and never worse than the greedy start
+    assert len(window_matches[0]) >= len(greedy_matches[0])
+    assert len(window_matches[0]) >= 0.99 * len(exact_matches[0])
+    assert window_matches[2].mean() <= 1.3 * exact_matches[2].mean()
+
+def test_windows_bound_the_assignment_size(monkeypatch):
+    actual_xy, predicted_xy = get_dense_canopy(seed=1)
+
+    monkeypatch.setattr(pdc, 'MAX_ASSIGNMENT_SIZE', 200)
+
+    assignment_sizes = []
+    assign_pairs = pdc.assign_pairs
+
+    def recording_assign_pairs(pairs, actual_index, *args):
+        assignment_sizes.append(len(np.unique(actual_index[pairs])))
+        return assign_pairs(pairs, actual_index, *args)
+
+    monkeypatch.setattr(pdc, 'assign_pairs', recording_assign_pairs)
+    matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'optimal')
+
+    assert_valid_matching(matches, actual_xy, predicted_xy)
+    assert len(assignment_sizes) >= GRID_SIZE ** 2 // 200
+    assert max(assignment_sizes) <= 200
+
+def test_city_scale_component_is_matched(monkeypatch):
+    # 100 x 100 trees linked into one component with the default window size
+    monkeypatch.setattr(sys.modules[__name__], 'GRID_SIZE', 100)
+    actual_xy, predicted_xy = get_dense_canopy(seed=2)
+
+    matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'optimal')
+    greedy_matches = pdc.match_points(actual_xy, predicted_xy, THRESHOLD, 'greedy')
+
+    assert_valid_matching(matches, actual_xy, predicted_xy)
+    assert len(matches[0]) >= len(greedy_matches[0])
+    assert matches[2].mean() < greedy_matches[2].mean()
+
+@pytest.mark.parametrize('seed', range(3))
+def test_small_components_are_solved_exactly(seed):
+    actual_xy, predicted_xy = get_dense_canopy(seed)
+
+    # a threshold below half the spacing keeps the components small
+    radius = 0.4 * TREE_SPACING
+    matches = pdc.match_points(actual_xy, predicted_xy, radius, 'optimal')
+    greedy_matches = pdc.match_points(actual_xy, predicted_xy, radius, 'greedy')
+
+    assert len(matches[0]) >= len(greedy_matches[0])
+    assert len(np.unique(matches[1])) == len(matches[1])
+
+@pytest.mark.parametrize('tile_size', [1., 2.5, 7., 30., 1000.])
+@pytest.mark.parametrize('matching', ['greedy', 'optimal'])
+def test_tiled_matching_equals_in_memory(tile_size, matching):
+    actual_xy, predicted_xy = get_dense_canopy(seed=3)
+
+    candidate_pairs = pdc.get_candidate_pairs(actual_xy, predicted_xy, THRESHOLD)
+    tiled_candidate_pairs = pdc.get_tiled_candidate_pairs(actual_xy, predicted_xy, THRESHOLD,
+                                                          tile_size, num_workers=1)
+
+    for values, tiled_values in zip(candidate_pairs, tiled_candidate_pairs):
+        assert np.array_equal(values, tiled_values)
+
+    matches = pdc.match_candidate_pairs(candidate_pairs, THRESHOLD, matching,
+                                        len(actual_xy), len(predicted_xy))
+    tiled_matches = pdc.match_candidate_pairs(tiled_candidate_pairs, THRESHOLD, matching,
+                                              len(actual_xy), len(predicted_xy))
+
+    for values, tiled_values in zip(matches, tiled_matches):
+        assert np.array_equal(values, tiled_values)
+
+def test_tiled_candidate_pairs_of_workers():
+    actual_xy, predicted_xy = get_dense_canopy(seed=4)
+
+    candidate_pairs = pdc.get_candidate_pairs(actual_xy, predicted_xy, THRESHOLD)
+    tiled_candidate_pairs = pdc.get_tiled_candidate_pairs(actual_xy, predicted_xy, THRESHOLD,
+                                                          20., num_workers=2)
+
+    for values, tiled_values in zip(candidate_pairs, tiled_candidate_pairs):
+        assert np.array_equal(values, tiled_values)
@@ -128,7 +128,8 @@ if __name__ == "__main__":
                         TRAINING_DATA_GENERATION_SCRIPT_PATH,
                         f'--tif_dir={TIF_DIR}',
                         f'--shape_dir={SHP_DIR}',
-                        f'--output_dir={OUTPUT_DIR}'])
+                        f'--output_dir={OUTPUT_DIR}',
+                        f'--num_workers={meta_data_json.get("num_workers", os.cpu_count())}'])
 
         #  --------------------generate train test csv in the same dir -----------------------------
         logging.info('Running train test split script')
@@ -138,7 +139,10 @@ if __name__ == "__main__":
                         CSV_GENERATE_SCRIPT_PATH,
                         f'--csv_file={os.path.join(OUTPUT_DIR, "annotations.txt")}',
                         f'--output_dir={OUTPUT_DIR}',
-                        f'--test_portion={meta_data_json["csv_test_portion"]}'])
+                        f'--test_portion={meta_data_json["csv_test_portion"]}',
+                        f'--seed={meta_data_json.get("csv_split_seed", 0)}']
+                       + (['--stratify'] if meta_data_json.get('csv_stratify_by_scene') else [])
+                       + (['--parquet'] if meta_data_json.get('csv_parquet') else []))
 
         #  ---------------------------upload all data on s3--------------------------------------
         logging.info('Uploading files to s3')
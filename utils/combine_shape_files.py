@@ -1,26 +1,37 @@
 """
     -> Script to combine small shape files into bigger one.
+       Input layers are read in parallel and streamed batch wise into the output,
+       so memory stays flat whatever the number of input files.
     -> Input:
             - Path to small shape files directory
             - Path to output directory
     -> command to run:
         python combine_shape_files.py\
             --input_dir=<PATH_TO_THE_DIRECTORY_CONTAINING_SHAPE_FILES>\
-            --output_dir=<PATH TO THE OUTPUT DIRECTORY>
+            --output_dir=<PATH TO THE OUTPUT DIRECTORY>\
+            --driver=<OPTIONAL OUTPUT DRIVER ESRI Shapefile/GPKG default is ESRI Shapefile>\
+            --num_workers=<OPTIONAL NUMBER OF READER PROCESSES default is cpu count>\
+            --batch_size=<OPTIONAL NUMBER OF FEATURES WRITTEN AT ONCE default is 10000>\
+            --drop_duplicate_points=<OPTIONAL KEEP POINTS WITH THE SAME COORDINATES ONCE PER FILE>
     -> Output:
         - big size shape files
 """
 
 import glob
+import multiprocessing
 import os
 import sys
 
 import argparse
-import geopandas as gpd
-import pandas as pd
+import fiona
+import numpy as np
 
 from tqdm import tqdm
 
+# output drivers with their file extension, GPKG avoids the 2 GB shapefile limit
+# (FlatGeobuf needs GDAL >= 3.1, the pinned Fiona wheels bundle GDAL 2.4)
+OUTPUT_DRIVERS = {'ESRI Shapefile': '', 'GPKG': '.gpkg'}
+
 def arguments():
     '''
         command lines arguments
@@ -31,8 +42,129 @@ def arguments():
                         type=str)
     parser.add_argument("--output_dir", help="Path to the output directory",
                         type=str)
+    parser.add_argument("--driver", help="Output driver",
+                        type=str, default='ESRI Shapefile', choices=list(OUTPUT_DRIVERS))
+    parser.add_argument("--num_workers", help="Number of processes reading input files",
+                        type=int, default=os.cpu_count())
+    parser.add_argument("--batch_size", help="Number of features written to the output at once",
+                        type=int, default=10000)
+    parser.add_argument("--drop_duplicate_points",
+                        help="Keep the first of the points with the same coordinates in a file",
+                        action='store_true')
     return vars(parser.parse_args())
 
+def get_layer_meta(shape_file_path):
+    '''
+        Method to read schema and crs of a shape file without reading its features
+        params:
+            shape_file_path : path to the shape file
+        return (shape_file_path, schema, crs_wkt)
+    '''
+    with fiona.open(shape_file_path) as src:
+        return shape_file_path, src.schema, src.crs_wkt
+
+def read_features(shape_file_path):
+    '''
+        Method to read all features of a shape file
+        params:
+            shape_file_path : path to the shape file
+        return list of features
+    '''
+    with fiona.open(shape_file_path) as src:
+        return list(src)
+
+def read_unique_point_features(shape_file_path):
+    '''
+        Method to read the features of a point shape file, keeping the first feature
+        of every coordinate pair
+        params:
+            shape_file_path : path to the shape file
+        return list of features
+    '''
+    features = read_features(shape_file_path)
+
+    if not features:
+        return features
+
+    point_xy = np.array([feature['geometry']['coordinates'][:2] for feature in features],
+                        dtype=np.float64)
+
+    _, first_index = np.unique(point_xy, axis=0, return_index=True)
+    first_index.sort()
+
+    return [features[feature_no] for feature_no in first_index]
+
+def validate_layers(pool, shape_file_path_list):
+    '''
+        Method to check once up front that all shape files share schema and crs
+        params:
+            pool : multiprocessing pool used to read the headers
+            shape_file_path_list : list of shape file paths
+        return (schema, crs_wkt) of the layers
+    '''
+    layer_meta_list = pool.map(get_layer_meta, shape_file_path_list)
+    _, schema, crs_wkt = layer_meta_list[0]
+
+    incompatible_files = [shape_file_path
+                          for shape_file_path, layer_schema, layer_crs_wkt in layer_meta_list
+                          if layer_schema != schema or layer_crs_wkt != crs_wkt]
+
+    if incompatible_files:
+        raise Exception(f'Error: schema/crs differs from {shape_file_path_list[0]} for '
+                        f'{len(incompatible_files)} files e.g. {incompatible_files[0]}')
+
+    return schema, crs_wkt
+
+def combine_shape_files(shape_file_path_list, dst_path, driver, num_workers, batch_size,
+                        drop_duplicate_points=False):
+    '''
+        Method to stream features of all shape files into a single output layer
+        params:
+            shape_file_path_list : list of shape file paths
+            dst_path : path of the output layer
+            driver : output driver out of OUTPUT_DRIVERS
+            num_workers : number of reader processes
+            batch_size : number of features written at once
+            drop_duplicate_points : keep the first point of every coordinate pair in a file
+    '''
+    with multiprocessing.Pool(num_workers) as pool:
+
+        schema, crs_wkt = validate_layers(pool, shape_file_path_list)
+
+        reader = read_features
+        if drop_duplicate_points:
+            if schema['geometry'] != 'Point':
+                raise Exception(f"Error: --drop_duplicate_points needs Point layers, "
+                                f"got {schema['geometry']}")
+            reader = read_unique_point_features
+
+        with fiona.open(dst_path, 'w',
+                        crs_wkt=crs_wkt,
+                        driver=driver,
+                        schema=schema) as dst:
+
+            batch = []
+
+            # only a window of files is in flight at a time to keep memory flat
+            window_size = max(1, num_workers) * 8
+
+            with tqdm(total=len(shape_file_path_list),
+                      desc='processing _shape files',
+                      file=sys.stdout) as progress_bar:
+
+                for start in range(0, len(shape_file_path_list), window_size):
+                    for features in pool.imap(reader,
+                                              shape_file_path_list[start:start+window_size]):
+                        batch.extend(features)
+                        progress_bar.update()
+
+                        if len(batch) >= batch_size:
+                            dst.writerecords(batch)
+                            batch = []
+
+            if batch:
+                dst.writerecords(batch)
+
 if __name__ == "__main__":
     args = arguments()
 
@@ -40,16 +172,17 @@ if __name__ == "__main__":
         os.makedirs(args['output_dir'])
 
     # listing all shape files recursively in the folder
-    shape_file_path_list = glob.glob(args['input_dir'] + '/**/*.shp', recursive=True)
+    shape_file_path_list = sorted(glob.glob(args['input_dir'] + '/**/*.shp', recursive=True))
 
-    dst_file_name = '_'.join(shape_file_path_list[0].strip().split('/')[-1].split('_')[:-1])
+    if not shape_file_path_list:
+        raise FileNotFoundError(f"no shape files in {args['input_dir']}")
 
-    gdf = gpd.GeoDataFrame(pd.concat([gpd.read_file(shape_file_path)
-                                      for shape_file_path in tqdm(shape_file_path_list,
-                                                                  desc='processing _shape files',
-                                                                  file=sys.stdout)],
-                                     ignore_index=True),
-                           crs=gpd.read_file(shape_file_path_list[0]).crs)
+    dst_file_name = '_'.join(shape_file_path_list[0].strip().split('/')[-1].split('_')[:-1])
 
-    gdf.to_file(os.path.join(args['output_dir'], dst_file_name),
-                driver='ESRI Shapefile')
+    combine_shape_files(shape_file_path_list,
+                        os.path.join(args['output_dir'],
+                                     dst_file_name + OUTPUT_DRIVERS[args['driver']]),
+                        args['driver'],
+                        args['num_workers'],
+                        args['batch_size'],
+                        args['drop_duplicate_points'])
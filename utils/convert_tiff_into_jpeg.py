@@ -29,13 +29,24 @@ def convert_to_jpg(tif_file_path, band_list):
         return:
             numpy array of image with given bands
     '''
+    with rasterio.open(tif_file_path) as dataset:
+        img = dataset.read()
+
+    return convert_array_to_jpg(img, band_list)
+
+def convert_array_to_jpg(img, band_list):
+    '''
+        Method to convert already read tif data into jpg/png
+        params:
+            img : tif data of shape (bands, height, width), it is not modified
+            band_list : list of bands
+        return:
+            numpy array of image with given bands
+    '''
     upper_percentile = 98
     lower_percentile = 2
     max_single_value_count = 600
 
-    dataset = rasterio.open(tif_file_path)
-    img = dataset.read()
-
     if 'ndvi' in band_list:
 
         if img.shape[0] == 8:
@@ -92,6 +103,30 @@ def convert_to_jpg(tif_file_path, band_list):
 
     return img_plot_enhance.astype('uint8')
 
+def convert_tif_dir(input_dir, output_dir_path, band_list, file_type='jpg'):
+    '''
+        Method to convert all tif files of a directory
+        params:
+            input_dir : path to the directory containing tif files
+            output_dir_path : path to the directory the images are saved in
+            band_list : list of bands
+            file_type : output file type (jpg/png)
+    '''
+    for tif_file in tqdm(os.listdir(input_dir), file=sys.stdout):
+
+        if not tif_file.endswith(('.tif')):
+            continue
+
+        img = convert_to_jpg(
+            os.path.join(input_dir, tif_file),
+            list(band_list))
+
+        dst_path = os.path.join(
+            output_dir_path,
+            tif_file.split('.')[0] + f".{file_type}")
+
+        imsave(dst_path, img)
+
 if __name__ == "__main__":
 
     # command line arguments
@@ -126,17 +161,4 @@ if __name__ == "__main__":
                 break
 
         # processing each tif files
-        for tif_file in tqdm(os.listdir(args['input_dir']), file=sys.stdout):
-
-            if not tif_file.endswith(('.tif')):
-                continue
-
-            img = convert_to_jpg(
-                os.path.join(args['input_dir'], tif_file),
-                band.copy())
-
-            dst_path = os.path.join(
-                output_dir_path,
-                tif_file.split('.')[0] + f".{args['file_type']}")
-
-            imsave(dst_path, img)
+        convert_tif_dir(args['input_dir'], output_dir_path, band, args['file_type'])
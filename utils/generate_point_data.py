@@ -8,9 +8,10 @@
         python generate_point_data.py\
             --input_dir=<PATH_TO_THE_DIRECTORY_CONTAINING_TIF_FILES>\
             --csv_file=<PATH TO THE ANNOTATION'S CSV FILE>\
-            --output_dir=<PATH TO THE OUTPUT DIRECTORY>
+            --output_dir=<PATH TO THE OUTPUT DIRECTORY>\
+            --drop_duplicate_points=<OPTIONAL KEEP POINTS WITH THE SAME COORDINATES ONCE PER FILE>
     -> Output:
-        - point data shape files for each tif
+        - point data shape files for each tif, one point per annotation
 """
 
 # importing
@@ -38,16 +39,21 @@ def arguments():
                         type=str)
     parser.add_argument("--output_dir", help="Path to the output directory",
                         type=str)
+    parser.add_argument("--drop_duplicate_points",
+                        help="Keep the first of the points with the same coordinates in a file",
+                        action='store_true')
 
     return vars(parser.parse_args())
 
-def generate_point_shape_files(tif_file_path, annotations_df, output_dir):
+def generate_point_shape_files(tif_file_path, annotations_df, output_dir,
+                               drop_duplicate_points=False):
     '''
         method to generate point data shape files tif files
         params:
             tif_file_path : path to the tif file
             annotations_df : pandas data frame of annotations.csv
             output_dir: path to the directory where shape files will get saved
+            drop_duplicate_points : keep the first point of every coordinate pair
     '''
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -74,92 +80,107 @@ def generate_point_shape_files(tif_file_path, annotations_df, output_dir):
                        'evi_avg': 'float'},
         }
 
+    annotation_list = []
+    center_list = []
+
+    # iterate over all annotations for this tif file
+    for xmin, ymin, xmax, ymax, score in annotations_df[['xmin', 'ymin', 'xmax', 'ymax',
+                                                         'score']].to_numpy(dtype=np.float64):
+
+        # slice array to tree
+        crown_image = image_array[:,
+                                  int(ymin):int(ymax),
+                                  int(xmin):int(xmax)]
+
+        # get bands
+        if image_array.shape[0] == 8:
+            RED = crown_image[4, :, :].astype(np.float32)
+            GREEN = crown_image[2, :, :].astype(np.float32)
+            BLUE = crown_image[1, :, :].astype(np.float32)
+            NIR = crown_image[7, :, :].astype(np.float32)
+
+        elif image_array.shape[0] == 4:
+            RED = crown_image[0, :, :].astype(np.float32)
+            GREEN = crown_image[1, :, :].astype(np.float32)
+            BLUE = crown_image[2, :, :].astype(np.float32)
+            NIR = crown_image[3, :, :].astype(np.float32)
+
+        else:
+            raise Exception('Error: Tif file is not of 4 or 8 bands')
+
+        ## vegetation indices
+        # NDVI
+        ndvi = np.where(
+            (NIR+RED) == 0.,
+            0,
+            (NIR-RED)/(NIR+RED))
+        ndvi_avg = np.average(ndvi)
+
+        # EVI
+        G = 2.5; L = 2.4; C = 1
+        evi = np.where(
+            (L+NIR+C*RED) == 0.,
+            0,
+            G*((NIR-RED)/(L+NIR+C*RED)))
+        evi_avg = np.average(evi)
+
+        # SAVI
+        L = 0.5
+        savi = np.where(
+            (RED + NIR + L) == 0.,
+            0,
+            ((NIR - RED) / (RED + NIR + L)) * (1+L))
+        savi_avg = np.average(savi)
+
+        # remove edge pixels
+        ndvi[0, :] = 0
+        ndvi[-1, :] = 0
+        ndvi[:, 0] = 0
+        ndvi[:, -1] = 0
+
+        # appy gaussian
+        ndvi = ndimage.filters.gaussian_filter(ndvi, sigma=2)
+
+        # apply mask
+        ndvi_mask = ndvi > ndvi_avg * 0.75
+
+        area = len(ndvi[ndvi_mask]) * x_res # assuming x_res == y_res
+
+        if area == 0:
+            continue
+
+        center_list.append(tuple(map(int, ndimage.measurements.center_of_mass(ndvi_mask))))
+        annotation_list.append((xmin, ymin, score, area, ndvi_avg, savi_avg, evi_avg))
+
+    annotation_array = np.array(annotation_list, dtype=np.float64).reshape(-1, 7)
+    center_array = np.array(center_list, dtype=np.float64).reshape(-1, 2)
+
+    # recalculate coordinates of all points at once
+    x_array = (annotation_array[:, 0] + center_array[:, 0]) * x_res + dataset.bounds.left
+    y_array = (raster_size_y - ((center_array[:, 1] + annotation_array[:, 1]) * y_res)) \
+              + dataset.bounds.bottom
+
+    point_index = np.arange(len(x_array))
+
+    if drop_duplicate_points:
+        # keep the first point of every coordinate pair
+        _, point_index = np.unique(np.column_stack([x_array, y_array]), axis=0, return_index=True)
+        point_index.sort()
+
     # Write a new Shapefile
     with fiona.open(os.path.join(output_dir, tif_file_name.split('.')[0]), 'w',
                     crs=crs,
                     driver='ESRI Shapefile',
                     schema=schema) as c:
 
-        # iterate over all annotations for this tif file
-        for _, row in annotations_df.iterrows():
-
-            # slice array to tree
-            crown_image = image_array[:,
-                                      int(row['ymin']):int(row['ymax']),
-                                      int(row['xmin']):int(row['xmax'])]
-
-            # get bands
-            if image_array.shape[0] == 8:
-                RED = crown_image[4, :, :].astype(np.float32)
-                GREEN = crown_image[2, :, :].astype(np.float32)
-                BLUE = crown_image[1, :, :].astype(np.float32)
-                NIR = crown_image[7, :, :].astype(np.float32)
-
-            elif image_array.shape[0] == 4:
-                RED = crown_image[0, :, :].astype(np.float32)
-                GREEN = crown_image[1, :, :].astype(np.float32)
-                BLUE = crown_image[2, :, :].astype(np.float32)
-                NIR = crown_image[3, :, :].astype(np.float32)
-
-            else:
-                raise Exception('Error: Tif file is not of 4 or 8 bands')
-
-            ## vegetation indices
-            # NDVI
-            ndvi = np.where(
-                (NIR+RED) == 0.,
-                0,
-                (NIR-RED)/(NIR+RED))
-            ndvi_avg = np.average(ndvi)
-
-            # EVI
-            G = 2.5; L = 2.4; C = 1
-            evi = np.where(
-                (L+NIR+C*RED) == 0.,
-                0,
-                G*((NIR-RED)/(L+NIR+C*RED)))
-            evi_avg = np.average(evi)
-
-            # SAVI
-            L = 0.5
-            savi = np.where(
-                (RED + NIR + L) == 0.,
-                0,
-                ((NIR - RED) / (RED + NIR + L)) * (1+L))
-            savi_avg = np.average(savi)
-
-            # remove edge pixels
-            ndvi[0, :] = 0
-            ndvi[-1, :] = 0
-            ndvi[:, 0] = 0
-            ndvi[:, -1] = 0
-
-            # appy gaussian
-            ndvi = ndimage.filters.gaussian_filter(ndvi, sigma=2)
-
-            # apply mask
-            ndvi_mask = ndvi > ndvi_avg * 0.75
-
-            area = len(ndvi[ndvi_mask]) * x_res # assuming x_res == y_res
-
-            if area == 0:
-                continue
-
-            x, y = map(int, ndimage.measurements.center_of_mass(ndvi_mask))
-
-            # recalculate coordinates
-            x = ((row['xmin'] + x) * x_res + (dataset.bounds.left))
-            y = (raster_size_y - ((y + row['ymin']) * y_res)) + dataset.bounds.bottom
-
-            pt = Point(x, y)
-
-            c.write({
-                'geometry': mapping(pt),
-                'properties': {'score': float(row['score']),
-                               'area' : float(area),
-                               'ndvi_avg': float(ndvi_avg),
-                               'savi_avg': float(savi_avg),
-                               'evi_avg' : float(evi_avg)}})
+        c.writerecords([{
+            'geometry': mapping(Point(x_array[point_no], y_array[point_no])),
+            'properties': {'score': float(annotation_array[point_no, 2]),
+                           'area' : float(annotation_array[point_no, 3]),
+                           'ndvi_avg': float(annotation_array[point_no, 4]),
+                           'savi_avg': float(annotation_array[point_no, 5]),
+                           'evi_avg' : float(annotation_array[point_no, 6])}}
+                        for point_no in point_index])
 
 if __name__ == '__main__':
     args = arguments()
@@ -180,4 +201,5 @@ if __name__ == '__main__':
         generate_point_shape_files(
             tif_file_path,
             annotations_df,
-            args['output_dir'])
+            args['output_dir'],
+            args['drop_duplicate_points'])
@@ -6,9 +6,15 @@
          --csv_file=<PATH TO THE BIG CSV FILE>
          --output_dir=<PATH TO THE OUTPUT DIRECTORY>
          --test_portion=<FLOAT VALUE DENOTING THE RATIO OF TEST SET>
+         --seed=<OPTIONAL INT SEED OF THE RANDOM ORDER FILES ARE DRAWN IN default = 0>
+         --stratify=<OPTIONAL FLAG TO SPLIT EVERY SCENE ON ITS OWN>
+         --parquet=<OPTIONAL FLAG TO ALSO WRITE train_labels.parquet AND test_labels.parquet>
+    The csv is streamed twice (count annotations per file, then route rows), memory does
+    not grow with the number of annotations
 '''
 
 #importing
+import bisect
 import csv
 import os
 import random
@@ -16,19 +22,34 @@ from collections import defaultdict
 
 import argparse
 
-# command line arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("--csv_file", help="path to the csv file",
-                    type=str)
-parser.add_argument("--output_dir", help="path to the output directory",
-                    type=str)
-parser.add_argument("--test_portion", help="float value denoting portion of test_set default = 0.2",
-                    type=float, default=0.2)
-args = vars(parser.parse_args())
-
-def get_csv_data(csv_file_path):
+# constants
+LABEL_COLUMNS = ['filename', 'xmin', 'ymin', 'xmax', 'ymax', 'class']
+WRITE_BUFFER_SIZE = 1 << 20
+PARQUET_BATCH_SIZE = 100000
+
+def arguments():
+    '''
+        command line arguments
+        return command line argument dictionary
     '''
-        script to read csv and return csv data in 2d list and a dictionary containing
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv_file", help="path to the csv file",
+                        type=str)
+    parser.add_argument("--output_dir", help="path to the output directory",
+                        type=str)
+    parser.add_argument("--test_portion", help="float value denoting portion of test_set default = 0.2",
+                        type=float, default=0.2)
+    parser.add_argument("--seed", help="seed of the random order files are drawn in",
+                        type=int, default=0)
+    parser.add_argument("--stratify", help="split every scene (filename without chunk number) on its own",
+                        action='store_true')
+    parser.add_argument("--parquet", help="also write the labels as parquet files (needs pyarrow)",
+                        action='store_true')
+    return vars(parser.parse_args())
+
+def get_annotation_count_dict(csv_file_path):
+    '''
+        first pass over the csv, return a dictionary containing
         {file_name : total_annotation_count_on_file}
         parms:
             csv_file_path : <PATH TO THE CSV FILE>
@@ -37,107 +58,234 @@ def get_csv_data(csv_file_path):
 
     # check file exists or not
     if not os.path.exists(csv_file_path):
-        raise f'file not found : {csv_file_path}'
-
-    csv_data = []
+        raise FileNotFoundError(f'file not found : {csv_file_path}')
 
-    with open(csv_file_path, 'r') as csv_file:
-        csv_reader = csv.reader(csv_file)
-        for row in csv_reader:
-            csv_data.append(row)
+    with open(csv_file_path, 'r', newline='') as csv_file:
+        for row in csv.reader(csv_file):
+            annotation_count_dict[row[0]] += 1
 
-    # creating dictionary {filename : total_annotations_for_that_file}
-    for csv_row_data in csv_data:
-        annotation_count_dict[csv_row_data[0]] += 1
+    return annotation_count_dict
 
-    return (csv_data, annotation_count_dict)
+def get_scene_name(filename):
+    '''
+        return name of the scene a chunk file is cut from i.e. filename without chunk number
+        params:
+            filename : chunk file name e.g. <scene>_012.tif
+    '''
+    return filename.rsplit('_', 1)[0]
 
-def get_filenames_of_test_set(annotation_count_dict, test_portion):
+def pack_test_set(annotation_count_dict, filenames, test_portion, rng):
     '''
-        Process annotation data and return name of those files
-        which contributes to test_portion of the dataset
+        Random draw of test_portion of the files into the test set, then a test file and
+        a train file are swapped as long as it brings the test annotations closer to
+        test_portion of the annotations, so both the files and the annotations are split
+        by test_portion and the test set is not biased to dense or sparse files
         parms:
             annotation_count_dict : dictionary containing filename as a key
                                     and total annotation as value
+            filenames : files to pick from
             test_portion : test_set fraction value
+            rng : random.Random the files are drawn with
     '''
+    expected_annotations = sum(annotation_count_dict[filename] for filename in filenames) \
+                           * test_portion
+    expected_files = round(len(filenames) * test_portion)
+
+    # sorted first so that the draw only depends on the seed
+    filenames = sorted(filenames)
+    rng.shuffle(filenames)
+
+    test_files = filenames[:expected_files]
+    train_files = filenames[expected_files:]
+    annotation_gap = expected_annotations - sum(annotation_count_dict[filename]
+                                                for filename in test_files)
+
+    while test_files and train_files:
+        train_counts = sorted((annotation_count_dict[filename], train_no)
+                              for train_no, filename in enumerate(train_files))
+
+        # the train file closest to the count that closes the gap, for every test file
+        best_swap = None
+        best_gap = abs(annotation_gap)
+
+        for test_no, filename in enumerate(test_files):
+            wanted_count = annotation_count_dict[filename] + annotation_gap
+            position = bisect.bisect_left(train_counts, (wanted_count, -1))
+
+            for train_count, train_no in train_counts[max(position - 1, 0):position + 1]:
+                new_gap = abs(annotation_gap - train_count + annotation_count_dict[filename])
+                if new_gap < best_gap:
+                    best_gap = new_gap
+                    best_swap = (test_no, train_no)
+
+        if best_swap is None:
+            break
 
-    total_test_annotations = 0
-    expected_annotations = int(sum(annotation_count_dict.values()) * test_portion)
-
-    padding = 0.01
-
-    total_attempt = 0
-
-    while not expected_annotations-padding*expected_annotations \
-            < total_test_annotations < \
-            expected_annotations+padding*expected_annotations:
-
-        total_attempt += 1
+        test_no, train_no = best_swap
+        annotation_gap -= annotation_count_dict[train_files[train_no]] \
+                          - annotation_count_dict[test_files[test_no]]
+        test_files[test_no], train_files[train_no] = train_files[train_no], test_files[test_no]
 
-        print(f'{total_attempt} - attempting to find optimal test set')
+    return set(test_files)
 
-        test_set = random.sample(annotation_count_dict.keys(),
-                                 int(test_portion*len(annotation_count_dict.keys())))
+def get_filenames_of_test_set(annotation_count_dict, test_portion, seed=0, stratify=False):
+    '''
+        Process annotation data and return name of those files
+        which contributes to test_portion of the dataset,
+        same inputs always give the same test set
+        parms:
+            annotation_count_dict : dictionary containing filename as a key
+                                    and total annotation as value
+            test_portion : test_set fraction value
+            seed : seed of the random order files are drawn in
+            stratify : split every scene on its own so each contributes test_portion
+    '''
+    rng = random.Random(seed)
 
-        total_test_annotations = sum([annotation_count_dict[filename] for filename in test_set])
+    if stratify:
+        scene_dict = defaultdict(list)
+        for filename in annotation_count_dict:
+            scene_dict[get_scene_name(filename)].append(filename)
 
-        if total_attempt % 10 == 0:
-            padding += 0.01
+        test_set = set()
+        for scene_name in sorted(scene_dict):
+            test_set |= pack_test_set(annotation_count_dict, scene_dict[scene_name],
+                                      test_portion, rng)
+    else:
+        test_set = pack_test_set(annotation_count_dict, list(annotation_count_dict),
+                                 test_portion, rng)
 
-        if total_attempt % 100 == 0:
-            print('Unable to find optimize test_set please check yous csv file')
-            break
+    total_test_annotations = sum(annotation_count_dict[filename] for filename in test_set)
+    total_annotations = sum(annotation_count_dict.values())
 
-    print('Test set found successfully')
-    return set(test_set)
+    print(f'Test set found successfully : {total_test_annotations}/{total_annotations} '
+          f'annotations ({total_test_annotations / max(total_annotations, 1):.4f})')
+    return test_set
 
-def generate_train_test_csv_data(csv_data, test_set):
+class ParquetLabelWriter():
+    '''
+        Writer of label rows into a parquet file, rows are buffered column wise and
+        written as a row group every PARQUET_BATCH_SIZE rows
     '''
-        return 2d list containing train test data
+    def __init__(self, parquet_file_path):
+        # optional dependency, only needed with --parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([('filename', pa.string()),
+                                 ('xmin', pa.int64()),
+                                 ('ymin', pa.int64()),
+                                 ('xmax', pa.int64()),
+                                 ('ymax', pa.int64()),
+                                 ('class', pa.string())])
+        self.writer = pq.ParquetWriter(parquet_file_path, self.schema)
+        self.columns = [[] for _ in LABEL_COLUMNS]
+
+    def write(self, row_data):
+        '''
+            buffer one label row
+            params:
+                row_data : [filename, xmin, ymin, xmax, ymax, class]
+        '''
+        for column, value in zip(self.columns, row_data):
+            column.append(value)
+
+        if len(self.columns[0]) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        '''
+            write the buffered rows as a row group
+        '''
+        if self.columns[0]:
+            self.writer.write_table(self.pa.Table.from_arrays(
+                [self.pa.array(column, type=field.type)
+                 for column, field in zip(self.columns, self.schema)],
+                schema=self.schema))
+            self.columns = [[] for _ in LABEL_COLUMNS]
+
+    def close(self):
+        '''
+            write the remaining rows and close the file
+        '''
+        self.flush()
+        self.writer.close()
+
+def write_train_test_split(csv_file_path, test_set, output_dir, parquet=False):
+    '''
+        second pass over the csv, every row is routed to the train or test labels
         params:
-            csv_data : input csv data
-            test_set :  filenames of files in test set
+            csv_file_path : <PATH TO THE CSV FILE>
+            test_set : filenames of files in test set
+            output_dir : path to the output directory
+            parquet : also write the labels as parquet files
+        return (total train annotations, total test annotations)
     '''
-    train_csv_data = [['filename', 'xmin', 'ymin', 'xmax', 'ymax', 'class']]
-    test_csv_data = [['filename', 'xmin', 'ymin', 'xmax', 'ymax', 'class']]
-
-    for row_data in csv_data:
-        # converting into int
-        row_data[1] = int(row_data[1])
-        row_data[2] = int(row_data[2])
-        row_data[3] = int(row_data[3])
-        row_data[4] = int(row_data[4])
-
-        if row_data[0] in test_set:
-            row_data[0] = row_data[0].split('.')[0] + '.jpg'
-            test_csv_data.append(row_data)
-        else:
-            row_data[0] = row_data[0].split('.')[0] + '.jpg'
-            train_csv_data.append(row_data)
-
-    return (train_csv_data, test_csv_data)
+    row_counts = {'train': 0, 'test': 0}
+    csv_files = {}
+    csv_writers = {}
+    parquet_writers = {}
+
+    try:
+        # parquet writers first, a missing pyarrow fails before any csv is truncated
+        if parquet:
+            for split_name in row_counts:
+                parquet_writers[split_name] = ParquetLabelWriter(
+                    os.path.join(output_dir, f'{split_name}_labels.parquet'))
+
+        for split_name in row_counts:
+            csv_files[split_name] = open(os.path.join(output_dir, f'{split_name}_labels.csv'),
+                                         'w+', newline='', buffering=WRITE_BUFFER_SIZE)
+            csv_writers[split_name] = csv.writer(csv_files[split_name])
+            csv_writers[split_name].writerow(LABEL_COLUMNS)
+
+        with open(csv_file_path, 'r', newline='') as csv_file:
+            for row_data in csv.reader(csv_file):
+                split_name = 'test' if row_data[0] in test_set else 'train'
+
+                row_data = [row_data[0].split('.')[0] + '.jpg',
+                            int(row_data[1]),
+                            int(row_data[2]),
+                            int(row_data[3]),
+                            int(row_data[4]),
+                            row_data[5]]
+
+                csv_writers[split_name].writerow(row_data)
+                if parquet:
+                    parquet_writers[split_name].write(row_data)
+
+                row_counts[split_name] += 1
+
+    finally:
+        for csv_file in csv_files.values():
+            csv_file.close()
+
+        for parquet_writer in parquet_writers.values():
+            parquet_writer.close()
+
+    return row_counts['train'], row_counts['test']
 
 # entry point
 if __name__ == "__main__":
+    args = arguments()
+
     print('processing_file...')
 
-    csv_data, annotation_count_dict = get_csv_data(args['csv_file'])
-    test_set = get_filenames_of_test_set(annotation_count_dict, args['test_portion'])
-    train_csv_data, test_csv_data = generate_train_test_csv_data(csv_data, test_set)
+    annotation_count_dict = get_annotation_count_dict(args['csv_file'])
+    test_set = get_filenames_of_test_set(annotation_count_dict,
+                                         args['test_portion'],
+                                         args['seed'],
+                                         args['stratify'])
 
     print('Total test images :', len(test_set))
-    print('generating train_labels.csv')
-
-    with open(os.path.join(args['output_dir'], 'train_labels.csv'), 'w+') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerows(train_csv_data)
-
-
-    print('generating test_labels.csv')
+    print('generating train_labels.csv and test_labels.csv')
 
-    with open(os.path.join(args['output_dir'], 'test_labels.csv'), 'w+') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerows(test_csv_data)
+    total_train_annotations, total_test_annotations = write_train_test_split(args['csv_file'],
+                                                                             test_set,
+                                                                             args['output_dir'],
+                                                                             args['parquet'])
 
+    print('Total train annotations :', total_train_annotations)
+    print('Total test annotations :', total_test_annotations)
     print('process completed successfully')
@@ -10,13 +10,17 @@
         python generate_training_data.py\
             --tif_dir=<PATH_TO_THE_DIRECTORY_CONTAINING_TIF_FILES>\
             --shape_dir=<PATH TO THE SHAPE FILE DIR>\
-            --output_dir=<PATH TO THE OUTPUT DIRECTORY>
+            --output_dir=<PATH TO THE OUTPUT DIRECTORY>\
+            --num_workers=<OPTIONAL NUMBER OF TIF FILES PROCESSED IN PARALLEL default is cpu count>
     -> Output:
         - chunked tif files and annotations.txt
 """
 
 import os
 import glob
+import multiprocessing
+import shutil
+import sys
 
 import argparse
 import fiona
@@ -25,9 +29,15 @@ import rasterio
 from rasterio.mask import mask
 import slidingwindow as sw
 
-from shapely.geometry import shape, Polygon, box, MultiPolygon
+from shapely.geometry import shape, Polygon
 from tqdm import tqdm
 
+# constants
+CHUNK_SIZE_PIX = 400
+OVERLAP_FRAC = 0.0
+LABEL = 'tree'
+ANNOTATION_SHARD_DIR_NAME = 'annotation_shards'
+
 def arguments():
     '''
         command line arguments
@@ -40,72 +50,141 @@ def arguments():
                         type=str)
     parser.add_argument("--output_dir", help="Path to the output directory",
                         type=str)
+    parser.add_argument("--num_workers", help="Number of tif files processed in parallel",
+                        type=int, default=os.cpu_count())
 
     return vars(parser.parse_args())
 
-if __name__ == "__main__":
+def get_annotation_bounds(shape_file_path):
+    '''
+        Method to read the bounds of all annotations of a shape file
+        params:
+            shape_file_path : path to the annotation shape file
+        return (annotation_bounds, file_order) where annotation_bounds is an array of
+        shape (n, 4) of (minx, miny, maxx, maxy) sorted by minx and file_order the
+        position of every annotation in the shape file
+    '''
+    with fiona.open(shape_file_path) as shape_file:
+        annotation_bounds = np.array([shape(pol['geometry']).bounds
+                                      for pol in shape_file
+                                      if pol['geometry'] is not None],
+                                     dtype=np.float64).reshape(-1, 4)
 
-    # constants
-    CHUNK_SIZE_PIX = 400
-    OVERLAP_FRAC = 0.0
-    LABEL = 'tree'
+    file_order = np.argsort(annotation_bounds[:, 0], kind='stable')
+    return annotation_bounds[file_order], file_order
 
-    args = arguments()
+def get_chunk_annotations(annotation_bounds, file_order, chunk_bounds):
+    '''
+        Method to select the annotations that are fully within a chunk, same result
+        as poly.within(chunk) for every annotation polygon but vectorized
+        params:
+            annotation_bounds, file_order : sorted annotation bounds
+                                            (see get_annotation_bounds)
+            chunk_bounds : (minx, miny, maxx, maxy) of the chunk
+        return array of shape (k, 4) of the bounds of the selected annotations
+        in shape file order
+    '''
+    x_min, y_min, x_max, y_max = chunk_bounds
 
-    for tif_file_name in tqdm(os.listdir(args['tif_dir']), desc='processing tif files : '):
+    # only annotations starting inside the chunk in x can be within it
+    start = np.searchsorted(annotation_bounds[:, 0], x_min, side='left')
+    end = np.searchsorted(annotation_bounds[:, 0], x_max, side='right')
+    candidate_bounds = annotation_bounds[start:end]
 
-        if not tif_file_name.endswith(('.tif',)):
-            continue
+    is_within = ((candidate_bounds[:, 1] >= y_min)
+                 & (candidate_bounds[:, 2] <= x_max)
+                 & (candidate_bounds[:, 3] <= y_max))
 
-        tif_file_path = os.path.join(args['tif_dir'], tif_file_name)
-        shape_file_path = glob.glob(os.path.join(args['shape_dir'],
-                                                 f"**/{tif_file_name.split('.')[0]}.shp"),
-                                    recursive=True)[0]
+    return candidate_bounds[is_within][np.argsort(file_order[start:end][is_within])]
 
-        dataset = rasterio.open(tif_file_path)
+def get_annotated_windows(windows, raster_bounds, transform, annotation_extent):
+    '''
+        Method to convert windows to map bounds and keep the ones intersecting the
+        annotation extent, windows outside of it can not contain annotations
+        params:
+            windows : list of slidingwindow windows
+            raster_bounds : bounds of the raster
+            transform : affine transform of the raster
+            annotation_extent : (minx, miny, maxx, maxy) of all annotations
+        return list of (window index, (minx, miny, maxx, maxy))
+    '''
+    x_pix_size_m = transform[0]
+    y_pix_size_m = abs(transform[4])
+
+    window_array = np.array([(window.x, window.y, window.w, window.h) for window in windows],
+                            dtype=np.float64).reshape(-1, 4)
 
-        # convert list to shapely MultiPolgyons
-        annotations_MultiPoly = MultiPolygon([shape(pol['geometry'])
-                                              for pol in fiona.open(shape_file_path)
-                                              if pol['geometry'] is not None])
+    # convert chunk coordinates to bbox
+    x_min = (window_array[:, 0] * x_pix_size_m) + raster_bounds[0]
+    x_max = ((window_array[:, 0] + window_array[:, 2]) * x_pix_size_m) + raster_bounds[0]
+    y_min = (window_array[:, 1] * y_pix_size_m) + raster_bounds[1]
+    y_max = ((window_array[:, 1] + window_array[:, 3]) * y_pix_size_m) + raster_bounds[1]
 
-        # crop raster file to annotation extend
-        x_min_annotations, y_min_annotations, x_max_annotations, y_max_annotations = annotations_MultiPoly.bounds
-        chunk_bbox_org = box(x_min_annotations, y_min_annotations, x_max_annotations, y_max_annotations)
-        # crop
-        out_img, out_transform = mask(dataset, shapes=[chunk_bbox_org], crop=True)
+    is_intersecting = ((x_min <= annotation_extent[2]) & (x_max >= annotation_extent[0])
+                       & (y_min <= annotation_extent[3]) & (y_max >= annotation_extent[1]))
 
-        ## get raster bbox
-        # convert bounds to polygon
-        x_min_data, y_min_data, x_max_data, y_max_data = dataset.bounds
-        poly_raster_bounds = Polygon([(x_min_data, y_min_data),
-                                      (x_min_data, y_max_data),
-                                      (x_max_data, y_max_data),
-                                      (x_max_data, y_min_data)])
+    return [(window_no, (x_min[window_no], y_min[window_no], x_max[window_no], y_max[window_no]))
+            for window_no in np.flatnonzero(is_intersecting).tolist()]
 
-        # get raster metadata
-        x_pix_size_m = dataset.meta['transform'][0]
-        y_pix_size_m = dataset.meta['transform'][4]
+def get_shape_file_index(shape_dir):
+    '''
+        Method to list the shape files of a directory recursively once
+        params:
+            shape_dir : path to the shape file directory
+        return dictionary of shape file name without extension to its path
+    '''
+    shape_file_index = {}
+
+    for shape_file_path in sorted(glob.glob(os.path.join(shape_dir, '**/*.shp'), recursive=True)):
+        shape_file_index.setdefault(os.path.basename(shape_file_path)[:-len('.shp')],
+                                    shape_file_path)
 
-        x_raster_size_pix = dataset.meta['width']
-        y_raster_size_pix = dataset.meta['height']
+    return shape_file_index
 
-        # Generate the set of windows
-        windows = sw.generate(np.rot90(np.fliplr(dataset.read().T)),
-                              sw.DimOrder.HeightWidthChannel,
-                              CHUNK_SIZE_PIX, OVERLAP_FRAC)
+def process_tif(task):
+    '''
+        Method to chop one tif file into chunks, the annotations of its chunks are
+        written to a shard of its own that is merged into annotations.txt afterwards
+        params:
+            task : (tif_file_path, shape_file_path, output_dir, annotation_shard_path)
+        return annotation_shard_path
+    '''
+    tif_file_path, shape_file_path, output_dir, annotation_shard_path = task
 
-        for i in tqdm(range(len(windows)), desc='chopping tif files : ', leave=False):
+    with open(annotation_shard_path, 'w') as annotation_file:
 
-            # convert chunk coordinates to bbox
-            x_min = (windows[i].x * x_pix_size_m) + x_min_data
-            x_max = ((windows[i].x + windows[i].w) * x_pix_size_m) + x_min_data
-            y_min = (windows[i].y * abs(y_pix_size_m)) + y_min_data
-            y_max = ((windows[i].y + windows[i].h) * abs(y_pix_size_m)) + y_min_data
+        dataset = rasterio.open(tif_file_path)
+        tif_file_name = os.path.basename(tif_file_path)
 
-            x_min_data, y_min_data, x_max_data, y_max_data = dataset.bounds
+        # annotation bounds, sorted by minx for the chunk lookups
+        annotation_bounds, file_order = get_annotation_bounds(shape_file_path)
+
+        # annotation extent
+        annotation_extent = (annotation_bounds[:, 0].min(), annotation_bounds[:, 1].min(),
+                             annotation_bounds[:, 2].max(), annotation_bounds[:, 3].max())
+
+        # Generate the set of windows from the raster size, without reading the raster,
+        # and keep only the windows intersecting the annotation extent
+        windows = sw.generateForSize(dataset.meta['width'],
+                                     dataset.meta['height'],
+                                     sw.DimOrder.HeightWidthChannel,
+                                     CHUNK_SIZE_PIX, OVERLAP_FRAC)
+
+        for i, chunk_bounds_m in tqdm(get_annotated_windows(windows,
+                                                            dataset.bounds,
+                                                            dataset.meta['transform'],
+                                                            annotation_extent),
+                                      desc='chopping tif files : ', leave=False):
+
+            # select only bboxes that are fully within the chunk
+            chunk_bounds = get_chunk_annotations(annotation_bounds, file_order, chunk_bounds_m)
 
-            # clip raster file
+            # only continue if there are boxes
+            if len(chunk_bounds) == 0:
+                continue
+
+            # clip raster file, mask reads only the window of the chunk
+            x_min, y_min, x_max, y_max = chunk_bounds_m
             poly_chunk_bounds = Polygon([(x_min, y_min), (x_min, y_max),
                                          (x_max, y_max), (x_max, y_min)])
             out_img_chunk, out_transform_chunk = mask(dataset,
@@ -116,15 +195,6 @@ if __name__ == "__main__":
             x_min_chunk = out_transform_chunk[2]
             y_min_chunk = out_transform_chunk[5]
 
-            # select only bboxes that are fully within the chunk
-            chunk_MultiPoly = MultiPolygon([poly_chunk_bounds.intersection(poly)
-                                            for poly in annotations_MultiPoly
-                                            if poly.within(poly_chunk_bounds)])
-
-            # only continue if there are boxes
-            if len(chunk_MultiPoly) == 0:
-                continue
-
             #### tif file #####
             # generate tiff/ profile
             profile = dataset.profile
@@ -135,37 +205,66 @@ if __name__ == "__main__":
             # write tif file
             file_name_tif = tif_file_name.split('.')[0]
             file_name_tif = file_name_tif + '_{0:03d}.tif'.format(i)
-            file_path_tif = os.path.join(args['output_dir'], file_name_tif)
+            file_path_tif = os.path.join(output_dir, file_name_tif)
             with rasterio.open(file_path_tif, 'w', **profile) as dst:
                 dst.write(out_img_chunk)
 
-            # get annotation coordinates
-            x = (abs(np.array([poly.exterior.coords.xy[0]
-                               for poly in chunk_MultiPoly])
-                     - x_min_chunk)
-                 * 1/out_transform_chunk[0])
-
-            y = (abs(np.array([poly.exterior.coords.xy[1]
-                               for poly in chunk_MultiPoly])
-                     - y_min_chunk)
-                 * 1/out_transform_chunk[0])
+            # get annotation pixel coordinates, y is counted from the top of the chunk
+            x_bbox = np.round(np.abs(chunk_bounds[:, [0, 2]] - x_min_chunk)
+                              * 1/out_transform_chunk[0]).astype(int)
+            y_bbox = np.round(np.abs(chunk_bounds[:, [3, 1]] - y_min_chunk)
+                              * 1/out_transform_chunk[0]).astype(int)
 
             # write annotations to annotation file
-            for i in range(len(x)):
-                x_min_bbox = np.round(x[i]).astype(int).min()
-                x_max_bbox = np.round(x[i]).astype(int).max()
-                y_min_bbox = np.round(y[i]).astype(int).min()
-                y_max_bbox = np.round(y[i]).astype(int).max()
-
-                string_list_tif = [file_name_tif,
-                                   str(x_min_bbox),
-                                   str(y_min_bbox),
-                                   str(x_max_bbox),
-                                   str(y_max_bbox),
-                                   LABEL]
-
-                string_tif = ",".join(string_list_tif)
-
-                with open(os.path.join(args['output_dir'], 'annotations.txt'), 'a') as file:
-                    file.write(string_tif + "\n")
-                    
\ No newline at end of file
+            annotation_file.writelines(
+                ",".join([file_name_tif,
+                          str(x_min_bbox),
+                          str(y_min_bbox),
+                          str(x_max_bbox),
+                          str(y_max_bbox),
+                          LABEL]) + "\n"
+                for (x_min_bbox, x_max_bbox), (y_min_bbox, y_max_bbox) in zip(x_bbox.tolist(),
+                                                                              y_bbox.tolist()))
+
+    return annotation_shard_path
+
+if __name__ == "__main__":
+    args = arguments()
+
+    tif_file_name_list = sorted(tif_file_name for tif_file_name in os.listdir(args['tif_dir'])
+                                if tif_file_name.endswith(('.tif',)))
+
+    # index shape files once instead of a recursive glob per tif file
+    shape_file_index = get_shape_file_index(args['shape_dir'])
+
+    annotation_shard_dir = os.path.join(args['output_dir'], ANNOTATION_SHARD_DIR_NAME)
+    os.makedirs(annotation_shard_dir, exist_ok=True)
+
+    tasks = []
+    for tif_file_name in tif_file_name_list:
+
+        if tif_file_name.split('.')[0] not in shape_file_index:
+            raise FileNotFoundError(f"no shape file for {tif_file_name} in {args['shape_dir']}")
+
+        tasks.append((os.path.join(args['tif_dir'], tif_file_name),
+                      shape_file_index[tif_file_name.split('.')[0]],
+                      args['output_dir'],
+                      os.path.join(annotation_shard_dir, tif_file_name.split('.')[0] + '.txt')))
+
+    if args['num_workers'] > 1:
+        with multiprocessing.Pool(args['num_workers']) as pool:
+            list(tqdm(pool.imap_unordered(process_tif, tasks),
+                      total=len(tasks),
+                      desc='processing tif files : ',
+                      file=sys.stdout))
+    else:
+        for task in tqdm(tasks, desc='processing tif files : ', file=sys.stdout):
+            process_tif(task)
+
+    # merge the shards in tif file order
+    with open(os.path.join(args['output_dir'], 'annotations.txt'), 'a') as annotation_file:
+        for task in tasks:
+            with open(task[-1]) as annotation_shard:
+                shutil.copyfileobj(annotation_shard, annotation_file)
+
+    shutil.rmtree(annotation_shard_dir)
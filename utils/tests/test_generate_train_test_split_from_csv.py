@@ -0,0 +1,60 @@
+'''
+    tests of the train/test split of generate_train_test_split_from_csv.py
+    -> command to run (from utils):
+        python -m pytest tests
+'''
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import generate_train_test_split_from_csv as split
+
+TOTAL_SCENES = 20
+CHUNKS_PER_SCENE = 40
+
+def get_annotation_count_dict(seed=0):
+    '''
+        return {filename : annotation count} of chunks with a skewed density, a few
+        dense chunks of forest and many sparse ones
+    '''
+    random_state = np.random.RandomState(seed)
+    annotation_counts = np.ceil(random_state.lognormal(2, 1.2, TOTAL_SCENES * CHUNKS_PER_SCENE))
+
+    return {f'scene{scene_no}_{chunk_no:03d}.tif': int(annotation_counts[scene_no * CHUNKS_PER_SCENE
+                                                                         + chunk_no])
+            for scene_no in range(TOTAL_SCENES)
+            for chunk_no in range(CHUNKS_PER_SCENE)}
+
+def get_fractions(annotation_count_dict, test_set):
+    '''
+        return (file fraction, annotation fraction) of the test set
+    '''
+    total_test_annotations = sum(annotation_count_dict[filename] for filename in test_set)
+
+    return (len(test_set) / len(annotation_count_dict),
+            total_test_annotations / sum(annotation_count_dict.values()))
+
+@pytest.mark.parametrize('test_portion', [0.1, 0.2, 0.3])
+@pytest.mark.parametrize('stratify', [False, True])
+@pytest.mark.parametrize('seed', range(3))
+def test_file_and_annotation_fractions_follow_test_portion(test_portion, stratify, seed):
+    annotation_count_dict = get_annotation_count_dict(seed)
+    test_set = split.get_filenames_of_test_set(annotation_count_dict, test_portion, seed, stratify)
+
+    file_fraction, annotation_fraction = get_fractions(annotation_count_dict, test_set)
+
+    assert abs(file_fraction - test_portion) <= 0.1 * test_portion
+    assert abs(annotation_fraction - test_portion) <= 0.1 * test_portion
+
+def test_split_depends_on_the_seed_only():
+    annotation_count_dict = get_annotation_count_dict()
+    shuffled_count_dict = dict(reversed(list(annotation_count_dict.items())))
+
+    test_set = split.get_filenames_of_test_set(annotation_count_dict, 0.2, seed=1)
+
+    assert split.get_filenames_of_test_set(shuffled_count_dict, 0.2, seed=1) == test_set
+    assert split.get_filenames_of_test_set(annotation_count_dict, 0.2, seed=2) != test_set